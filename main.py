@@ -22,6 +22,8 @@ import torch.utils.data.distributed
 from optimizers.lr_scheduler import LinearWarmupCosineAnnealingLR
 from trainer import run_training
 from utils.data_utils import get_loader
+from utils.distillation import TEACHER_MODES, CachedTeacher, DistillationLoss, OnlineTeacher, compare_models, load_teacher
+from utils.utils import CROP_SAMPLES, get_inferer
 
 from monai.inferers import sliding_window_inference
 from monai.losses import DiceCELoss, FocalLoss
@@ -30,10 +32,13 @@ from monai.transforms import Activations, AsDiscrete, Compose
 from monai.utils.enums import MetricReduction
 from monai.visualize import matshow3d
 
-from utils.myModel import MyModel, MyModel2d, MyModel3dunet
+from utils.myModel import get_model
 
 parser = argparse.ArgumentParser(description="Swin UNETR segmentation pipeline")
 parser.add_argument("--checkpoint", default=None, help="start training from saved checkpoint")
+parser.add_argument("--resume", default=None, help="resume the full training state from a resume.pt snapshot")
+parser.add_argument("--snapshot_every", default=0, type=int, help="write resume.pt every N training steps, 0 disables")
+parser.add_argument("--seed", default=0, type=int, help="seed of the training crops and augmentations")
 parser.add_argument("--logdir", default="test", type=str, help="directory to save the tensorboard logs")
 parser.add_argument(
     "--pretrained_dir", default="./pretrained_models/", type=str, help="pretrained checkpoint directory"
@@ -47,6 +52,8 @@ parser.add_argument(
     help="pretrained model name",
 )
 parser.add_argument("--save_checkpoint", action="store_true", help="save checkpoint during training")
+parser.add_argument("--sync_checkpoint", action="store_true", help="write checkpoints on the training thread")
+parser.add_argument("--keep_checkpoints", default=0, type=int, help="number of model_epoch{N}.pt history checkpoints")
 parser.add_argument("--max_epochs", default=5000, type=int, help="max number of training epochs")
 parser.add_argument("--batch_size", default=1, type=int, help="number of batch size")
 parser.add_argument("--sw_batch_size", default=4, type=int, help="number of sliding window batch size")
@@ -56,6 +63,15 @@ parser.add_argument("--reg_weight", default=1e-5, type=float, help="regularizati
 parser.add_argument("--momentum", default=0.99, type=float, help="momentum")
 parser.add_argument("--noamp", action="store_true", help="do NOT use amp for training")
 parser.add_argument("--val_every", default=100, type=int, help="validation frequency")
+parser.add_argument("--proxy_val_every", default=0, type=int, help="proxy validation frequency, 0 disables")
+parser.add_argument("--proxy_patches", default=64, type=int, help="number of validation patches in the proxy set")
+parser.add_argument("--proxy_seed", default=0, type=int, help="seed for choosing the proxy validation patches")
+parser.add_argument("--async_val", action="store_true", help="run full validation in a separate process")
+parser.add_argument("--val_device", default="cpu", type=str, help="device of the async validation worker")
+parser.add_argument("--async_val_max_pending", default=2, type=int, help="snapshots queued for the validation worker")
+parser.add_argument(
+    "--best_metric", default="full", choices=["full", "proxy"], help="validation that selects the best checkpoint"
+)
 parser.add_argument("--distributed", action="store_true", help="start distributed training")
 parser.add_argument("--world_size", default=1, type=int, help="number of nodes for distributed training")
 parser.add_argument("--rank", default=0, type=int, help="node rank for distributed training")
@@ -84,19 +100,74 @@ parser.add_argument("--RandRotate90d_prob", default=0.2, type=float, help="RandR
 parser.add_argument("--RandScaleIntensityd_prob", default=0.1, type=float, help="RandScaleIntensityd aug probability")
 parser.add_argument("--RandShiftIntensityd_prob", default=0.1, type=float, help="RandShiftIntensityd aug probability")
 parser.add_argument("--infer_overlap", default=0.5, type=float, help="sliding window inference overlap")
+parser.add_argument("--val_overlap", default=0.0, type=float, help="sliding window overlap of the validation in training")
+parser.add_argument(
+    "--threshold_sweep", action="store_true", help="log dice/iou/F0.5 over all thresholds at every full validation"
+)
+parser.add_argument(
+    "--blend_mode", default="gaussian", choices=["gaussian", "cosine", "constant"], help="overlapping window weighting"
+)
+parser.add_argument(
+    "--mask_threshold", default=0.01, type=float, help="skip inference windows with less fragment mask coverage, 0 disables"
+)
+parser.add_argument(
+    "--crop_mask_threshold", default=0.1, type=float, help="min fragment mask coverage of negative training crops, 0 disables"
+)
 parser.add_argument("--lrschedule", default="warmup_cosine", type=str, help="type of learning rate scheduler")
 parser.add_argument("--warmup_epochs", default=50, type=int, help="number of warmup epochs")
 parser.add_argument("--resume_ckpt", action="store_true", help="resume training from pretrained checkpoint")
 parser.add_argument("--smooth_dr", default=1e-6, type=float, help="constant added to dice denominator to avoid nan")
 parser.add_argument("--smooth_nr", default=0.0, type=float, help="constant added to dice numerator to avoid zero")
 parser.add_argument("--use_checkpoint", action="store_true", help="use gradient checkpointing to save memory")
+parser.add_argument(
+    "--checkpoint_policy",
+    default="swin",
+    type=str,
+    help="activation checkpointing: none, swin, all, auto or comma separated stages (layers1..4, encoder*, decoder*)",
+)
+parser.add_argument("--checkpoint_budget_mb", default=None, type=float, help="activation memory budget for auto policy")
+parser.add_argument(
+    "--swin_attention",
+    default="stock",
+    choices=["stock", "sdpa", "sdpa_keep"],
+    help="window attention: stock, sdpa (attention recomputed in backward) or sdpa_keep (stored for backward)",
+)
 parser.add_argument("--use_ssl_pretrained", action="store_true", help="use self-supervised pretrained weights")
 parser.add_argument("--spatial_dims", default=3, type=int, help="spatial dimension of input data")
 parser.add_argument("--squared_dice", action="store_true", help="use squared Dice")
 
 parser.add_argument("--focalLoss", action="store_true", help="use FocalLoss")
 parser.add_argument("--num_channel", default=65, type=int, help="num of copy channels")
-parser.add_argument("--model_mode", default="3dswin", help="model_mode ['3dswin', '2dswin', '3dunet', '2dunet']")
+parser.add_argument("--model_mode", default="3dswin", help="model_mode ['3dswin', '2dswin', '25dswin', '3dunet', '2dunet']")
+parser.add_argument("--slice_band", default=None, type=str, help="start,stop of the slices the 25dswin stem sees, default all")
+parser.add_argument("--teacher_model", default=None, type=str, help="distil from this frozen checkpoint (path or name in pretrained_dir)")
+parser.add_argument("--teacher_mode", default=None, type=str, help="model_mode of the teacher ['2dswin', '25dswin', '2dunet'], default model_mode")
+parser.add_argument("--teacher_slice_band", default=None, type=str, help="--slice_band of a 25dswin teacher")
+parser.add_argument("--teacher_cache", default=None, type=str, help="directory of precomputed teacher <name>_prob.npy maps")
+parser.add_argument("--distill_alpha", default=0.5, type=float, help="weight of the soft teacher loss, 1 - alpha on the labels")
+parser.add_argument("--distill_temperature", default=2.0, type=float, help="distillation temperature on the logits")
+
+
+def build_loss(args):
+    if args.focalLoss:
+        return FocalLoss(weight=[10.0])
+    elif args.squared_dice:
+        return DiceCELoss(squared_pred=True, smooth_nr=args.smooth_nr, smooth_dr=args.smooth_dr)
+    else:
+        return DiceCELoss(include_background=True, sigmoid=True, ce_weight=torch.Tensor([ 10])) # Normally
+
+
+def build_optimizer(model, args):
+    if args.optim_name == "adam":
+        return torch.optim.Adam(model.parameters(), lr=args.optim_lr, weight_decay=args.reg_weight)
+    elif args.optim_name == "adamw":
+        return torch.optim.AdamW(model.parameters(), lr=args.optim_lr, weight_decay=args.reg_weight)
+    elif args.optim_name == "sgd":
+        return torch.optim.SGD(
+            model.parameters(), lr=args.optim_lr, momentum=args.momentum, nesterov=True, weight_decay=args.reg_weight
+        )
+    else:
+        raise ValueError("Unsupported Optimization Procedure: " + str(args.optim_name))
 
 
 def main():
@@ -133,20 +204,24 @@ def main_worker(gpu, args):
     inf_size = [args.roi_x, args.roi_y, args.roi_z]
 
     pretrained_dir = args.pretrained_dir
-    if args.model_mode == "3dswin":
-        model = MyModel(img_size=(args.roi_x,args.roi_y,args.roi_y))
-    elif args.model_mode == "2dswin":
-        model = MyModel2d(img_size=(args.roi_x,args.roi_y))
-    elif args.model_mode == "3dunet":
-        model = MyModel3dunet(img_size=(args.roi_x,args.roi_y,args.roi_y))
-    else:
-        raise ValueError("model mode error")
+    model = get_model(args)
+    if args.model_mode in ["3dswin", "2dswin", "25dswin"]:
+        stages = model.set_checkpoint_policy(
+            args.checkpoint_policy,
+            budget_mb=args.checkpoint_budget_mb,
+            batch_size=args.batch_size * CROP_SAMPLES[args.model_mode],
+            amp=args.amp,
+        )
+        if args.rank == 0:
+            print("Activation checkpointing on", stages)
+        if args.swin_attention != "stock":
+            model.set_attention("sdpa", recompute=args.swin_attention == "sdpa")
 
     
     if args.resume_ckpt:
             # raise ValueError("2d model can not resume from ckpt")
         model_dict = torch.load(os.path.join(pretrained_dir, args.pretrained_model_name))["state_dict"]
-        if args.model_mode == "2dswin":
+        if args.model_mode in ["2dswin", "25dswin", "2dunet"]:
             model.load_state_dict(model_dict)
         elif args.model_mode == "3dswin":
             model.load_swin_ckpt(model_dict)
@@ -178,56 +253,27 @@ def main_worker(gpu, args):
         except ValueError:
             raise ValueError("Self-supervised pre-trained weights not available for" + str(args.model_name))
 
-    if args.focalLoss:
-        loss = FocalLoss(weight=[10.0])
-    elif args.squared_dice:
-        loss = DiceCELoss(squared_pred=True, smooth_nr=args.smooth_nr, smooth_dr=args.smooth_dr)
-    else:
-        loss = DiceCELoss(include_background=True, sigmoid=True, ce_weight=torch.Tensor([ 10])) # Normally
+    loss = build_loss(args)
+
+    teacher, teacher_model = None, None
+    if args.teacher_model or args.teacher_cache:
+        if args.model_mode not in TEACHER_MODES:
+            raise ValueError("distillation needs a 2D student, model_mode should be one of {}".format(list(TEACHER_MODES)))
+        if args.teacher_mode is None:
+            args.teacher_mode = args.model_mode
+        if args.teacher_model:
+            teacher_model = load_teacher(args, torch.device("cuda", args.gpu))
+            print("Distilling from {} teacher {}".format(args.teacher_mode, args.teacher_model))
+        # the cache is cheaper than running the teacher, so it wins when both are given
+        teacher = CachedTeacher(scale=args.teacher_scale) if args.teacher_cache else OnlineTeacher(teacher_model)
+        loss = DistillationLoss(loss, alpha=args.distill_alpha, temperature=args.distill_temperature)
         
     
     post_label = AsDiscrete(to_onehot=args.out_channels)
     post_pred = AsDiscrete(argmax=True, to_onehot=args.out_channels)
     dice_acc = DiceMetric(include_background=False, reduction=MetricReduction.MEAN, get_not_nans=True)
     miou_acc = MeanIoU(include_background=False, reduction=MetricReduction.MEAN, get_not_nans=True)
-    if args.model_mode == "3dswin":
-        model_inferer = partial(
-            sliding_window_inference,
-            roi_size = (args.roi_x,args.roi_y,args.roi_z),
-            sw_batch_size = 8,
-            predictor = model,
-            overlap = 0,
-            progress = True,
-            padding_mode = "reflect", 
-            device = "cpu", 
-            sw_device = "cuda"
-        )
-    elif args.model_mode == "2dswin":
-        model_inferer = partial(
-            sliding_window_inference,
-            roi_size = (args.roi_x,args.roi_y),
-            sw_batch_size = 8,
-            predictor = model,
-            overlap = 0,
-            progress = True,
-            padding_mode = "reflect", 
-            device = "cpu", 
-            sw_device = "cuda"
-        )
-    elif args.model_mode == "3dunet":
-        model_inferer = partial(
-            sliding_window_inference,
-            roi_size = (args.roi_x,args.roi_y,args.roi_z),
-            sw_batch_size = 8,
-            predictor = model,
-            overlap = 0,
-            progress = True,
-            padding_mode = "reflect", 
-            device = "cpu", 
-            sw_device = "cuda"
-        )
-    else:
-        raise ValueError("model mode error")
+    model_inferer = get_inferer(args, model)
         
 
     pytorch_total_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
@@ -250,6 +296,18 @@ def main_worker(gpu, args):
             best_acc = checkpoint["best_acc"]
         print("=> loaded checkpoint '{}' (epoch {}) (bestacc {})".format(args.checkpoint, start_epoch, best_acc))
 
+    resume_state = None
+    if args.resume is not None:
+        resume_state = torch.load(args.resume, map_location="cpu")
+        model.load_state_dict(resume_state["state_dict"])
+        start_epoch = resume_state["epoch"]
+        best_acc = resume_state["best_acc"]
+        print(
+            "=> resuming '{}' (epoch {}) (step {}) (bestacc {})".format(
+                args.resume, start_epoch, resume_state["step"], best_acc
+            )
+        )
+
     model.cuda(0)
 
     if args.distributed:
@@ -258,16 +316,9 @@ def main_worker(gpu, args):
             model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
         model.cuda(args.gpu)
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu], output_device=args.gpu)
-    if args.optim_name == "adam":
-        optimizer = torch.optim.Adam(model.parameters(), lr=args.optim_lr, weight_decay=args.reg_weight)
-    elif args.optim_name == "adamw":
-        optimizer = torch.optim.AdamW(model.parameters(), lr=args.optim_lr, weight_decay=args.reg_weight)
-    elif args.optim_name == "sgd":
-        optimizer = torch.optim.SGD(
-            model.parameters(), lr=args.optim_lr, momentum=args.momentum, nesterov=True, weight_decay=args.reg_weight
-        )
-    else:
-        raise ValueError("Unsupported Optimization Procedure: " + str(args.optim_name))
+    optimizer = build_optimizer(model, args)
+    if resume_state is not None and "optimizer" in resume_state:
+        optimizer.load_state_dict(resume_state["optimizer"])
 
     if args.lrschedule == "warmup_cosine":
         scheduler = LinearWarmupCosineAnnealingLR(
@@ -279,6 +330,8 @@ def main_worker(gpu, args):
             scheduler.step(epoch=start_epoch)
     else:
         scheduler = None
+    if resume_state is not None and scheduler is not None and "scheduler" in resume_state:
+        scheduler.load_state_dict(resume_state["scheduler"])
     print("Lodaer test")
     for i in loader[0]:
         print(i['image'].shape)
@@ -303,7 +356,15 @@ def main_worker(gpu, args):
         start_epoch=start_epoch,
         post_label=post_label,
         post_pred=post_pred,
+        resume_state=resume_state,
+        teacher=teacher,
     )
+    if teacher is not None and args.rank == 0:
+        # throughput against F0.5 of the final student and its teacher on the validation tiles (of rank 0)
+        models = [("student", model.module if args.distributed else model)]
+        if teacher_model is not None:
+            models.insert(0, ("teacher", teacher_model))
+        compare_models(models, loader[1], lambda m: get_inferer(args, m), torch.device("cuda", args.gpu))
     return accuracy
 
 
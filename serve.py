@@ -0,0 +1,114 @@
+import argparse
+import asyncio
+import os
+
+import numpy as np
+import torch
+
+from monai.data import load_decathlon_datalist
+from utils.inference import StreamingInferer
+from utils.serving import BatchingWorker, InferenceServer
+
+from utils.myModel import MyModel, MyModel2d, MyModel25d, parse_slice_band
+
+# Long-lived inference service: the model stays resident and windows of concurrent requests share micro-batches.
+#   python serve.py --model_mode 2dswin --pretrained_dir ./pretrained_models --pretrained_model_name model.pt \
+#       --data_dir /data --json_list data.json --split test --port 8008
+#   curl -X POST localhost:8008/region -d '{"fragment": "a", "y": 0, "x": 0, "h": 1024, "w": 1024}' -o a.u8
+#   curl localhost:8008/metrics
+parser = argparse.ArgumentParser(description="Swin UNETR inference server")
+parser.add_argument("--pretrained_dir", default="./pretrained_models/", type=str, help="pretrained checkpoint directory")
+parser.add_argument("--pretrained_model_name", default="model.pt", type=str, help="pretrained model name")
+parser.add_argument("--model_mode", default="3dswin", help="model_mode ['3dswin', '2dswin', '25dswin']")
+parser.add_argument("--slice_band", default=None, type=str, help="start,stop of the slices the 25dswin stem sees, default all")
+parser.add_argument("--data_dir", default=None, type=str, help="dataset directory of the fragments to serve")
+parser.add_argument("--json_list", default=None, type=str, help="dataset json file")
+parser.add_argument("--split", default="test", type=str, help="datalist split whose fragments are served")
+parser.add_argument("--host", default="127.0.0.1", type=str, help="address to listen on")
+parser.add_argument("--port", default=8008, type=int, help="port to listen on")
+parser.add_argument("--socket", default=None, type=str, help="listen on this UNIX socket instead of TCP")
+parser.add_argument("--max_batch", default=16, type=int, help="max windows per forward pass")
+parser.add_argument("--max_latency_ms", default=10.0, type=float, help="max wait of a window for its batch to fill")
+parser.add_argument("--sw_batch_size", default=4, type=int, help="windows a request submits at a time")
+parser.add_argument("--noamp", action="store_true", help="do NOT use amp for inference")
+parser.add_argument("--roi_x", default=256, type=int, help="roi size in x direction")
+parser.add_argument("--roi_y", default=256, type=int, help="roi size in y direction")
+parser.add_argument("--a_min", default=0.0, type=float, help="a_min in ScaleIntensityRanged")
+parser.add_argument("--a_max", default=65535.0, type=float, help="a_max in ScaleIntensityRanged")
+parser.add_argument("--b_min", default=0.0, type=float, help="b_min in ScaleIntensityRanged")
+parser.add_argument("--b_max", default=1.0, type=float, help="b_max in ScaleIntensityRanged")
+parser.add_argument("--infer_overlap", default=0.5, type=float, help="sliding window inference overlap")
+parser.add_argument("--blend_mode", default="gaussian", choices=["gaussian", "cosine", "constant"], help="window blending")
+parser.add_argument("--mask_threshold", default=0.01, type=float, help="skip windows with less fragment mask coverage")
+
+
+def load_fragments(args):
+    fragments = {}
+    if args.data_dir is None:
+        return fragments
+    files = load_decathlon_datalist(os.path.join(args.data_dir, args.json_list), True, args.split, base_dir=args.data_dir)
+    for item in files:
+        image_path = item["image"][0] if isinstance(item["image"], list) else item["image"]
+        mask = None
+        if "label" in item:
+            mask_path = item["label"][0] if isinstance(item["label"], list) else item["label"]
+            mask = np.load(mask_path, mmap_mode="r")
+        fragments[os.path.basename(image_path).replace(".npy", "")] = (np.load(image_path, mmap_mode="r"), mask)
+    return fragments
+
+
+def main():
+    args = parser.parse_args()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if args.model_mode == "3dswin":
+        model = MyModel(img_size=(args.roi_x, args.roi_y, args.roi_y), checkpoint_policy="none")
+        layout, depth, activation, window = "3d", 64, None, (1, 1, args.roi_x, args.roi_y, 64)
+    elif args.model_mode == "2dswin":
+        model = MyModel2d(img_size=(args.roi_x, args.roi_y), checkpoint_policy="none")
+        layout, depth, activation, window = "2d", None, "sigmoid", (1, 65, args.roi_x, args.roi_y)
+    elif args.model_mode == "25dswin":
+        model = MyModel25d(
+            img_size=(args.roi_x, args.roi_y), slice_band=parse_slice_band(args.slice_band), checkpoint_policy="none"
+        )
+        layout, depth, activation, window = "2d", None, "sigmoid", (1, 65, args.roi_x, args.roi_y)
+    else:
+        raise ValueError("model_mode should be ['3dswin', '2dswin', '25dswin']")
+    model_dict = torch.load(os.path.join(args.pretrained_dir, args.pretrained_model_name), map_location="cpu")
+    model.load_state_dict(model_dict["state_dict"])
+    model.eval()
+    model.to(device)
+    with torch.no_grad():
+        # warmup, so the first request does not pay for allocator and kernel setup
+        model(torch.zeros(window, device=device))
+
+    worker = BatchingWorker(
+        model, device, max_batch=args.max_batch, max_latency=args.max_latency_ms / 1000.0, amp=not args.noamp
+    )
+
+    def make_inferer(predictor):
+        return StreamingInferer(
+            predictor,
+            roi_size=(args.roi_x, args.roi_y),
+            sw_batch_size=args.sw_batch_size,
+            overlap=args.infer_overlap,
+            layout=layout,
+            depth=depth,
+            intensity=(args.a_min, args.a_max, args.b_min, args.b_max),
+            activation=activation,
+            mask_threshold=args.mask_threshold,
+            blend_mode=args.blend_mode,
+        )
+
+    fragments = load_fragments(args)
+    print("Serving fragments: {}".format(", ".join(sorted(fragments)) or "none (window requests only)"))
+    server = InferenceServer(make_inferer, worker, fragments)
+    try:
+        asyncio.run(server.serve(host=args.host, port=args.port, socket_path=args.socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.close()
+
+
+if __name__ == "__main__":
+    main()
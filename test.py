@@ -18,10 +18,19 @@ import torch
 from utils.data_utils import get_loader
 from utils.utils import dice, resample_3d, resample_2d
 
+from monai.data import load_decathlon_datalist
 from monai.inferers import sliding_window_inference
 from monai.networks.nets import SwinUNETR
+from utils.backends import load_backend
+from utils.cpu_pool import CPUInferencePool
+from utils.ensemble import load_ensemble
+from utils.inference import CascadeInferer, StreamingInferer
+from utils.prob_store import ProbStore, ProbStoreWriter
+from utils.rle import SubmissionWriter
+from utils.threshold_metrics import ThresholdHistogram
+from utils.tta import TTAPredictor
 
-from utils.myModel import MyModel,MyModel2d
+from utils.myModel import MyModel,MyModel2d,MyModel25d,MyModel2dunet,parse_slice_band
 
 parser = argparse.ArgumentParser(description="Swin UNETR segmentation pipeline")
 parser.add_argument("--checkpoint", default=None, help="start training from saved checkpoint")
@@ -88,7 +97,179 @@ parser.add_argument("--squared_dice", action="store_true", help="use squared Dic
 parser.add_argument("--focalLoss", action="store_true", help="use FocalLoss")
 parser.add_argument("--num_channel", default=65, type=int, help="num of copy channels")
 parser.add_argument("--exp_name", default="test2", type=str, help="experiment name")
-parser.add_argument("--model_mode", default="3dswin", help="model_mode ['3dswin', '2dswin', '3dunet', '2dunet']")
+parser.add_argument("--model_mode", default="3dswin", help="model_mode ['3dswin', '2dswin', '25dswin', '3dunet', '2dunet']")
+parser.add_argument("--slice_band", default=None, type=str, help="start,stop of the slices the 25dswin stem sees, default all")
+parser.add_argument("--streaming", action="store_true", help="bounded memory inference on memmapped fragments")
+parser.add_argument("--split", default="validation", type=str, help="datalist split used by --streaming")
+parser.add_argument(
+    "--blend_mode", default="gaussian", choices=["gaussian", "cosine", "constant"], help="overlapping window weighting"
+)
+parser.add_argument(
+    "--mask_threshold", default=0.01, type=float, help="skip inference windows with less fragment mask coverage, 0 disables"
+)
+parser.add_argument(
+    "--crop_mask_threshold", default=0.1, type=float, help="min fragment mask coverage of negative training crops, 0 disables"
+)
+parser.add_argument(
+    "--tta", default="none", type=str, help="test-time augmentation: none, flips, rot, all or a list like identity,flip"
+)
+parser.add_argument(
+    "--ensemble_models", default=None, type=str, help="comma separated checkpoints in pretrained_dir averaged as one model"
+)
+parser.add_argument("--ensemble_mode", default="vmap", choices=["vmap", "loop"], help="how ensemble members are evaluated")
+parser.add_argument("--cascade", action="store_true", help="refine only windows a coarse first stage flags as ink")
+parser.add_argument("--cascade_model", default=None, type=str, help="first stage checkpoint in pretrained_dir, default the model")
+parser.add_argument("--cascade_scale", default=4, type=int, help="y/x subsampling of the first stage input")
+parser.add_argument("--cascade_threshold", default=0.1, type=float, help="min coarse ink probability to refine a window")
+parser.add_argument("--cascade_compare", action="store_true", help="also run dense inference and report the dice delta")
+parser.add_argument("--out_dtype", default="uint8", choices=["uint8", "float16"], help="dtype of streamed probability maps")
+parser.add_argument(
+    "--out_format", default="npy", choices=["npy", "tiles"], help="streamed maps as a .npy memmap or a compressed uint8 tile store"
+)
+parser.add_argument("--submission", default=None, type=str, help="also write an RLE submission CSV of the streamed maps")
+parser.add_argument("--submission_threshold", default=0.5, type=float, help="ink probability threshold of the submission")
+parser.add_argument("--out_tile", default=256, type=int, help="tile size of the tile store")
+parser.add_argument("--cpu_workers", default=0, type=int, help="CPU streaming inference in this many forked processes")
+parser.add_argument(
+    "--backend", default="eager", choices=["eager", "torchscript", "onnxruntime"], help="runtime of the model, see tools/export_model.py"
+)
+parser.add_argument("--backend_threads", default=None, type=int, help="intra-op threads of the torchscript/onnxruntime backend")
+parser.add_argument("--freeze", action="store_true", help="specialise the eager model to the roi, see freeze_for_inference")
+parser.add_argument("--sparse_windows", action="store_true", help="skip Swin windows over empty / out-of-mask input")
+parser.add_argument("--sparse_floor", default=0.0, type=float, help="pixels at or below this (scaled) intensity are empty")
+parser.add_argument("--threads_per_worker", default=None, type=int, help="torch threads per CPU worker, default cores/workers")
+
+
+def map_histogram(output, labels, rows=1024):
+    """
+    Threshold histogram of a (memmapped) probability map against the ink labels, read ``rows`` rows at a time.
+    """
+    return ThresholdHistogram().update_chunked(output, labels, rows=rows)
+
+
+def streaming_inference(args, model, device, output_directory, coarse_model=None):
+    datalist_json = os.path.join(args.data_dir, args.json_list)
+    files = load_decathlon_datalist(datalist_json, True, args.split, base_dir=args.data_dir)
+    if args.model_mode in ["2dswin", "25dswin", "2dunet"]:
+        layout, depth, activation = "2d", None, "sigmoid"
+    elif args.model_mode == "3dswin":
+        # MyModel ends with a sigmoid conv and sees the 64 slices left by Drop1Layerd
+        layout, depth, activation = "3d", 64, None
+    else:
+        raise ValueError("model_mode should be ['3dswin', '2dswin', '3dunet', '2dunet']")
+
+    def make_inferer(predictor):
+        return StreamingInferer(
+            predictor,
+            roi_size=(args.roi_x, args.roi_y),
+            sw_batch_size=args.sw_batch_size,
+            overlap=args.infer_overlap,
+            device=device,
+            layout=layout,
+            depth=depth,
+            intensity=(args.a_min, args.a_max, args.b_min, args.b_max),
+            activation=activation,
+            mask_threshold=args.mask_threshold,
+            blend_mode=args.blend_mode,
+        )
+
+    def open_output(name, shape):
+        if args.out_format == "tiles":
+            # the tile store is always uint8
+            return ProbStoreWriter(os.path.join(output_directory, name), shape, tile=(args.out_tile, args.out_tile))
+        return np.lib.format.open_memmap(
+            os.path.join(output_directory, name + ".npy"), mode="w+", dtype=args.out_dtype, shape=shape
+        )
+
+    def reopen(output):
+        return ProbStore(output.path) if isinstance(output, ProbStoreWriter) else output
+
+    predictor = model if args.tta == "none" else TTAPredictor(model, args.tta)
+    dense_inferer = make_inferer(predictor)
+    inferer = dense_inferer
+    if coarse_model is not None:
+        inferer = CascadeInferer(
+            make_inferer(coarse_model), dense_inferer, scale=args.cascade_scale, threshold=args.cascade_threshold
+        )
+    pool = None
+    if args.cpu_workers > 0:
+        if coarse_model is not None or device.type != "cpu":
+            raise ValueError("--cpu_workers runs dense CPU inference, it cannot be combined with --cascade or a GPU")
+        pool = CPUInferencePool(dense_inferer, workers=args.cpu_workers, threads_per_worker=args.threads_per_worker)
+        inferer = pool
+    dice_list_case, dense_dice_list_case = [], []
+    total_hist = ThresholdHistogram()
+    submission = SubmissionWriter(args.submission) if args.submission else None
+    for item in files:
+        image_path = item["image"][0] if isinstance(item["image"], list) else item["image"]
+        img_name = os.path.basename(image_path).replace(".npy", "")
+        print("Streaming inference on case {}".format(img_name))
+        volume = np.load(image_path, mmap_mode="r")
+        output = open_output(img_name + "_prob", volume.shape[1:])
+        mask = None
+        if "label" in item:
+            mask_path = item["label"][0] if isinstance(item["label"], list) else item["label"]
+            mask = np.load(mask_path, mmap_mode="r")
+        stats = inferer(volume, output, mask=mask)
+        print(
+            "{} windows ({} skipped outside the mask) in {:.2f}s ({:.2f} windows/s)".format(
+                stats["windows"], stats["masked"], stats["time"], stats["windows_per_s"]
+            )
+        )
+        if coarse_model is not None:
+            print(
+                "Cascade skipped {} windows ({:.1%}), coarse stage {:.2f}s".format(
+                    stats["filtered"], stats["cascade_skip_fraction"], stats["coarse_time"]
+                )
+            )
+        if pool is not None:
+            print(
+                "Windows/s per worker ({} threads each): {}".format(
+                    pool.threads_per_worker, ", ".join("{:.2f}".format(v) for v in stats["worker_windows_per_s"])
+                )
+            )
+        elif isinstance(predictor, TTAPredictor):
+            print(predictor.report())
+            predictor.reset_timing()
+        if args.sparse_windows and pool is None:
+            # forked workers count in their own copy of the model
+            print(model.sparse_report())
+            model.sparse_stats.update(windows=0, skipped=0)
+        if submission is not None:
+            submission.add(img_name, reopen(output), threshold=args.submission_threshold)
+        if "inklabels" in item:
+            label_path = item["inklabels"][0] if isinstance(item["inklabels"], list) else item["inklabels"]
+            labels = np.load(label_path, mmap_mode="r")
+            hist = map_histogram(reopen(output), labels)
+            total_hist += hist
+            mean_dice = float(hist.dice()[hist.at(0.5)])
+            print("Mean Organ Dice: {}".format(mean_dice))
+            print(hist.summary())
+            dice_list_case.append(mean_dice)
+            if coarse_model is not None and args.cascade_compare:
+                dense_output = open_output(img_name + "_dense_prob", volume.shape[1:])
+                dense_stats = dense_inferer(volume, dense_output, mask=mask)
+                dense_hist = map_histogram(reopen(dense_output), labels)
+                dense_dice = float(dense_hist.dice()[dense_hist.at(0.5)])
+                dense_dice_list_case.append(dense_dice)
+                print(
+                    "Dense Dice: {} (cascade delta {:+.4f}), dense {:.2f}s vs cascade {:.2f}s".format(
+                        dense_dice, mean_dice - dense_dice, dense_stats["time"], stats["time"]
+                    )
+                )
+    if submission is not None:
+        submission.close()
+    if pool is not None:
+        pool.close()
+    if dice_list_case:
+        print("Overall Mean Dice: {}".format(np.mean(dice_list_case)))
+        print("Overall (pooled pixels): {}".format(total_hist.summary()))
+    if dense_dice_list_case:
+        print(
+            "Overall Dense Dice: {} (cascade delta {:+.4f})".format(
+                np.mean(dense_dice_list_case), np.mean(dice_list_case) - np.mean(dense_dice_list_case)
+            )
+        )
 
 
 def main():
@@ -97,21 +278,80 @@ def main():
     output_directory = "./outputs/" + args.exp_name
     if not os.path.exists(output_directory):
         os.makedirs(output_directory)
-    val_loader = get_loader(args)
     pretrained_dir = args.pretrained_dir
     model_name = args.pretrained_model_name
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     pretrained_pth = os.path.join(pretrained_dir, model_name)
-    if args.model_mode == "3dswin":
-        model = MyModel(img_size=(args.roi_x,args.roi_y,args.roi_y))
-    elif args.model_mode == "2dswin":
-        model = MyModel2d(img_size=(args.roi_x,args.roi_y))
+
+    # MyModel sees the 64 slices left by Drop1Layerd as its last dim
+    frozen_roi = (args.roi_x, args.roi_y, 64) if args.model_mode == "3dswin" else (args.roi_x, args.roi_y)
+    if args.model_mode == "2dunet" and (args.freeze or args.sparse_windows):
+        raise ValueError("--freeze and --sparse_windows need a Swin model_mode")
+    streaming_only = [
+        name
+        for name, used in (
+            ("--cascade", args.cascade),
+            ("--cpu_workers", args.cpu_workers > 0),
+            ("--out_format", args.out_format != "npy"),
+            ("--out_dtype", args.out_dtype != "uint8"),
+            ("--submission", args.submission is not None),
+        )
+        if used
+    ]
+    if streaming_only and not args.streaming:
+        raise ValueError("--streaming is needed for {}".format(", ".join(streaming_only)))
+
+    def build_model():
+        if args.model_mode == "3dswin":
+            return MyModel(img_size=(args.roi_x,args.roi_y,args.roi_y), checkpoint_policy="none")
+        elif args.model_mode == "2dswin":
+            return MyModel2d(img_size=(args.roi_x,args.roi_y), checkpoint_policy="none")
+        elif args.model_mode == "25dswin":
+            return MyModel25d(
+                img_size=(args.roi_x,args.roi_y), slice_band=parse_slice_band(args.slice_band), checkpoint_policy="none"
+            )
+        elif args.model_mode == "2dunet":
+            return MyModel2dunet()
+        else:
+            raise ValueError("model mode error")
+
+    if args.backend != "eager":
+        if args.ensemble_models or (args.backend == "onnxruntime" and args.cpu_workers > 0):
+            raise ValueError("--backend {} cannot be combined with --ensemble_models or --cpu_workers".format(args.backend))
+        model = load_backend(args.backend, pretrained_pth, device=device, threads=args.backend_threads)
+    elif args.ensemble_models:
+        checkpoints = [os.path.join(pretrained_dir, name) for name in args.ensemble_models.split(",")]
+        model = load_ensemble(checkpoints, build_model, device, mode=args.ensemble_mode)
     else:
-        raise ValueError("model mode error")
-    model_dict = torch.load(pretrained_pth)["state_dict"]
-    model.load_state_dict(model_dict)
-    model.eval()
-    model.to(device)
+        model = build_model()
+        model_dict = torch.load(pretrained_pth, map_location="cpu")["state_dict"]
+        model.load_state_dict(model_dict)
+        model.eval()
+        model.to(device)
+        if args.freeze:
+            model.freeze_for_inference(frozen_roi)
+    if args.sparse_windows:
+        if args.backend != "eager" or args.ensemble_models or args.freeze or args.tta != "none":
+            raise ValueError("--sparse_windows needs a single eager model without --freeze or --tta")
+        model.set_sparse_windows(True, intensity_floor=args.sparse_floor)
+    if args.streaming:
+        coarse_model = None
+        if args.cascade and args.cascade_model:
+            coarse_model = build_model()
+            coarse_model.load_state_dict(
+                torch.load(os.path.join(pretrained_dir, args.cascade_model), map_location="cpu")["state_dict"]
+            )
+            coarse_model.eval()
+            coarse_model.to(device)
+            if args.freeze:
+                coarse_model.freeze_for_inference(frozen_roi)
+        elif args.cascade:
+            coarse_model = model
+        streaming_inference(args, model, device, output_directory, coarse_model=coarse_model)
+        return
+    val_loader = get_loader(args)
+    if args.tta != "none":
+        model = TTAPredictor(model, args.tta)
 
     with torch.no_grad():
         dice_list_case = []
@@ -140,7 +380,7 @@ def main():
             val_outputs = np.argmax(val_outputs, axis=1).astype(np.uint8)[0]
             val_labels = val_labels.cpu()
             val_labels = np.array(val_labels)[0, 0, :, :]
-            if args.model_mode == "2dswin":
+            if args.model_mode in ["2dswin", "25dswin", "2dunet"]:
                 val_outputs = resample_2d(val_outputs, target_shape)
             elif args.model_mode == "3dswin":
                 val_outputs = resample_3d(val_outputs, target_shape)
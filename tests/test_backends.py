@@ -0,0 +1,48 @@
+import pytest
+import torch
+
+from utils.backends import export_onnx, export_paths, export_torchscript, load_backend, window_shape
+from utils.myModel import MyModel2d
+
+
+@pytest.fixture(scope="module")
+def exported(tmp_path_factory):
+    torch.manual_seed(0)
+    model = MyModel2d(img_size=(64, 64), checkpoint_policy="none").eval()
+    model_path = str(tmp_path_factory.mktemp("export") / "model.pt")
+    torch.save({"state_dict": model.state_dict()}, model_path)
+    return model, model_path
+
+
+def test_torchscript_matches_eager(exported):
+    model, model_path = exported
+    ts_path, _ = export_paths(model_path)
+    export_torchscript(model, torch.rand(window_shape("2dswin", 64, 64, 2)), ts_path)
+    predictor = load_backend("torchscript", model_path)
+    x = torch.rand(3, 65, 64, 64)
+    with torch.no_grad():
+        assert torch.allclose(predictor(x), model(x), atol=1e-4)
+
+
+def test_onnxruntime_matches_eager(exported):
+    pytest.importorskip("onnxruntime")
+    model, model_path = exported
+    _, onnx_path = export_paths(model_path)
+    export_onnx(model, torch.rand(window_shape("2dswin", 64, 64, 2)), onnx_path)
+    predictor = load_backend("onnxruntime", model_path, threads=1)
+    # the batch dim stays dynamic
+    for batch in (1, 3):
+        x = torch.rand(batch, 65, 64, 64)
+        with torch.no_grad():
+            assert torch.allclose(predictor(x), model(x), atol=1e-4)
+
+
+def test_load_backend_paths(tmp_path):
+    model = torch.nn.Identity()
+    assert load_backend("eager", "unused.pt", model=model) is model
+    with pytest.raises(FileNotFoundError):
+        load_backend("torchscript", str(tmp_path / "missing.pt"))
+    assert export_paths("/a/b/model.pt") == ("/a/b/model.ts", "/a/b/model.onnx")
+    assert window_shape("3dswin", 32, 48) == (1, 1, 32, 48, 64)
+    with pytest.raises(ValueError):
+        window_shape("3dunet", 32, 32)
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+import torch
+
+from utils.cpu_pool import CPUInferencePool, split_threads
+from utils.inference import StreamingInferer
+
+
+class FailOnBright(torch.nn.Module):
+    def forward(self, x):
+        if float(x.max()) > 0.99:
+            raise RuntimeError("bright window")
+        return x[:, :1]
+
+
+def make_inferer(model):
+    return StreamingInferer(
+        model, roi_size=(32, 32), sw_batch_size=3, overlap=0.5, intensity=(0.0, 1.0, 0.0, 1.0), mask_threshold=0.05
+    )
+
+
+def saved_volume(tmp_path, volume, name="volume"):
+    path = str(tmp_path / (name + ".npy"))
+    np.save(path, volume)
+    return np.load(path, mmap_mode="r")
+
+
+def test_pool_matches_single_process(tmp_path):
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Conv2d(3, 4, 3, padding=1), torch.nn.Tanh(), torch.nn.Conv2d(4, 1, 3, padding=1))
+    model.eval()
+    rng = np.random.default_rng(0)
+    volume = saved_volume(tmp_path, rng.random((3, 150, 110)).astype(np.float32))
+    mask = np.ones(volume.shape[1:], dtype=np.uint8)
+    mask[100:, 60:] = 0
+    expected = np.zeros(volume.shape[1:], dtype=np.float32)
+    expected_stats = make_inferer(model)(volume, expected, mask=mask)
+    pool = CPUInferencePool(make_inferer(model), workers=2, threads_per_worker=1, band_rows=1, tmp_dir=str(tmp_path))
+    try:
+        output = np.zeros(volume.shape[1:], dtype=np.float32)
+        stats = pool(volume, output, mask=mask)
+    finally:
+        pool.close()
+    np.testing.assert_allclose(output, expected, atol=1e-5)
+    assert stats["windows"] == expected_stats["windows"] and stats["masked"] == expected_stats["masked"] > 0
+    assert len(stats["worker_windows_per_s"]) == 2
+
+
+def test_pool_errors_and_inputs(tmp_path):
+    volume = np.zeros((1, 64, 64), dtype=np.float32)
+    volume[0, 40:, 40:] = 1
+    pool = CPUInferencePool(make_inferer(FailOnBright()), workers=2, threads_per_worker=1, tmp_dir=str(tmp_path))
+    try:
+        with pytest.raises(ValueError):
+            pool(volume, np.zeros((64, 64), dtype=np.float32))
+        with pytest.raises(RuntimeError):
+            pool(saved_volume(tmp_path, volume, "bright"), np.zeros((64, 64), dtype=np.float32))
+        # nothing of the failed fragment is left over for the next one
+        output = np.zeros((64, 64), dtype=np.float32)
+        pool(saved_volume(tmp_path, volume * 0.5, "dim"), output)
+        np.testing.assert_allclose(output, 1 / (1 + np.exp(-volume[0] * 0.5)), atol=1e-6)
+    finally:
+        pool.close()
+
+
+def test_split_threads():
+    assert split_threads(4, cores=16) == 4
+    assert split_threads(3, cores=8) == 2
+    assert split_threads(8, cores=4) == 1
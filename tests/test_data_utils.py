@@ -0,0 +1,53 @@
+import numpy as np
+import torch
+from monai import data, transforms
+
+from utils.data_utils import Sampler, SeededDataset
+
+
+def seeded_dataset(seed=0):
+    items = [{"image": np.full((1, 16, 16), i, dtype=np.float32)} for i in range(6)]
+    transform = transforms.Compose(
+        [
+            transforms.RandSpatialCropd(keys="image", roi_size=(8, 8), random_size=False),
+            transforms.RandFlipd(keys="image", prob=0.5, spatial_axis=0),
+            transforms.RandShiftIntensityd(keys="image", offsets=0.1, prob=0.5),
+        ]
+    )
+    return SeededDataset(data.Dataset(data=items, transform=transform), seed=seed)
+
+
+def test_samples_do_not_depend_on_order():
+    ds = seeded_dataset()
+    forward = [ds[i]["image"] for i in range(len(ds))]
+    backward = [ds[i]["image"] for i in reversed(range(len(ds)))][::-1]
+    for a, b in zip(forward, backward):
+        assert torch.equal(torch.as_tensor(a), torch.as_tensor(b))
+
+
+def test_samples_change_with_epoch():
+    ds = seeded_dataset()
+    first = [torch.as_tensor(ds[i]["image"]) for i in range(len(ds))]
+    ds.set_epoch(1)
+    second = [torch.as_tensor(ds[i]["image"]) for i in range(len(ds))]
+    assert any(not torch.equal(a, b) for a, b in zip(first, second))
+
+
+def test_resumed_epoch_matches_uninterrupted_one():
+    def epoch_batches(start_index, num_workers):
+        ds = seeded_dataset()
+        sampler = Sampler(ds, num_replicas=1, rank=0)
+        sampler.set_epoch(3)
+        ds.set_epoch(3)
+        sampler.set_start_index(start_index)
+        loader = data.DataLoader(ds, batch_size=1, sampler=sampler, num_workers=num_workers)
+        # global RNG consumed differently before the resumed iterator is created
+        torch.rand(start_index + 1)
+        np.random.rand(start_index + 1)
+        return [batch["image"] for batch in loader]
+
+    full = epoch_batches(0, num_workers=0)
+    resumed = epoch_batches(2, num_workers=2)
+    assert len(resumed) == len(full) - 2
+    for a, b in zip(full[2:], resumed):
+        assert torch.equal(a, b)
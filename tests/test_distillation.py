@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+from utils.distillation import CachedTeacher, DistillationLoss, OnlineTeacher, add_teacher_cache, compare_models
+from utils.inference import TileInferer
+
+
+def test_loss_mixes_hard_and_soft_terms():
+    torch.manual_seed(0)
+    logits, teacher = torch.randn(2, 1, 8, 8), torch.randn(2, 1, 8, 8)
+    target = (torch.rand(2, 1, 8, 8) > 0.5).float()
+    hard_loss = torch.nn.BCEWithLogitsLoss()
+    loss = DistillationLoss(hard_loss, alpha=0.3, temperature=2.0)
+    soft = F.binary_cross_entropy_with_logits(logits / 2, torch.sigmoid(teacher / 2)) * 4
+    assert torch.allclose(loss(logits, target, teacher), 0.7 * hard_loss(logits, target) + 0.3 * soft)
+    assert torch.equal(loss(logits, target), hard_loss(logits, target))
+    assert torch.equal(DistillationLoss(hard_loss, alpha=0.0)(logits, target, teacher), hard_loss(logits, target))
+    with pytest.raises(ValueError):
+        DistillationLoss(hard_loss, alpha=1.5)
+
+
+def test_soft_term_is_stationary_at_the_teacher():
+    teacher = torch.randn(1, 1, 8, 8)
+    logits = teacher.clone().requires_grad_(True)
+    DistillationLoss(torch.nn.BCEWithLogitsLoss(), alpha=1.0, temperature=3.0)(logits, torch.zeros_like(teacher), teacher).backward()
+    assert logits.grad.abs().max() < 1e-6
+
+
+def test_cached_teacher_reads_uint8_maps(tmp_path):
+    prob = np.array([[0, 64, 128], [192, 255, 10]], dtype=np.uint8)
+    np.save(str(tmp_path / "frag1_prob.npy"), prob)
+    datalist = [{"image": "/data/frag1.npy"}]
+    scale = add_teacher_cache(datalist, str(tmp_path))
+    assert scale == pytest.approx(1 / 255.0)
+    assert datalist[0]["teacher"] == str(tmp_path / "frag1_prob.npy")
+    batch = {"teacher": torch.from_numpy(prob)[None, None]}
+    logits = CachedTeacher(scale)(batch, torch.zeros(1))
+    assert torch.allclose(torch.sigmoid(logits)[0, 0], torch.from_numpy(prob).float() / 255, atol=1e-4)
+    with pytest.raises(FileNotFoundError):
+        add_teacher_cache([{"image": "/data/frag2.npy"}], str(tmp_path))
+
+
+def test_online_teacher_is_frozen():
+    model = torch.nn.Conv2d(3, 1, 1).train()
+    teacher = OnlineTeacher(model)
+    out = teacher({}, torch.rand(1, 3, 4, 4))
+    assert not model.training and not out.requires_grad
+    assert not any(p.requires_grad for p in model.parameters())
+
+
+def test_compare_models_scores_models():
+    torch.manual_seed(0)
+    labels = (torch.rand(2, 1, 64, 64) > 0.7).float()
+    # the first channel is the label, a perfect model only has to read it
+    loader = [{"image": torch.cat([labels[i: i + 1], torch.rand(1, 2, 64, 64)], 1), "inklabels": labels[i: i + 1]}
+              for i in range(2)]
+    perfect = torch.nn.Conv2d(3, 1, 1)
+    with torch.no_grad():
+        perfect.weight.zero_()
+        perfect.weight[0, 0] = 40.0
+        perfect.bias.fill_(-20.0)
+    blind = torch.nn.Conv2d(3, 1, 1)
+    with torch.no_grad():
+        blind.weight.zero_()
+        blind.bias.fill_(-5.0)
+    inferer_fn = lambda m: TileInferer(m, roi_size=(32, 32), overlap=0.0, sw_device="cpu")
+    rows = compare_models([("perfect", perfect), ("blind", blind)], loader, inferer_fn, torch.device("cpu"), verbose=False)
+    assert [row["name"] for row in rows] == ["perfect", "blind"]
+    assert rows[0]["dice"] == pytest.approx(1.0) and rows[0]["f05"] == pytest.approx(1.0)
+    assert rows[1]["dice"] == 0.0
+    assert rows[0]["params"] == 4
@@ -0,0 +1,40 @@
+import torch
+
+from utils.ensemble import EnsemblePredictor, load_ensemble
+from utils.myModel import MyModel2d
+
+
+def members(k=3):
+    models = []
+    for seed in range(k):
+        torch.manual_seed(seed)
+        models.append(MyModel2d(img_size=(64, 64), checkpoint_policy="none").eval())
+    return models
+
+
+def test_vmap_and_loop_match_mean_of_members():
+    models = members()
+    x = torch.rand(2, 65, 64, 64)
+    with torch.no_grad():
+        ref = torch.stack([m(x) for m in models]).mean(0)
+        vmapped = EnsemblePredictor(models, mode="vmap")(x)
+        looped = EnsemblePredictor(models, mode="loop")(x)
+    assert torch.allclose(vmapped, ref, atol=1e-4), float((vmapped - ref).abs().max())
+    assert torch.allclose(looped, ref, atol=1e-5)
+
+
+def test_load_ensemble_from_checkpoints(tmp_path):
+    models = members(2)
+    paths = []
+    for i, model in enumerate(models):
+        paths.append(str(tmp_path / "fold{}.pt".format(i)))
+        torch.save({"state_dict": model.state_dict()}, paths[-1])
+    build = lambda: MyModel2d(img_size=(64, 64), checkpoint_policy="none")
+    ensemble = load_ensemble(paths, build, "cpu", mode="vmap")
+    x = torch.rand(1, 65, 64, 64)
+    with torch.no_grad():
+        ref = (models[0](x) + models[1](x)) / 2
+        out = ensemble(x)
+    assert torch.allclose(out, ref, atol=1e-4)
+    tensors = list(models[0].parameters()) + list(models[0].buffers())
+    assert ensemble.weight_bytes() == 2 * sum(t.numel() * t.element_size() for t in tensors)
@@ -0,0 +1,62 @@
+import argparse
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from utils.myModel import MyModel25d, SliceStem, get_model, parse_slice_band
+
+
+def test_stem_collapses_depth_to_a_convex_combination():
+    torch.manual_seed(0)
+    stem = SliceStem(out_channels=6).eval()
+    x = torch.rand(2, 65, 24, 20)
+    with torch.no_grad():
+        features = stem.conv2(stem.conv1(x.unsqueeze(1)))
+        out = stem(x)
+    assert features.shape[2] == 9
+    assert out.shape == (2, 6, 24, 20)
+    assert torch.all(out <= features.amax(2) + 1e-6) and torch.all(out >= features.amin(2) - 1e-6)
+
+
+def test_any_window_size_is_padded_and_cropped():
+    torch.manual_seed(0)
+    model = MyModel25d(img_size=(50, 72), checkpoint_policy="none").eval()
+    assert model.img_size == (64, 96)
+    x = torch.rand(1, 65, 50, 72)
+    with torch.no_grad():
+        out = model(x)
+        padded = model(F.pad(x, (0, 24, 0, 14)))
+    assert out.shape == (1, 1, 50, 72)
+    assert torch.allclose(out, padded[..., :50, :72], atol=1e-5)
+
+
+def test_slices_outside_the_band_are_ignored():
+    torch.manual_seed(0)
+    model = MyModel25d(img_size=(64, 64), slice_band=(8, 40), checkpoint_policy="none").eval()
+    x = torch.rand(1, 65, 64, 64)
+    outside, inside = x.clone(), x.clone()
+    outside[:, :8] = 0
+    outside[:, 40:] = 1
+    inside[:, 20] = 0
+    with torch.no_grad():
+        ref = model(x)
+        assert torch.equal(model(outside), ref)
+        assert not torch.allclose(model(inside), ref)
+
+
+def test_training_step_reaches_the_stem():
+    torch.manual_seed(0)
+    model = MyModel25d(img_size=(64, 64), checkpoint_policy="swin").train()
+    model(torch.rand(2, 65, 64, 64)).mean().backward()
+    assert model.stem.conv1[0].weight.grad.abs().sum() > 0
+    assert model.stem.score.weight.grad.abs().sum() > 0
+
+
+def test_get_model_and_slice_band():
+    args = argparse.Namespace(model_mode="25dswin", roi_x=64, roi_y=64, slice_band="8,40")
+    model = get_model(args)
+    assert isinstance(model, MyModel25d) and model.slice_band == (8, 40)
+    assert parse_slice_band(None) is None and parse_slice_band("") is None
+    with pytest.raises(ValueError):
+        parse_slice_band("40,8")
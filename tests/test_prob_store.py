@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from utils.prob_store import ProbStore, ProbStoreWriter, average_stores
+
+
+def sparse_map(seed, shape=(70, 90)):
+    rng = np.random.default_rng(seed)
+    prob = np.zeros(shape, dtype=np.uint8)
+    # ink in one corner only, so most tiles are empty and not stored
+    prob[5:30, 40:85] = rng.integers(0, 256, size=(25, 45))
+    return prob
+
+
+def write_store(path, prob, tile=(16, 32), compression="zlib", band=7):
+    writer = ProbStoreWriter(str(path), prob.shape, tile=tile, compression=compression)
+    for y in range(0, prob.shape[0], band):
+        writer[y: y + band] = prob[y: y + band]
+    return ProbStore(str(path))
+
+
+@pytest.mark.parametrize("compression", ["zlib", "none"])
+def test_round_trip_and_slicing(tmp_path, compression):
+    prob = sparse_map(0)
+    store = write_store(tmp_path / "store", prob, compression=compression)
+    assert store.shape == prob.shape
+    assert np.array_equal(store[:, :], prob)
+    assert np.array_equal(store[3:41, 17:88], prob[3:41, 17:88])
+    assert np.array_equal(store[60:], prob[60:])
+    assert (store.index[..., 1] == 0).sum() > 0
+    assert np.allclose(store.probabilities((slice(5, 9), slice(40, 50))), prob[5:9, 40:50] / 255.0)
+    assert np.array_equal(store.to_memmap(str(tmp_path / "map.npy")), prob)
+
+
+def test_float_rows_are_quantized(tmp_path):
+    prob = np.random.default_rng(1).random((20, 30)).astype(np.float32)
+    store = write_store(tmp_path / "store", prob, band=20)
+    assert np.array_equal(store[:, :], np.rint(prob * 255).astype(np.uint8))
+
+
+def test_rows_out_of_order_are_rejected(tmp_path):
+    writer = ProbStoreWriter(str(tmp_path / "store"), (20, 30), tile=(8, 8))
+    writer[0:5] = np.zeros((5, 30), dtype=np.uint8)
+    with pytest.raises(ValueError):
+        writer[6:10] = np.zeros((4, 30), dtype=np.uint8)
+
+
+def test_average_stores_round_trip(tmp_path):
+    probs = [sparse_map(seed) for seed in range(3)]
+    paths = [str(tmp_path / "fold{}".format(i)) for i in range(3)]
+    for path, prob in zip(paths, probs):
+        write_store(path, prob)
+    mean = average_stores(paths, str(tmp_path / "mean"))
+    expected = np.rint(np.mean(np.stack(probs).astype(np.float64), axis=0)).astype(np.uint8)
+    assert np.array_equal(mean[:, :], expected)
+    # averaging a store with itself gives it back
+    assert np.array_equal(average_stores([paths[0], paths[0]], str(tmp_path / "same"))[:, :], probs[0])
+    write_store(tmp_path / "other", np.zeros((10, 10), dtype=np.uint8))
+    with pytest.raises(ValueError):
+        average_stores([paths[0], str(tmp_path / "other")], str(tmp_path / "bad"))
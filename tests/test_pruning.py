@@ -0,0 +1,60 @@
+import pytest
+import torch
+
+from utils.myModel import MyModel2d
+from utils.pruning import l1_scores, prunable_groups, prune_channels, taylor_scores
+
+
+def model_with_dead_channels(sparsity, min_channels=4):
+    # zero the consumer weights of the channels prune_channels will drop, so pruning must not change the output
+    torch.manual_seed(0)
+    model = MyModel2d(img_size=(64, 64), checkpoint_policy="none").eval()
+    for _, _, consumer in prunable_groups(model):
+        weight = model.get_submodule(consumer).weight
+        n = weight.shape[1]
+        keep = max(min(min_channels, n), int(round(n * (1.0 - sparsity))))
+        with torch.no_grad():
+            weight[:, torch.randperm(n)[: n - keep]] = 0
+    return model
+
+
+def test_pruning_dead_channels_keeps_the_output():
+    model = model_with_dead_channels(0.5)
+    x = torch.rand(2, 65, 64, 64)
+    with torch.no_grad():
+        ref = model(x)
+    groups = prunable_groups(model)
+    params = sum(p.numel() for p in model.parameters())
+    kept = prune_channels(model, 0.5, l1_scores(model, groups), groups)
+    assert len(groups) > 0 and set(kept) == {g[2] for g in groups}
+    assert sum(p.numel() for p in model.parameters()) < params
+    with torch.no_grad():
+        assert torch.allclose(model(x), ref, atol=1e-5)
+
+
+def test_pruned_checkpoint_reloads_into_a_fresh_model(tmp_path):
+    model = model_with_dead_channels(0.25)
+    prune_channels(model, 0.25, l1_scores(model))
+    path = str(tmp_path / "model_pruned25.pt")
+    torch.save({"state_dict": model.state_dict()}, path)
+    fresh = MyModel2d(img_size=(64, 64), checkpoint_policy="none")
+    fresh.load_state_dict(torch.load(path, map_location="cpu")["state_dict"])
+    fresh.eval()
+    x = torch.rand(1, 65, 64, 64)
+    with torch.no_grad():
+        assert torch.equal(fresh(x), model(x))
+
+
+def test_taylor_scores_and_limits():
+    torch.manual_seed(0)
+    model = MyModel2d(img_size=(64, 64), checkpoint_policy="none")
+    groups = prunable_groups(model)
+    batches = [(torch.rand(1, 65, 64, 64), (torch.rand(1, 1, 64, 64) > 0.5).float())]
+    scores = taylor_scores(model, batches, torch.nn.BCEWithLogitsLoss(), groups)
+    for _, _, consumer in groups:
+        assert scores[consumer].shape == (model.get_submodule(consumer).weight.shape[1],)
+    assert all(p.grad is None for p in model.parameters())
+    kept = prune_channels(model, 0.9, scores, groups, min_channels=8)
+    assert min(kept.values()) >= 8
+    with pytest.raises(ValueError):
+        prune_channels(model, 1.0, scores, groups)
@@ -0,0 +1,44 @@
+import copy
+
+import pytest
+import torch
+from torch.ao.nn.quantized.dynamic import Linear as DynamicLinear
+
+from utils.myModel import MyModel2d
+from utils.quantization import quantize_model, save_quantized, state_dict_bytes
+
+
+def correlation(a, b):
+    return float(torch.corrcoef(torch.stack([a.flatten(), b.flatten()]))[0, 1])
+
+
+@pytest.fixture(scope="module")
+def float_model():
+    torch.manual_seed(0)
+    return MyModel2d(img_size=(64, 64), checkpoint_policy="none").eval()
+
+
+@pytest.mark.parametrize("decoder,min_corr", [(False, 0.99), (True, 0.9)])
+def test_quantized_model_tracks_float(float_model, decoder, min_corr):
+    # a random model has no trained activation ranges, so only a loose agreement is expected
+    calibration = [torch.rand(2, 65, 64, 64) for _ in range(2)]
+    before = copy.deepcopy(float_model.state_dict())
+    qmodel = quantize_model(float_model, calibration, decoder=decoder)
+    assert all(torch.equal(before[k], v) for k, v in float_model.state_dict().items())
+    assert any(isinstance(m, DynamicLinear) for m in qmodel.swinUNETR.swinViT.modules())
+    x = torch.rand(2, 65, 64, 64)
+    with torch.no_grad():
+        ref, out = float_model(x), qmodel(x)
+    assert out.shape == ref.shape
+    assert correlation(out, ref) > min_corr
+    assert state_dict_bytes(qmodel) < state_dict_bytes(float_model)
+
+
+def test_saved_quantized_model_matches(float_model, tmp_path):
+    qmodel = quantize_model(float_model, [torch.rand(2, 65, 64, 64)])
+    path = str(tmp_path / "model_int8.ts")
+    save_quantized(qmodel, torch.rand(2, 65, 64, 64), path)
+    loaded = torch.jit.load(path)
+    x = torch.rand(3, 65, 64, 64)
+    with torch.no_grad():
+        assert torch.allclose(loaded(x), qmodel(x), atol=1e-5)
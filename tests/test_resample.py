@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+import torch
+from scipy import ndimage
+
+from utils.resample import nearest_indices, resample_nearest
+from utils.utils import dice, resample_2d, resample_3d
+
+SHAPES = [
+    ((37, 53), (100, 71)),
+    ((100, 71), (37, 53)),
+    ((64, 64), (64, 64)),
+    ((7, 300), (1000, 33)),
+    ((1, 9), (5, 9)),
+    # the last zoom sample lands just past the source edge
+    ((8, 6), (26, 148)),
+    ((13, 17, 5), (40, 9, 11)),
+]
+
+
+def zoom(img, target_shape):
+    out = ndimage.zoom(img, [t / float(s) for s, t in zip(img.shape, target_shape)], order=0, prefilter=False)
+    assert out.shape == tuple(target_shape)
+    return out
+
+
+@pytest.mark.parametrize("src,dst", SHAPES)
+def test_matches_ndimage_zoom(src, dst):
+    img = np.random.default_rng(0).integers(1, 255, size=src).astype(np.uint8)
+    assert np.array_equal(resample_nearest(img, dst, edge="zoom"), zoom(img, dst))
+    resample = resample_2d if len(src) == 2 else resample_3d
+    assert np.array_equal(resample(img, dst), zoom(img, dst))
+
+
+@pytest.mark.parametrize("src,dst", SHAPES)
+def test_chunked_torch_and_clamp_agree(src, dst, tmp_path):
+    img = np.random.default_rng(1).random(src).astype(np.float32)
+    ref = resample_nearest(img, dst, edge="zoom")
+    out = np.lib.format.open_memmap(str(tmp_path / "out.npy"), mode="w+", dtype=np.float32, shape=dst)
+    assert np.array_equal(resample_nearest(img, dst, edge="zoom", out=out, chunk_rows=3), ref)
+    assert np.array_equal(resample_nearest(torch.from_numpy(img), dst, edge="zoom").numpy(), ref)
+    clamped = resample_nearest(img, dst)
+    # clamp only differs where zoom lands past the last sample and fills 0
+    valid = np.ones(dst, dtype=bool)
+    for axis, (s, t) in enumerate(zip(src, dst)):
+        v = nearest_indices(s, t, "zoom")[1]
+        if v is not None:
+            shape = [1] * len(dst)
+            shape[axis] = t
+            valid &= v.reshape(shape)
+    assert np.array_equal(clamped[valid], ref[valid])
+    assert (clamped > 0).all()
+
+
+def test_dice_of_masks_matches_float_dice():
+    rng = np.random.default_rng(2)
+    x, y = rng.random((30, 40)) < 0.3, rng.random((30, 40)) < 0.4
+    expected = 2 * np.sum(x & y) / (np.sum(x) + np.sum(y))
+    assert dice(x, y) == pytest.approx(expected)
+    assert dice(x.astype(np.float32), y.astype(np.float32)) == pytest.approx(expected)
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from utils.rle import SubmissionWriter, read_submission, rle_decode, rle_encode
+
+
+def reference_encode(mask):
+    flat = np.concatenate([[0], mask.ravel().astype(np.int8), [0]])
+    edges = np.flatnonzero(np.diff(flat)) + 1
+    return " ".join(map(str, np.stack([edges[0::2], edges[1::2] - edges[0::2]], axis=1).ravel().tolist()))
+
+
+def assert_round_trip(mask, rows):
+    rle = rle_encode(mask, rows=rows)
+    assert rle == reference_encode(mask)
+    assert np.array_equal(rle_decode(rle, mask.shape), mask.astype(np.uint8))
+
+
+@pytest.mark.parametrize("rows", [1, 3, 7, 1024])
+@pytest.mark.parametrize("density", [0.05, 0.5, 0.95])
+def test_random_masks_round_trip(rows, density):
+    rng = np.random.default_rng(int(density * 100) + rows)
+    assert_round_trip(rng.random((23, 17)) < density, rows)
+
+
+@pytest.mark.parametrize("rows", [1, 4, 1024])
+def test_uniform_masks(rows):
+    zeros = np.zeros((9, 5), dtype=bool)
+    assert rle_encode(zeros, rows=rows) == ""
+    assert_round_trip(zeros, rows)
+    ones = np.ones((9, 5), dtype=bool)
+    assert rle_encode(ones, rows=rows) == "1 45"
+    assert_round_trip(ones, rows)
+
+
+@pytest.mark.parametrize("rows", [1, 2, 3])
+def test_run_crossing_chunk_borders(rows):
+    mask = np.zeros((6, 4), dtype=bool)
+    mask[1, 2:] = True
+    mask[2:5] = True
+    assert rle_encode(mask, rows=rows) == "7 14"
+    assert_round_trip(mask, rows)
+
+
+@pytest.mark.parametrize("rows", [1, 2, 1024])
+def test_first_and_last_pixel(rows):
+    mask = np.zeros((5, 3), dtype=bool)
+    mask[0, 0] = mask[-1, -1] = True
+    assert rle_encode(mask, rows=rows) == "1 1 15 1"
+    assert_round_trip(mask, rows)
+
+
+def test_probabilities_are_thresholded():
+    prob = np.array([[0.2, 0.5, 0.7], [0.9, 0.1, 0.6]], dtype=np.float32)
+    assert rle_encode(prob, threshold=0.5) == "2 3 6 1"
+
+
+def test_submission_file_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    masks = {"a": rng.random((11, 13)) < 0.3, "b": np.zeros((4, 4), dtype=bool)}
+    filename = str(tmp_path / "submission.csv")
+    with SubmissionWriter(filename) as writer:
+        for fragment_id, mask in masks.items():
+            writer.add(fragment_id, mask, rows=2)
+    rles = read_submission(filename)
+    for fragment_id, mask in masks.items():
+        assert np.array_equal(rle_decode(rles[fragment_id], mask.shape), mask.astype(np.uint8))
@@ -0,0 +1,121 @@
+import asyncio
+import time
+
+import numpy as np
+
+from utils.serving import InferenceServer
+
+
+class _Metrics(object):
+    def record_request(self, seconds):
+        pass
+
+
+class _Worker(object):
+    metrics = _Metrics()
+
+
+def failing_inferer(fail_at_row):
+    def infer(volume, output, mask=None):
+        for row in range(volume.shape[1]):
+            if row == fail_at_row:
+                raise RuntimeError("inference failed")
+            output[row] = np.full((1, volume.shape[2]), row, dtype=np.uint8)
+
+    return lambda worker: infer
+
+
+def slow_inferer(predicted_rows):
+    def make(predictor):
+        def infer(volume, output, mask=None):
+            for row in range(volume.shape[1]):
+                predictor(None)
+                time.sleep(0.01)
+                predicted_rows.append(row)
+                output[row] = np.zeros((1, volume.shape[2]), dtype=np.uint8)
+
+        return infer
+
+    return make
+
+
+class _Predictor(_Worker):
+    def predict(self, windows):
+        return windows
+
+    __call__ = predict
+
+
+async def send_window(port, shape, dtype="uint16"):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    body = np.zeros(shape, dtype=dtype).tobytes()
+    writer.write(
+        "POST /window?c={}&h={}&w={}&dtype={} HTTP/1.1\r\nContent-Length: {}\r\n\r\n".format(
+            *shape, dtype, len(body)
+        ).encode()
+        + body
+    )
+    await writer.drain()
+    return reader, writer
+
+
+def request_window(fail_at_row, shape=(1, 4, 8), dtype="uint16"):
+    async def run():
+        server = InferenceServer(failing_inferer(fail_at_row), _Worker(), {})
+        tcp = await asyncio.start_server(server.handle, host="127.0.0.1", port=0)
+        reader, writer = await send_window(tcp.sockets[0].getsockname()[1], shape, dtype)
+        response = await reader.read()
+        writer.close()
+        tcp.close()
+        await tcp.wait_closed()
+        return response
+
+    return asyncio.run(run())
+
+
+def test_complete_stream_is_terminated():
+    response = request_window(fail_at_row=None)
+    assert response.startswith(b"HTTP/1.1 200 OK")
+    assert response.endswith(b"0\r\n\r\n")
+
+
+def test_error_before_first_row_is_an_error_response():
+    response = request_window(fail_at_row=0)
+    assert response.startswith(b"HTTP/1.1 500")
+    assert b"200 OK" not in response
+
+
+def test_error_after_headers_truncates_the_stream():
+    response = request_window(fail_at_row=2)
+    assert response.startswith(b"HTTP/1.1 200 OK")
+    assert response.count(b"HTTP/1.1") == 1
+    assert not response.endswith(b"0\r\n\r\n")
+
+
+def test_unknown_dtype_is_rejected():
+    response = request_window(fail_at_row=None, dtype="int64")
+    assert response.startswith(b"HTTP/1.1 400")
+    assert request_window(fail_at_row=None, dtype="float32").startswith(b"HTTP/1.1 200 OK")
+
+
+def test_disconnect_cancels_inference():
+    predicted_rows = []
+    rows = 200
+
+    async def run():
+        server = InferenceServer(slow_inferer(predicted_rows), _Predictor(), {})
+        handlers = []
+
+        def handle(reader, writer):
+            handlers.append(asyncio.ensure_future(server.handle(reader, writer)))
+
+        tcp = await asyncio.start_server(handle, host="127.0.0.1", port=0)
+        reader, writer = await send_window(tcp.sockets[0].getsockname()[1], (1, rows, 8))
+        await reader.readuntil(b"\r\n\r\n")
+        writer.transport.abort()
+        await asyncio.wait_for(handlers[0], timeout=5)
+        tcp.close()
+        await tcp.wait_closed()
+
+    asyncio.run(run())
+    assert len(predicted_rows) < rows // 2
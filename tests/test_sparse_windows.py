@@ -0,0 +1,36 @@
+import copy
+
+import torch
+
+from utils.myModel import MyModel2d, MyModel25d
+
+
+def fragment_inputs(roi, batch=2):
+    # nonzero papyrus everywhere, the mask drops the right columns
+    x = torch.rand(batch, 65, roi, roi) + 0.1
+    mask = torch.ones(batch, 1, roi, roi)
+    mask[..., 70:] = 0
+    return x, mask
+
+
+def assert_sparse_matches_masked_dense(model, roi):
+    x, mask = fragment_inputs(roi)
+    sparse = copy.deepcopy(model).set_sparse_windows(True)
+    with torch.no_grad():
+        ref = model(x * mask)
+        out = sparse(x, mask=mask)
+    inside = mask.expand_as(out) > 0
+    assert sparse.sparse_stats["skipped"] > 0
+    assert torch.allclose(out[inside], ref[inside], atol=1e-4), float((out - ref)[inside].abs().max())
+
+
+def test_sparse_2d_matches_dense_on_masked_input():
+    torch.manual_seed(0)
+    model = MyModel2d(img_size=(128, 128), checkpoint_policy="none").eval()
+    assert_sparse_matches_masked_dense(model, 128)
+
+
+def test_sparse_25d_matches_dense_on_masked_input():
+    torch.manual_seed(0)
+    model = MyModel25d(img_size=(128, 128), slice_band=(8, 40), checkpoint_policy="none").eval()
+    assert_sparse_matches_masked_dense(model, 128)
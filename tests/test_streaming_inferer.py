@@ -0,0 +1,143 @@
+import numpy as np
+import torch
+
+from utils.inference import CascadeInferer, StreamingInferer, TileInferer, get_importance_map, get_window_grid
+
+
+class ConstantLogit(torch.nn.Module):
+    def __init__(self, value):
+        super().__init__()
+        self.value = value
+
+    def forward(self, x):
+        return torch.full((x.shape[0], 1) + x.shape[2:], self.value)
+
+
+def pixelwise_model(channels):
+    # the logit of a pixel does not depend on the window it is predicted in
+    torch.manual_seed(0)
+    return torch.nn.Conv2d(channels, 1, 1).eval()
+
+
+def masked_fragment(channels=3, shape=(112, 100)):
+    rng = np.random.default_rng(0)
+    volume = rng.random((channels,) + shape).astype(np.float32)
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[10:50, 5:45] = 1
+    return volume, mask
+
+
+def streamed(model, volume, mask, overlap):
+    inferer = StreamingInferer(
+        model, roi_size=(32, 32), sw_batch_size=3, overlap=overlap, intensity=(0.0, 1.0, 0.0, 1.0), mask_threshold=0.05
+    )
+    output = np.zeros(volume.shape[1:], dtype=np.float32)
+    stats = inferer(volume, output, mask=mask)
+    return output, stats
+
+
+def tiled(model, volume, mask, overlap):
+    inferer = TileInferer(
+        model, roi_size=(32, 32), sw_batch_size=3, overlap=overlap, sw_device="cpu", mask_threshold=0.05
+    )
+    with torch.no_grad():
+        logits = inferer(torch.from_numpy(volume)[None], mask=torch.from_numpy(mask)[None, None])
+    return torch.sigmoid(logits)[0, 0].numpy()
+
+
+def test_streaming_matches_tile_inferer_on_masked_fragment():
+    volume, mask = masked_fragment()
+    for model in (ConstantLogit(2.0), pixelwise_model(volume.shape[0])):
+        for overlap in (0.0, 0.5):
+            output, stats = streamed(model, volume, mask, overlap)
+            assert stats["masked"] > 0
+            np.testing.assert_allclose(output, tiled(model, volume, mask, overlap), atol=1e-5)
+
+
+def test_window_partly_skipped_is_not_diluted():
+    volume, mask = masked_fragment()
+    output, _ = streamed(ConstantLogit(2.0), volume, mask, 0.5)
+    covered = output > 0
+    assert covered.any() and not covered.all()
+    np.testing.assert_allclose(output[covered], 1 / (1 + np.exp(-2.0)), rtol=1e-5)
+
+
+def conv_model(channels, dims=2):
+    # 3x3 zero padded convs, so a pixel's logit depends on where it sits in its window
+    torch.manual_seed(0)
+    conv = torch.nn.Conv2d if dims == 2 else torch.nn.Conv3d
+    return torch.nn.Sequential(conv(channels, 4, 3, padding=1), torch.nn.Tanh(), conv(4, 1, 3, padding=1)).eval()
+
+
+def brute_force(model, volume, roi, overlap, layout="2d"):
+    # every window predicted on its own and blended over the whole fragment at once
+    inferer = StreamingInferer(model, roi_size=roi, overlap=overlap, intensity=(0.0, 1.0, 0.0, 1.0), layout=layout)
+    acc = np.zeros(volume.shape[1:], dtype=np.float64)
+    weight = np.zeros(volume.shape[1:], dtype=np.float64)
+    base = get_importance_map(roi, "gaussian", 0.125, overlap)
+    for y, x in get_window_grid(volume.shape[1:], roi, overlap):
+        prob = inferer.predict([inferer.read_window(volume, y, x)])[0]
+        acc[y: y + roi[0], x: x + roi[1]] += (prob * base)[: volume.shape[1] - y, : volume.shape[2] - x]
+        weight[y: y + roi[0], x: x + roi[1]] += base[: volume.shape[1] - y, : volume.shape[2] - x]
+    return acc / weight
+
+
+def test_streaming_matches_brute_force_blend(tmp_path):
+    volume, _ = masked_fragment(shape=(90, 77))
+    path = str(tmp_path / "volume.npy")
+    np.save(path, volume)
+    volume = np.load(path, mmap_mode="r")
+    model = conv_model(volume.shape[0])
+    for overlap in (0.0, 0.5, (0.25, 0.5)):
+        expected = brute_force(model, volume, (32, 32), overlap)
+        inferer = StreamingInferer(
+            model, roi_size=(32, 32), sw_batch_size=3, overlap=overlap, intensity=(0.0, 1.0, 0.0, 1.0)
+        )
+        output = np.zeros(volume.shape[1:], dtype=np.float32)
+        stats = inferer(volume, output)
+        assert stats["windows"] == len(get_window_grid(volume.shape[1:], (32, 32), overlap))
+        np.testing.assert_allclose(output, expected, atol=1e-5)
+        quantized = np.zeros(volume.shape[1:], dtype=np.uint8)
+        inferer(volume, quantized)
+        assert np.abs(quantized.astype(np.int32) - np.rint(expected * 255)).max() <= 1
+
+
+def test_streaming_3d_layout_and_small_fragment():
+    # smaller than one window: reflect padded and cropped back
+    volume, _ = masked_fragment(channels=5, shape=(20, 27))
+    model = conv_model(1, dims=3)
+    inferer = StreamingInferer(
+        model, roi_size=(32, 32), overlap=0.5, layout="3d", depth=4, intensity=(0.0, 1.0, 0.0, 1.0)
+    )
+    output = np.zeros(volume.shape[1:], dtype=np.float32)
+    inferer(volume, output)
+    assert inferer.read_window(volume, 0, 0).shape == (1, 32, 32, 4)
+    np.testing.assert_allclose(output, brute_force(model, volume[:4], (32, 32), 0.5, layout="3d"), atol=1e-5)
+
+
+class InkChannel(torch.nn.Module):
+    # ink wherever the first channel is bright
+    def forward(self, x):
+        return 20 * (x[:, :1] - 0.5)
+
+
+def test_cascade_refines_only_windows_with_ink():
+    volume = np.zeros((2, 128, 160), dtype=np.float32)
+    volume[0, 70:90, 100:130] = 1
+    make = lambda: StreamingInferer(
+        InkChannel(), roi_size=(32, 32), sw_batch_size=4, overlap=0.5, intensity=(0.0, 1.0, 0.0, 1.0)
+    )
+    dense = np.zeros(volume.shape[1:], dtype=np.float32)
+    dense_stats = make()(volume, dense)
+    cascade = CascadeInferer(make(), make(), scale=4, threshold=0.5)
+    output = np.zeros(volume.shape[1:], dtype=np.float32)
+    stats = cascade(volume, output)
+    assert stats["filtered"] > 0 and stats["windows"] + stats["filtered"] == dense_stats["windows"]
+    assert stats["cascade_skip_fraction"] == stats["filtered"] / float(dense_stats["windows"])
+    np.testing.assert_allclose(output, dense, atol=1e-3)
+    assert output[75:85, 105:125].min() > 0.99
+
+    nothing = CascadeInferer(make(), make(), scale=4, threshold=1.1)
+    output = np.zeros(volume.shape[1:], dtype=np.float32)
+    assert nothing(volume, output)["windows"] == 0
+    assert output.max() == 0
@@ -0,0 +1,61 @@
+import copy
+
+import pytest
+import torch
+from monai.networks.nets.swin_unetr import WindowAttention
+
+from utils.myModel import MyModel2d
+from utils.swin_attention import SDPAWindowAttention, use_sdpa_attention
+
+
+def shifted_mask(nw=4, n=16):
+    # like SwinUNETR's compute_mask: only the border windows mask part of their tokens
+    mask = torch.zeros(nw, n, n)
+    mask[2:, : n // 2, n // 2:] = -100.0
+    mask[2:, n // 2:, : n // 2] = -100.0
+    return mask
+
+
+def outputs_and_grads(module, x, mask):
+    module.zero_grad()
+    x = x.clone().requires_grad_(True)
+    out = module(x, mask)
+    (out * torch.linspace(-1, 1, out.numel()).view_as(out)).sum().backward()
+    grads = {name: p.grad.clone() for name, p in module.named_parameters()}
+    return out.detach(), x.grad, grads
+
+
+@pytest.mark.parametrize("recompute", [True, False])
+@pytest.mark.parametrize("masked", [True, False])
+def test_sdpa_matches_stock_window_attention(recompute, masked):
+    torch.manual_seed(0)
+    stock = WindowAttention(dim=24, num_heads=3, window_size=(4, 4), qkv_bias=True)
+    torch.nn.init.normal_(stock.relative_position_bias_table, 0.0, 1.0)
+    sdpa = copy.deepcopy(stock)
+    assert use_sdpa_attention(sdpa, recompute=recompute) == 1
+    assert isinstance(sdpa, SDPAWindowAttention)
+    x = torch.randn(2 * 4, 16, 24)
+    mask = shifted_mask() if masked else None
+    ref_out, ref_dx, ref_grads = outputs_and_grads(stock, x, mask)
+    out, dx, grads = outputs_and_grads(sdpa, x, mask)
+    assert torch.allclose(out, ref_out, atol=1e-5)
+    assert torch.allclose(dx, ref_dx, atol=1e-5)
+    for name in ref_grads:
+        assert torch.allclose(grads[name], ref_grads[name], atol=1e-4), name
+
+
+def test_model_attention_switch():
+    torch.manual_seed(0)
+    model = MyModel2d(img_size=(64, 64), checkpoint_policy="none")
+    x = torch.rand(2, 65, 64, 64)
+    with torch.no_grad():
+        ref = model(x)
+        out = model.set_attention("sdpa")(x)
+    assert model.attention == "sdpa"
+    assert torch.allclose(out, ref, atol=1e-4)
+    state = model.state_dict()
+    model.set_attention("stock")
+    assert not any(isinstance(m, SDPAWindowAttention) for m in model.modules())
+    assert state.keys() == model.state_dict().keys()
+    with pytest.raises(ValueError):
+        model.set_attention("flash")
@@ -0,0 +1,40 @@
+import copy
+
+import pytest
+import torch
+
+from utils.myModel import MyModel2d, MyModel25d
+
+
+def randomise(model):
+    # non-trivial LayerNorm affines and position bias, so folding and bias gathering are actually exercised
+    for module in model.modules():
+        if isinstance(module, torch.nn.LayerNorm) and module.elementwise_affine:
+            torch.nn.init.normal_(module.weight, 1.0, 0.2)
+            torch.nn.init.normal_(module.bias, 0.0, 0.2)
+        if hasattr(module, "relative_position_bias_table"):
+            torch.nn.init.normal_(module.relative_position_bias_table, 0.0, 1.0)
+    return model.eval()
+
+
+def assert_frozen_matches_eager(model, x):
+    frozen = copy.deepcopy(model).freeze_for_inference()
+    with torch.no_grad():
+        ref = model(x)
+        out = frozen(x)
+    assert out.shape == ref.shape
+    assert torch.allclose(out, ref, atol=1e-4), float((out - ref).abs().max())
+
+
+@pytest.mark.parametrize("roi", [64, 96])
+def test_freeze_2d_matches_eager(roi):
+    # the 7x7 windows never divide the token grids of these ROIs, so every stage pads
+    torch.manual_seed(0)
+    model = randomise(MyModel2d(img_size=(roi, roi), checkpoint_policy="none"))
+    assert_frozen_matches_eager(model, torch.rand(2, 65, roi, roi))
+
+
+def test_freeze_25d_matches_eager():
+    torch.manual_seed(0)
+    model = randomise(MyModel25d(img_size=(64, 64), slice_band=(8, 40), checkpoint_policy="none"))
+    assert_frozen_matches_eager(model, torch.rand(2, 65, 64, 64))
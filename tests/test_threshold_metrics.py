@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+import torch
+
+from utils.rle import binarize
+from utils.threshold_metrics import ThresholdHistogram
+
+
+def direct(pred, label):
+    tp = np.sum(pred & label)
+    fp = np.sum(pred & ~label)
+    fn = np.sum(~pred & label)
+    dice = 2 * tp / max(2 * tp + fp + fn, 1)
+    iou = tp / max(tp + fp + fn, 1)
+    f05 = 1.25 * tp / max(1.25 * tp + 0.25 * fn + fp, 1)
+    return dice, iou, f05
+
+
+def random_map(seed=0, shape=(40, 50)):
+    rng = np.random.default_rng(seed)
+    label = rng.random(shape) < 0.3
+    prob = np.clip(label * 0.3 + rng.random(shape) * 0.7, 0, 1).astype(np.float32)
+    return prob, label
+
+
+@pytest.mark.parametrize("num_bins", [256, 10])
+def test_curves_match_direct_metrics(num_bins):
+    prob, label = random_map()
+    hist = ThresholdHistogram(num_bins).update(prob, label)
+    thresholds = hist.counts()[0]
+    for b in range(0, num_bins, max(num_bins // 16, 1)):
+        dice, iou, f05 = direct(prob >= thresholds[b], label)
+        assert hist.dice()[b] == pytest.approx(dice)
+        assert hist.iou()[b] == pytest.approx(iou)
+        assert hist.fbeta(0.5)[b] == pytest.approx(f05)
+
+
+@pytest.mark.parametrize("num_bins", [256, 10])
+def test_uint8_maps_are_probability_times_255(num_bins):
+    prob, label = random_map(1)
+    stored = np.rint(prob * 255).astype(np.uint8)
+    hist = ThresholdHistogram(num_bins).update(stored, label)
+    thresholds = hist.counts()[0]
+    for b in range(num_bins):
+        assert hist.dice()[b] == pytest.approx(direct(binarize(stored, thresholds[b]), label)[0])
+    best_t, best_f = hist.best("f0.5")
+    assert direct(binarize(stored, best_t), label)[2] == pytest.approx(best_f)
+
+
+def test_torch_chunked_and_merged_updates_agree():
+    prob, label = random_map(2)
+    mask = np.ones_like(label)
+    mask[:5] = 0
+    ref = ThresholdHistogram().update(prob, label, mask)
+    chunked = ThresholdHistogram().update_chunked(prob, label, mask, rows=7)
+    tensors = ThresholdHistogram().update(torch.from_numpy(prob), torch.from_numpy(label), torch.from_numpy(mask))
+    merged = ThresholdHistogram().update(prob[:20], label[:20], mask[:20])
+    merged += ThresholdHistogram().update(prob[20:], label[20:], mask[20:])
+    for hist in (chunked, tensors, merged):
+        assert np.array_equal(hist.pos, ref.pos) and np.array_equal(hist.neg, ref.neg)
+    assert ref.pos.sum() + ref.neg.sum() == mask.sum()
@@ -0,0 +1,101 @@
+import numpy as np
+import torch
+
+from utils.inference import TileInferer, get_importance_map, get_window_grid
+
+
+class ConstantLogit(torch.nn.Module):
+    def __init__(self, value):
+        super().__init__()
+        self.value = value
+
+    def forward(self, x):
+        return torch.full((x.shape[0], 1) + x.shape[2:], self.value)
+
+
+def make_inferer(overlap=0.5):
+    return TileInferer(
+        ConstantLogit(5.0), roi_size=(32, 32), sw_batch_size=4, overlap=overlap, sw_device="cpu", mask_threshold=0.01
+    )
+
+
+def test_all_masked_tile_is_background():
+    inputs = torch.rand(2, 3, 64, 64)
+    mask = torch.zeros(2, 1, 64, 64)
+    prob = torch.sigmoid(make_inferer()(inputs, mask=mask))
+    assert prob.shape == (2, 1, 64, 64)
+    assert float(prob.max()) < 1e-6
+
+
+def test_partly_masked_tile_keeps_covered_windows():
+    inputs = torch.rand(1, 3, 64, 64)
+    mask = torch.zeros(1, 1, 64, 64)
+    mask[..., :32] = 1
+    logits = make_inferer(overlap=0.0)(inputs, mask=mask)
+    assert torch.allclose(logits[..., :32], torch.tensor(5.0))
+    assert torch.allclose(logits[..., 32:], torch.tensor(-20.0))
+
+
+def test_unmasked_tile_matches_dense_blend():
+    inputs = torch.rand(1, 3, 64, 64)
+    logits = make_inferer()(inputs, mask=torch.ones(1, 1, 64, 64))
+    assert torch.allclose(logits, torch.tensor(5.0), atol=1e-5)
+
+
+def conv_model():
+    torch.manual_seed(0)
+    return torch.nn.Sequential(torch.nn.Conv2d(3, 4, 3, padding=1), torch.nn.Tanh(), torch.nn.Conv2d(4, 2, 3, padding=1))
+
+
+def test_constant_blend_matches_monai():
+    from monai.inferers import sliding_window_inference
+
+    model = conv_model().eval()
+    for shape, overlap in (((70, 90), 0.0), ((70, 90), 0.5), ((20, 45), 0.25)):
+        inputs = torch.rand((2, 3) + shape)
+        inferer = TileInferer(
+            model, roi_size=(32, 32), sw_batch_size=3, overlap=overlap, sw_device="cpu", blend_mode="constant"
+        )
+        with torch.no_grad():
+            ours = inferer(inputs)
+            ref = sliding_window_inference(inputs, (32, 32), 3, model, overlap=overlap, padding_mode="reflect")
+        assert torch.allclose(ours, ref, atol=1e-5), float((ours - ref).abs().max())
+
+
+def test_gaussian_blend_matches_brute_force():
+    model = conv_model().eval()
+    inputs = torch.rand(1, 3, 70, 90)
+    inferer = TileInferer(model, roi_size=(32, 32), overlap=0.5, sw_device="cpu")
+    acc = torch.zeros(1, 2, 70, 90)
+    weight = torch.zeros(1, 1, 70, 90)
+    base = torch.from_numpy(get_importance_map((32, 32), "gaussian", 0.125, 0.5).copy())
+    with torch.no_grad():
+        for y, x in get_window_grid((70, 90), (32, 32), 0.5):
+            acc[..., y: y + 32, x: x + 32] += model(inputs[..., y: y + 32, x: x + 32]) * base
+            weight[..., y: y + 32, x: x + 32] += base
+        out = inferer(inputs)
+        # the second tile of the same shape reuses the cached normalisation
+        again = inferer(inputs)
+    assert torch.allclose(out, acc / weight, atol=1e-5)
+    assert torch.equal(out, again)
+    assert list(inferer._norm_cache) == [(70, 90)]
+
+
+def test_window_grid_matches_monai():
+    from monai.data.utils import dense_patch_slices
+    from monai.inferers.utils import _get_scan_interval
+
+    for shape, overlap in (((70, 90), 0.5), ((64, 64), 0.0), ((100, 33), 0.25)):
+        interval = _get_scan_interval(shape, (32, 32), 2, (overlap, overlap))
+        ref = [tuple(s.start for s in slices) for slices in dense_patch_slices(shape, (32, 32), interval)]
+        assert sorted(get_window_grid(shape, (32, 32), overlap)) == sorted(ref)
+
+
+def test_importance_map_is_flat_without_overlap():
+    weight = get_importance_map((16, 16, 8), "gaussian", overlap=(0.5, 0.5, 0))
+    assert np.allclose(weight, weight[..., :1])
+    assert weight.max() == 1 and weight.min() >= 1e-3
+    assert get_importance_map((16, 16, 8), "gaussian", overlap=(0.5, 0.5, 0)) is weight
+    assert np.all(get_importance_map((16, 16), "constant", overlap=0.5) == 1)
+    cosine = get_importance_map((16, 16), "cosine", overlap=0.5)
+    assert np.allclose(cosine, cosine.T) and cosine[8, 8] > cosine[0, 8]
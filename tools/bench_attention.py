@@ -0,0 +1,78 @@
+import sys
+sys.path.append('..')
+sys.path.append('.')
+import argparse
+import copy
+import time
+
+import torch
+
+from bench_checkpoint_policy import run_step
+from utils.myModel import MyModel, MyModel2d
+
+# Stock MONAI window attention against SDPAWindowAttention (with and without recomputing the attention core) on one
+# training step without activation checkpointing: peak activation memory (CUDA max allocated, saved tensors on CPU),
+# step time, no-grad forward time, and the largest output / gradient difference against stock.
+#   python tools/bench_attention.py --model_mode 2dswin --roi 256 --batch_size 4
+parser = argparse.ArgumentParser(description="window attention benchmark")
+parser.add_argument("--model_mode", default="2dswin", type=str)
+parser.add_argument("--roi", default=256, type=int)
+parser.add_argument("--batch_size", default=4, type=int)
+parser.add_argument("--steps", default=3, type=int)
+parser.add_argument("--atol", default=1e-4, type=float, help="max output difference, gradients are compared relative")
+
+VARIANTS = (("stock", "stock", False), ("sdpa_keep", "sdpa", False), ("sdpa", "sdpa", True))
+
+
+def main():
+    args = parser.parse_args()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    torch.manual_seed(0)
+    if args.model_mode == "2dswin":
+        model = MyModel2d(img_size=(args.roi, args.roi), checkpoint_policy="none")
+        x = torch.rand(args.batch_size, 65, args.roi, args.roi)
+    elif args.model_mode == "3dswin":
+        # MyModel only takes 64^3 inputs, the SwinUNETR is benchmarked on its own below
+        model = MyModel(img_size=(args.roi, args.roi, args.roi), checkpoint_policy="none")
+        x = torch.rand(args.batch_size, 1, args.roi, args.roi, args.roi)
+    else:
+        raise ValueError("model_mode should be ['3dswin', '2dswin']")
+    for module in model.modules():
+        # zero initialised tables would hide a wrong bias gather
+        if hasattr(module, "relative_position_bias_table"):
+            torch.nn.init.normal_(module.relative_position_bias_table, 0.0, 1.0)
+    model.to(device).train()
+    x = x.to(device)
+
+    print("{:<12} {:>10} {:>12} {:>12} {:>12} {:>12}".format(
+        "attention", "step (s)", "peak (MB)", "fwd (s)", "out diff", "grad diff"))
+    ref = None
+    for name, mode, recompute in VARIANTS:
+        variant = copy.deepcopy(model).set_attention(mode, recompute=recompute)
+        net = variant.swinUNETR
+        run_step(net, x, device)
+        times, peaks = [], []
+        for _ in range(args.steps):
+            variant.zero_grad(set_to_none=True)
+            t, peak = run_step(net, x, device)
+            times.append(t)
+            peaks.append(peak)
+        grads = torch.cat([p.grad.flatten() for p in net.parameters() if p.grad is not None])
+        with torch.no_grad():
+            start = time.time()
+            out = net(x)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            fwd = time.time() - start
+        if ref is None:
+            ref = (out, grads)
+        out_diff = (out - ref[0]).abs().max().item()
+        grad_diff = ((grads - ref[1]).abs().max() / ref[1].abs().max()).item()
+        print("{:<12} {:>10.3f} {:>12.1f} {:>12.3f} {:>12.2e} {:>12.2e}".format(
+            name, sum(times) / len(times), max(peaks) / 2**20, fwd, out_diff, grad_diff))
+        if out_diff > args.atol or grad_diff > args.atol:
+            raise SystemExit("{} attention differs from stock by more than --atol {}".format(name, args.atol))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import sys
+sys.path.append('..')
+sys.path.append('.')
+import argparse
+import time
+
+import torch
+
+from utils.checkpoint_policy import estimate_activation_bytes
+from utils.myModel import MyModel, MyModel2d
+
+# Step time and peak activation memory of MyModel2d / MyModel for every checkpoint policy.
+# On CUDA the peak is torch.cuda.max_memory_allocated, on CPU it is the size of the tensors autograd keeps
+# for backward (counted once per storage through saved tensor hooks).
+parser = argparse.ArgumentParser(description="activation checkpointing benchmark")
+parser.add_argument("--model_mode", default="2dswin", type=str)
+parser.add_argument("--roi", default=256, type=int)
+parser.add_argument("--batch_size", default=4, type=int)
+parser.add_argument("--steps", default=3, type=int)
+parser.add_argument("--budget_mb", default=None, type=float, help="also benchmark the auto policy for this budget")
+parser.add_argument(
+    "--policies", default="none,swin,all,layers1;layers2,decoder1;decoder2;encoder1", type=str,
+    help="comma separated policies, use ';' to join stages of one policy"
+)
+
+
+class SavedTensorMeter(object):
+    def __init__(self):
+        self.storages = {}
+
+    def pack(self, t):
+        try:
+            key = t.untyped_storage().data_ptr()
+            nbytes = t.untyped_storage().nbytes()
+        except AttributeError:
+            key = t.storage().data_ptr()
+            nbytes = t.storage().size() * t.element_size()
+        self.storages[key] = nbytes
+        return t
+
+    @staticmethod
+    def unpack(t):
+        return t
+
+    @property
+    def total(self):
+        return sum(self.storages.values())
+
+
+def run_step(model, x, device):
+    meter = SavedTensorMeter()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.time()
+    with torch.autograd.graph.saved_tensors_hooks(meter.pack, meter.unpack):
+        out = model(x)
+    out.float().mean().backward()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated()
+    else:
+        peak = meter.total
+    return time.time() - start, peak
+
+
+def main():
+    args = parser.parse_args()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if args.model_mode == "2dswin":
+        img_size = (args.roi, args.roi)
+        model = MyModel2d(img_size=img_size)
+        x = torch.rand(args.batch_size, 65, *img_size)
+    elif args.model_mode == "3dswin":
+        img_size = (64, 64, 64)
+        model = MyModel(img_size=img_size)
+        x = torch.rand(args.batch_size, 1, *img_size)
+    else:
+        raise ValueError("model_mode should be ['3dswin', '2dswin']")
+    model.to(device).train()
+    x = x.to(device)
+
+    policies = [p.replace(";", ",") for p in args.policies.split(",")]
+    if args.budget_mb is not None:
+        policies.append("auto")
+    estimate = estimate_activation_bytes(img_size, model.feature_size, batch_size=args.batch_size)
+    print("{:<40} {:>10} {:>12} {:>12}".format("policy", "step (s)", "peak (MB)", "est. (MB)"))
+    for policy in policies:
+        stages = model.set_checkpoint_policy(policy, budget_mb=args.budget_mb, batch_size=args.batch_size)
+        est = sum(ckpt if name in stages else full for name, (full, ckpt) in estimate.items())
+        run_step(model, x, device)
+        times, peaks = [], []
+        for _ in range(args.steps):
+            model.zero_grad(set_to_none=True)
+            t, peak = run_step(model, x, device)
+            times.append(t)
+            peaks.append(peak)
+        name = policy if policy != "auto" else "auto -> " + (",".join(stages) or "none")
+        print("{:<40} {:>10.3f} {:>12.1f} {:>12.1f}".format(
+            name[:40], sum(times) / len(times), max(peaks) / 2**20, est / 2**20))
+
+
+if __name__ == "__main__":
+    main()
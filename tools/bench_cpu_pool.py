@@ -0,0 +1,58 @@
+import sys
+sys.path.append('..')
+sys.path.append('.')
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from utils.cpu_pool import CPUInferencePool
+from utils.inference import StreamingInferer
+from utils.myModel import MyModel2d
+
+# CPU scaling of streaming inference: one process with all cores against CPUInferencePool with 1, 2, 4, ... workers
+# on a random MyModel2d and a random fragment. Every run must give the same map as the single process.
+#   python tools/bench_cpu_pool.py --shape 65,1024,1024 --roi 256 --workers 1,2,4,8
+parser = argparse.ArgumentParser(description="CPU process pool benchmark")
+parser.add_argument("--shape", default="65,1024,1024", type=str, help="fragment shape, comma separated")
+parser.add_argument("--roi", default=256, type=int)
+parser.add_argument("--overlap", default=0.5, type=float)
+parser.add_argument("--workers", default="1,2,4", type=str, help="worker counts to try, comma separated")
+
+
+def main():
+    args = parser.parse_args()
+    shape = tuple(int(s) for s in args.shape.split(","))
+    model = MyModel2d(img_size=(args.roi, args.roi), checkpoint_policy="none").eval()
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, "volume.npy")
+    np.save(path, np.random.RandomState(0).randint(0, 65535, size=shape).astype(np.uint16))
+    volume = np.load(path, mmap_mode="r")
+    inferer = StreamingInferer(model, (args.roi, args.roi), overlap=args.overlap)
+
+    reference = np.zeros(shape[1:], dtype=np.uint8)
+    stats = inferer(volume, reference)
+    print("1 process, {} threads: {:.2f} windows/s".format(torch.get_num_threads(), stats["windows_per_s"]))
+    for workers in (int(w) for w in args.workers.split(",")):
+        pool = CPUInferencePool(inferer, workers=workers)
+        output = np.zeros(shape[1:], dtype=np.uint8)
+        start = time.time()
+        stats = pool(volume, output)
+        pool.close()
+        print(
+            "{} workers x {} threads: {:.2f} windows/s in {:.2f}s, per worker {}, same map: {}".format(
+                workers,
+                pool.threads_per_worker,
+                stats["windows_per_s"],
+                time.time() - start,
+                ", ".join("{:.2f}".format(v) for v in stats["worker_windows_per_s"]),
+                np.array_equal(output, reference),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import sys
+sys.path.append('..')
+sys.path.append('.')
+import argparse
+import copy
+import time
+
+import torch
+
+from utils.myModel import MyModel, MyModel2d
+
+# Eager against freeze_for_inference() on random windows: max abs difference of the SwinUNETR outputs (must stay
+# below --atol) and forward time. LayerNorm affines are randomised so the folding is actually exercised.
+#   python tools/bench_freeze.py --model_mode 2dswin --roi 256 --batch_size 4
+parser = argparse.ArgumentParser(description="frozen inference benchmark")
+parser.add_argument("--model_mode", default="2dswin", type=str)
+parser.add_argument("--roi", default=256, type=int)
+parser.add_argument("--batch_size", default=4, type=int)
+parser.add_argument("--repeat", default=5, type=int)
+parser.add_argument("--atol", default=1e-4, type=float)
+
+
+def timed(fn, x, repeat):
+    with torch.no_grad():
+        out = fn(x)
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.time()
+            fn(x)
+            best = min(best, time.time() - start)
+    return out, best
+
+
+def main():
+    args = parser.parse_args()
+    torch.manual_seed(0)
+    if args.model_mode == "3dswin":
+        model = MyModel(img_size=(args.roi, args.roi, args.roi), checkpoint_policy="none")
+        x = torch.rand(args.batch_size, 1, args.roi, args.roi, args.roi)
+    else:
+        model = MyModel2d(img_size=(args.roi, args.roi), checkpoint_policy="none")
+        x = torch.rand(args.batch_size, 65, args.roi, args.roi)
+    for module in model.modules():
+        if isinstance(module, torch.nn.LayerNorm) and module.elementwise_affine:
+            torch.nn.init.normal_(module.weight, 1.0, 0.2)
+            torch.nn.init.normal_(module.bias, 0.0, 0.2)
+    model.eval()
+    frozen = copy.deepcopy(model)
+    start = time.time()
+    frozen.freeze_for_inference()
+    print("froze in {:.2f}s".format(time.time() - start))
+
+    ref, eager_time = timed(model.swinUNETR, x, args.repeat)
+    out, frozen_time = timed(frozen.swinUNETR, x, args.repeat)
+    diff = (out - ref).abs().max().item()
+    print(
+        "{} roi {} batch {}: eager {:.1f}ms, frozen {:.1f}ms ({:.2f}x), max abs diff {:.2e}".format(
+            args.model_mode, args.roi, args.batch_size, 1000 * eager_time, 1000 * frozen_time,
+            eager_time / frozen_time, diff,
+        )
+    )
+    if diff > args.atol:
+        raise SystemExit("frozen model differs from eager by more than --atol {}".format(args.atol))
+
+
+if __name__ == "__main__":
+    main()
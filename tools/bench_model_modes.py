@@ -0,0 +1,74 @@
+import sys
+sys.path.append('..')
+sys.path.append('.')
+import argparse
+import time
+
+import torch
+from torch.utils.flop_counter import FlopCounterMode
+
+from utils.myModel import MyModel, MyModel2d, MyModel25d, MyModel2dunet, parse_slice_band
+
+# FLOPs, parameters and forward throughput of the 2dswin, 25dswin, 2dunet and 3dswin models on random windows, per window
+# and per output pixel. MyModel only takes 64x64x64 windows, so 3dswin is always measured at 64x64.
+#   python tools/bench_model_modes.py --roi 256 --batch_size 4 --slice_band 8,56
+parser = argparse.ArgumentParser(description="model variant cost benchmark")
+parser.add_argument("--roi", default=256, type=int)
+parser.add_argument("--batch_size", default=4, type=int)
+parser.add_argument("--repeat", default=3, type=int)
+parser.add_argument("--slice_band", default=None, type=str, help="start,stop of the slices the 25dswin stem sees")
+parser.add_argument("--modes", default="2dswin,25dswin,3dswin", type=str)
+
+
+def build(mode, roi, slice_band):
+    if mode == "2dswin":
+        return MyModel2d(img_size=(roi, roi), checkpoint_policy="none"), (65, roi, roi)
+    if mode == "25dswin":
+        return MyModel25d(img_size=(roi, roi), slice_band=slice_band, checkpoint_policy="none"), (65, roi, roi)
+    if mode == "2dunet":
+        return MyModel2dunet(), (65, roi, roi)
+    if mode == "3dswin":
+        return MyModel(img_size=(64, 64, 64), checkpoint_policy="none"), (1, 64, 64, 64)
+    raise ValueError("model_mode should be ['3dswin', '2dswin', '25dswin', '2dunet']")
+
+
+def main():
+    args = parser.parse_args()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    slice_band = parse_slice_band(args.slice_band)
+    print("{:<8} {:>8} {:>10} {:>12} {:>12} {:>12} {:>14}".format(
+        "mode", "window", "params (M)", "GFLOP/win", "kFLOP/pixel", "ms/window", "Mpixel/s"))
+    for mode in args.modes.split(","):
+        model, shape = build(mode, args.roi, slice_band)
+        model.to(device).eval()
+        x = torch.rand((args.batch_size,) + shape, device=device)
+        pixels = shape[1] * shape[2]
+        with torch.no_grad():
+            counter = FlopCounterMode(display=False)
+            with counter:
+                model(x[:1])
+            flops = counter.get_total_flops()
+            model(x)
+            best = float("inf")
+            for _ in range(args.repeat):
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                start = time.time()
+                model(x)
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                best = min(best, time.time() - start)
+        per_window = best / args.batch_size
+        print("{:<8} {:>8} {:>10.2f} {:>12.2f} {:>12.1f} {:>12.1f} {:>14.2f}".format(
+            mode,
+            "{}x{}".format(shape[1], shape[2]),
+            sum(p.numel() for p in model.parameters()) / 1e6,
+            flops / 1e9,
+            flops / pixels / 1e3,
+            1000 * per_window,
+            pixels / per_window / 1e6,
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import sys
+sys.path.append('..')
+sys.path.append('.')
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import scipy.ndimage as ndimage
+import torch
+
+from utils.resample import nearest_indices, resample_nearest
+
+# Nearest-neighbour resampling: utils.resample.resample_nearest against ndimage.zoom(order=0, prefilter=False).
+# Outputs must be identical with edge="zoom"; edge="clamp" only differs where zoom samples past the last pixel.
+parser = argparse.ArgumentParser(description="nearest resampling benchmark")
+parser.add_argument("--src", default="2045,1582", type=str, help="source shape, comma separated")
+parser.add_argument("--dst", default="8181,6330", type=str, help="target shape, comma separated")
+parser.add_argument("--repeat", default=3, type=int)
+parser.add_argument("--chunk_rows", default=1024, type=int)
+
+
+def timed(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.time()
+        out = fn()
+        best = min(best, time.time() - start)
+    return out, best
+
+
+def main():
+    args = parser.parse_args()
+    src = tuple(int(s) for s in args.src.split(","))
+    dst = tuple(int(s) for s in args.dst.split(","))
+    rng = np.random.RandomState(0)
+    img = (rng.rand(*src) * 255).astype(np.uint8)
+    ratio = tuple(float(t) / float(s) for s, t in zip(src, dst))
+
+    ref, t_zoom = timed(lambda: ndimage.zoom(img, ratio, order=0, prefilter=False), args.repeat)
+    print("ndimage.zoom               {:.4f}s  shape {}".format(t_zoom, ref.shape))
+    nearest_indices.cache_clear()
+    out, t_first = timed(lambda: resample_nearest(img, dst, edge="zoom"), 1)
+    out, t_gather = timed(lambda: resample_nearest(img, dst, edge="zoom"), args.repeat)
+    print("gather (first call)        {:.4f}s  identical {}".format(t_first, np.array_equal(out, ref)))
+    print("gather (cached indices)    {:.4f}s  identical {}  x{:.1f}".format(
+        t_gather, np.array_equal(out, ref), t_zoom / max(t_gather, 1e-9)))
+    clamp = resample_nearest(img, dst, edge="clamp")
+    print("clamp edge differs from zoom in {} samples (zoom samples past the last pixel there)".format(
+        int(np.count_nonzero(clamp != ref))))
+
+    timg = torch.from_numpy(img)
+    tout, t_torch = timed(lambda: resample_nearest(timg, dst, edge="zoom"), args.repeat)
+    print("torch index_select         {:.4f}s  identical {}".format(t_torch, np.array_equal(tout.numpy(), ref)))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        np.save(os.path.join(tmp, "src.npy"), img)
+        src_map = np.load(os.path.join(tmp, "src.npy"), mmap_mode="r")
+        dst_map = np.lib.format.open_memmap(os.path.join(tmp, "dst.npy"), mode="w+", dtype=np.uint8, shape=dst)
+        _, t_chunk = timed(
+            lambda: resample_nearest(src_map, dst, edge="zoom", out=dst_map, chunk_rows=args.chunk_rows), 1
+        )
+        print("chunked memmap             {:.4f}s  identical {}".format(t_chunk, np.array_equal(dst_map, ref)))
+        del dst_map
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import sys
+sys.path.append('..')
+sys.path.append('.')
+import argparse
+import http.client
+import json
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Fires concurrent region requests at a running serve.py and prints client latencies and the server /metrics.
+#   python tools/bench_serve.py --fragment a --size 512 --requests 32 --concurrency 8
+parser = argparse.ArgumentParser(description="load test of the inference server")
+parser.add_argument("--host", default="127.0.0.1", type=str)
+parser.add_argument("--port", default=8008, type=int)
+parser.add_argument("--socket", default=None, type=str, help="UNIX socket of the server")
+parser.add_argument("--fragment", required=True, type=str, help="fragment id served by the server")
+parser.add_argument("--size", default=512, type=int, help="height and width of each requested region")
+parser.add_argument("--extent", default=4096, type=int, help="regions start inside the top-left extent x extent pixels")
+parser.add_argument("--requests", default=32, type=int)
+parser.add_argument("--concurrency", default=8, type=int)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super().__init__("localhost")
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def request(args, method, url, body=None):
+    conn = UnixHTTPConnection(args.socket) if args.socket else http.client.HTTPConnection(args.host, args.port)
+    conn.request(method, url, body=body)
+    response = conn.getresponse()
+    data = response.read()
+    conn.close()
+    if response.status != 200:
+        raise RuntimeError("{} {}: {}".format(response.status, url, data.decode()))
+    return response, data
+
+
+def region(args, i):
+    rng = np.random.RandomState(i)
+    y, x = rng.randint(0, max(args.extent - args.size, 0) + 1, size=2)
+    spec = {"fragment": args.fragment, "y": int(y), "x": int(x), "h": args.size, "w": args.size}
+    start = time.time()
+    response, data = request(args, "POST", "/region", json.dumps(spec))
+    h, w = (int(s) for s in response.getheader("X-Shape").split(","))
+    assert len(data) == h * w
+    return time.time() - start
+
+
+def main():
+    args = parser.parse_args()
+    start = time.time()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        latencies = list(pool.map(lambda i: region(args, i), range(args.requests)))
+    elapsed = time.time() - start
+    print(
+        "{} requests in {:.2f}s, latency p50 {:.1f}ms p95 {:.1f}ms".format(
+            args.requests, elapsed, 1000 * np.percentile(latencies, 50), 1000 * np.percentile(latencies, 95)
+        )
+    )
+    _, metrics = request(args, "GET", "/metrics")
+    print(json.dumps(json.loads(metrics), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import sys
+sys.path.append('..')
+sys.path.append('.')
+import copy
+import os
+
+import numpy as np
+import torch
+from monai.data import load_decathlon_datalist
+
+from main import parser
+from utils.inference import StreamingInferer
+from utils.myModel import MyModel, MyModel2d
+from utils.threshold_metrics import ThresholdHistogram
+
+# Sparse Swin windows on real fragments: streams every fragment of --split through the dense model and through
+# set_sparse_windows() (fragment mask and --sparse_floor), and reports the skipped Swin window ratio, windows/s of
+# both, the largest probability difference (inside the fragment mask when there is one) and the Dice of both. The
+# sparse model zeroes the input outside the mask, so with a mask the Dice change includes that border effect.
+# Takes main.py's arguments plus the ones below.
+#   python tools/bench_sparse_windows.py --model_mode 2dswin --roi_x 256 --roi_y 256 --data_dir <data> \
+#       --json_list <json> --pretrained_dir ./pretrained_models --pretrained_model_name model.pt
+parser.add_argument("--split", default="validation", type=str, help="datalist split to stream")
+parser.add_argument("--sparse_floor", default=0.0, type=float, help="pixels at or below this (scaled) intensity are empty")
+
+
+def first(path):
+    return path[0] if isinstance(path, list) else path
+
+
+def main():
+    args = parser.parse_args()
+    if args.model_mode == "3dswin":
+        model = MyModel(img_size=(args.roi_x, args.roi_y, args.roi_y), checkpoint_policy="none")
+        layout, depth, activation = "3d", 64, None
+    elif args.model_mode == "2dswin":
+        model = MyModel2d(img_size=(args.roi_x, args.roi_y), checkpoint_policy="none")
+        layout, depth, activation = "2d", None, "sigmoid"
+    else:
+        raise ValueError("model_mode should be ['3dswin', '2dswin']")
+    model_path = os.path.join(args.pretrained_dir, args.pretrained_model_name)
+    model.load_state_dict(torch.load(model_path, map_location="cpu")["state_dict"])
+    model.eval()
+    sparse = copy.deepcopy(model).set_sparse_windows(True, intensity_floor=args.sparse_floor)
+
+    def run(predictor, volume, mask):
+        inferer = StreamingInferer(
+            predictor,
+            roi_size=(args.roi_x, args.roi_y),
+            sw_batch_size=args.sw_batch_size,
+            overlap=args.infer_overlap,
+            layout=layout,
+            depth=depth,
+            intensity=(args.a_min, args.a_max, args.b_min, args.b_max),
+            activation=activation,
+            mask_threshold=args.mask_threshold,
+            blend_mode=args.blend_mode,
+        )
+        output = np.zeros(volume.shape[1:], dtype=np.float32)
+        return output, inferer(volume, output, mask=mask)
+
+    files = load_decathlon_datalist(os.path.join(args.data_dir, args.json_list), True, args.split, base_dir=args.data_dir)
+    dense_time = sparse_time = 0.0
+    for item in files:
+        volume = np.load(first(item["image"]), mmap_mode="r")
+        mask = np.load(first(item["label"]), mmap_mode="r") if "label" in item else None
+        sparse.sparse_stats.update(windows=0, skipped=0)
+        dense_out, dense_stats = run(model, volume, mask)
+        sparse_out, sparse_stats = run(sparse, volume, mask)
+        dense_time += dense_stats["time"]
+        sparse_time += sparse_stats["time"]
+        inside = np.asarray(mask) > 0 if mask is not None else np.ones(dense_out.shape, dtype=bool)
+        line = "{}: {:.2f} -> {:.2f} windows/s ({:.2f}x), {}, max prob diff {:.2e} ({})".format(
+            os.path.basename(first(item["image"])),
+            dense_stats["windows_per_s"],
+            sparse_stats["windows_per_s"],
+            dense_stats["time"] / max(sparse_stats["time"], 1e-8),
+            sparse.sparse_report(),
+            float(np.abs(sparse_out - dense_out)[inside].max(initial=0.0)),
+            "inside mask" if mask is not None else "no mask",
+        )
+        if "inklabels" in item:
+            labels = np.load(first(item["inklabels"]), mmap_mode="r")
+            dense_hist = ThresholdHistogram().update_chunked(dense_out, labels)
+            sparse_hist = ThresholdHistogram().update_chunked(sparse_out, labels)
+            b = dense_hist.at(0.5)
+            dense_dice, sparse_dice = float(dense_hist.dice()[b]), float(sparse_hist.dice()[b])
+            line += ", dice {:.4f} -> {:.4f} ({:+.4f}{})".format(
+                dense_dice, sparse_dice, sparse_dice - dense_dice, ", masked input" if mask is not None else ""
+            )
+        print(line)
+    print("Overall {:.2f}s dense, {:.2f}s sparse ({:.2f}x)".format(dense_time, sparse_time, dense_time / max(sparse_time, 1e-8)))
+
+
+if __name__ == "__main__":
+    main()
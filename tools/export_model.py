@@ -0,0 +1,82 @@
+import sys
+sys.path.append('..')
+sys.path.append('.')
+import argparse
+import os
+import time
+
+import torch
+
+from utils.backends import OnnxRuntimePredictor, export_onnx, export_paths, export_torchscript, window_shape
+from utils.myModel import MyModel, MyModel2d
+
+# Traces a checkpoint at a fixed ROI to TorchScript (<name>.ts) and ONNX (<name>.onnx) next to it, then checks both
+# against eager PyTorch on random windows and times them. test.py picks the exports up with --backend.
+#   python tools/export_model.py --model_mode 2dswin --roi_x 256 --roi_y 256 --pretrained_dir ./pretrained_models \
+#       --pretrained_model_name model.pt
+parser = argparse.ArgumentParser(description="export a checkpoint to TorchScript and ONNX")
+parser.add_argument("--pretrained_dir", default="./pretrained_models/", type=str, help="pretrained checkpoint directory")
+parser.add_argument("--pretrained_model_name", default="model.pt", type=str, help="pretrained model name")
+parser.add_argument("--model_mode", default="3dswin", help="model_mode ['3dswin', '2dswin']")
+parser.add_argument("--roi_x", default=256, type=int, help="roi size in x direction")
+parser.add_argument("--roi_y", default=256, type=int, help="roi size in y direction")
+parser.add_argument("--formats", default="torchscript,onnx", type=str, help="comma separated export formats")
+parser.add_argument("--opset", default=18, type=int, help="ONNX opset")
+parser.add_argument("--batch_size", default=4, type=int, help="windows per parity check batch")
+parser.add_argument("--checks", default=3, type=int, help="random batches compared against eager")
+parser.add_argument("--atol", default=1e-3, type=float, help="max abs logit difference accepted")
+
+
+def timed(fn, x, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.time()
+        out = fn(x)
+        best = min(best, time.time() - start)
+    return out, best
+
+
+def main():
+    args = parser.parse_args()
+    if args.model_mode == "3dswin":
+        model = MyModel(img_size=(args.roi_x, args.roi_y, args.roi_y), checkpoint_policy="none")
+    elif args.model_mode == "2dswin":
+        model = MyModel2d(img_size=(args.roi_x, args.roi_y), checkpoint_policy="none")
+    else:
+        raise ValueError("model_mode should be ['3dswin', '2dswin']")
+    model_path = os.path.join(args.pretrained_dir, args.pretrained_model_name)
+    model.load_state_dict(torch.load(model_path, map_location="cpu")["state_dict"])
+    model.eval()
+    ts_path, onnx_path = export_paths(model_path)
+    formats = args.formats.split(",")
+    example = torch.rand(window_shape(args.model_mode, args.roi_x, args.roi_y, 2))
+
+    backends = {}
+    if "torchscript" in formats:
+        backends["torchscript"] = export_torchscript(model, example, ts_path)
+        print("TorchScript saved to {}".format(ts_path))
+    if "onnx" in formats:
+        export_onnx(model, example, onnx_path, opset=args.opset)
+        print("ONNX saved to {}".format(onnx_path))
+        backends["onnxruntime"] = OnnxRuntimePredictor(onnx_path)
+
+    failed = False
+    for i in range(args.checks):
+        x = torch.rand(window_shape(args.model_mode, args.roi_x, args.roi_y, args.batch_size))
+        with torch.no_grad():
+            ref, eager_time = timed(model, x)
+            for name, predictor in backends.items():
+                out, backend_time = timed(predictor, x)
+                diff = (out.float() - ref).abs().max().item()
+                failed |= diff > args.atol
+                print(
+                    "batch {} {}: max abs diff {:.2e}, {:.1f}ms vs eager {:.1f}ms".format(
+                        i, name, diff, 1000 * backend_time, 1000 * eager_time
+                    )
+                )
+    if failed:
+        raise SystemExit("export differs from eager by more than --atol {}".format(args.atol))
+
+
+if __name__ == "__main__":
+    main()
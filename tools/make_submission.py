@@ -0,0 +1,50 @@
+import sys
+sys.path.append('..')
+sys.path.append('.')
+import argparse
+import os
+import time
+
+import numpy as np
+
+from utils.prob_store import ProbStore
+from utils.rle import SubmissionWriter, binarize, read_submission, rle_decode
+
+# Run-length encoded submission CSV from stored probability maps (.npy memmaps or --out_format=tiles stores).
+#   python tools/make_submission.py a=outputs/test/a_prob b=outputs/test/b_prob.npy --threshold=0.45 --out=submission.csv
+parser = argparse.ArgumentParser(description="write a Vesuvius RLE submission")
+parser.add_argument("maps", nargs="+", help="fragment_id=path of a probability map")
+parser.add_argument("--threshold", default=0.5, type=float, help="ink probability threshold")
+parser.add_argument("--out", default="submission.csv", type=str)
+parser.add_argument("--rows", default=1024, type=int, help="rows encoded at a time")
+parser.add_argument("--check", action="store_true", help="decode the CSV again and compare with the thresholded maps")
+
+
+def open_map(path):
+    if os.path.isdir(path):
+        return ProbStore(path)
+    return np.load(path, mmap_mode="r")
+
+
+def main():
+    args = parser.parse_args()
+    maps = [m.split("=", 1) for m in args.maps]
+    with SubmissionWriter(args.out) as writer:
+        for fragment_id, path in maps:
+            start = time.time()
+            writer.add(fragment_id, open_map(path), threshold=args.threshold, rows=args.rows)
+            print("{}: encoded in {:.2f}s".format(fragment_id, time.time() - start))
+    if args.check:
+        rles = read_submission(args.out)
+        for fragment_id, path in maps:
+            prob = open_map(path)
+            mask = rle_decode(rles[fragment_id], prob.shape)
+            same = all(
+                np.array_equal(mask[r: r + args.rows] > 0, binarize(prob[r: r + args.rows], args.threshold))
+                for r in range(0, prob.shape[0], args.rows)
+            )
+            print("{}: round trip {}".format(fragment_id, "ok" if same else "MISMATCH"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import sys
+sys.path.append('..')
+sys.path.append('.')
+import copy
+import json
+import os
+import time
+
+import torch
+from torch.utils.flop_counter import FlopCounterMode
+
+from main import build_loss, build_optimizer, parser
+from monai.metrics import MeanIoU
+from monai.transforms import AsDiscrete
+from monai.utils.enums import MetricReduction
+from trainer import run_training
+from utils.checkpoint_io import atomic_save
+from utils.data_utils import get_loader
+from utils.distillation import compare_models
+from utils.myModel import get_model
+from utils.pruning import PRUNE_SCORES, l1_scores, prunable_groups, prune_channels, taylor_scores
+from utils.utils import CROP_SAMPLES, get_inferer
+
+# Structured pruning of the Swin MLP hidden units and the middle channels of the UNETR conv blocks of a 2dswin /
+# 25dswin checkpoint. Channels are scored once (L1 magnitude or first-order Taylor on training crops), then for every
+# --sparsities level the lowest scoring fraction of each layer is removed (smaller tensors), optionally fine-tuned
+# with run_training for --finetune_epochs (needs a GPU, like main.py), and saved as <name>_pruned<percent>.pt, which
+# the model wrappers load directly. Prints parameters, FLOPs and CPU latency per window against validation Dice /
+# best F0.5 per level and writes them to <name>_pruned.json. Takes main.py's arguments plus the ones below.
+#   python tools/prune_model.py --model_mode 2dswin --roi_x 256 --roi_y 256 --data_dir <data> --json_list <json> \
+#       --pretrained_dir ./pretrained_models --pretrained_model_name model.pt --prune_score taylor --finetune_epochs 5
+parser.add_argument("--sparsities", default="0.25,0.5,0.75", type=str, help="fractions of hidden channels to remove")
+parser.add_argument("--prune_score", default="l1", choices=PRUNE_SCORES, help="channel importance")
+parser.add_argument("--score_batches", default=4, type=int, help="training batches the taylor score is summed over")
+parser.add_argument("--min_channels", default=4, type=int, help="hidden channels kept at least per layer")
+parser.add_argument("--finetune_epochs", default=0, type=int, help="run_training epochs after pruning, 0 skips")
+parser.add_argument("--latency_repeat", default=5, type=int, help="timed CPU forward passes per model")
+
+
+def score_batches(loader, args, device):
+    batches = []
+    for batch in loader:
+        if len(batches) >= args.score_batches:
+            break
+        batches.append((batch["image"].to(device), batch["inklabels"][:, 0:1].to(device)))
+    return batches
+
+
+def finetune(model, loaders, loss_func, args, logdir):
+    args = copy.copy(args)
+    args.max_epochs = args.finetune_epochs
+    args.logdir = logdir
+    model.set_checkpoint_policy(
+        args.checkpoint_policy,
+        budget_mb=args.checkpoint_budget_mb,
+        batch_size=args.batch_size * CROP_SAMPLES[args.model_mode],
+        amp=args.amp,
+    )
+    model.cuda(0)
+    run_training(
+        model=model,
+        train_loader=loaders[0],
+        val_loader=loaders[1],
+        optimizer=build_optimizer(model, args),
+        loss_func=loss_func,
+        acc_func=MeanIoU(include_background=False, reduction=MetricReduction.MEAN, get_not_nans=True),
+        args=args,
+        model_inferer=get_inferer(args, model),
+        post_label=AsDiscrete(to_onehot=args.out_channels),
+        post_pred=AsDiscrete(argmax=True, to_onehot=args.out_channels),
+    )
+    model.set_checkpoint_policy("none")
+
+
+def cpu_cost(model, args):
+    model = copy.deepcopy(model).cpu().eval()
+    x = torch.rand(args.sw_batch_size, 65, args.roi_x, args.roi_y)
+    with torch.no_grad():
+        counter = FlopCounterMode(display=False)
+        with counter:
+            model(x[:1])
+        model(x)
+        best = float("inf")
+        for _ in range(args.latency_repeat):
+            start = time.time()
+            model(x)
+            best = min(best, time.time() - start)
+    return counter.get_total_flops(), best / args.sw_batch_size
+
+
+def main():
+    args = parser.parse_args()
+    if args.model_mode not in ("2dswin", "25dswin"):
+        raise ValueError("model_mode should be ['2dswin', '25dswin']")
+    args.amp = not args.noamp
+    args.test_mode = False
+    args.distributed = False
+    args.rank, args.gpu, args.world_size = 0, 0, 1
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if args.finetune_epochs > 0 and device.type != "cuda":
+        raise ValueError("--finetune_epochs trains through run_training, which needs a GPU")
+    sparsities = [float(s) for s in args.sparsities.split(",")]
+
+    model = get_model(args)
+    model.set_checkpoint_policy("none")
+    model_path = os.path.join(args.pretrained_dir, args.pretrained_model_name)
+    model.load_state_dict(torch.load(model_path, map_location="cpu")["state_dict"])
+    model.to(device)
+    loaders = get_loader(args)
+    loss_func = build_loss(args)
+    groups = prunable_groups(model)
+    start = time.time()
+    if args.prune_score == "taylor":
+        scores = taylor_scores(model, score_batches(loaders[0], args, device), loss_func, groups)
+    else:
+        scores = l1_scores(model, groups)
+    print("Scored {} layers ({}) in {:.2f}s".format(len(groups), args.prune_score, time.time() - start))
+
+    stem = os.path.splitext(model_path)[0]
+    rows = []
+    for sparsity in [0.0] + sparsities:
+        pruned = copy.deepcopy(model)
+        path = model_path
+        if sparsity > 0:
+            kept = prune_channels(pruned, sparsity, scores, groups, min_channels=args.min_channels)
+            if args.finetune_epochs > 0:
+                finetune(pruned, loaders, loss_func, args, "./runs/{}/sparsity_{:.2f}".format(args.logdir, sparsity))
+            path = "{}_pruned{:02d}.pt".format(stem, int(round(100 * sparsity)))
+            atomic_save(
+                {"state_dict": pruned.state_dict(), "sparsity": sparsity, "prune_score": args.prune_score, "kept": kept},
+                path,
+            )
+            # the export has to load into a freshly built wrapper, as test.py / serve.py do
+            get_model(args).load_state_dict(torch.load(path, map_location="cpu")["state_dict"])
+        flops, window_s = cpu_cost(pruned, args)
+        accuracy = compare_models(
+            [("pruned", pruned.to(device))], loaders[1], lambda m: get_inferer(args, m, sw_device=device), device,
+            verbose=False,
+        )[0]
+        rows.append({
+            "sparsity": sparsity,
+            "checkpoint": os.path.basename(path),
+            "params": accuracy["params"],
+            "gflop_per_window": flops / 1e9,
+            "cpu_ms_per_window": 1000 * window_s,
+            "dice": accuracy["dice"],
+            "best_f05": accuracy["f05"],
+            "threshold": accuracy["threshold"],
+        })
+
+    print("{:>8} {:>10} {:>10} {:>12} {:>10} {:>10}  {}".format(
+        "sparsity", "params (M)", "GFLOP/win", "CPU ms/win", "dice@0.5", "best f0.5", "checkpoint"))
+    for row in rows:
+        print("{:>8.2f} {:>10.2f} {:>10.2f} {:>12.1f} {:>10.4f} {:>10.4f}  {}".format(
+            row["sparsity"], row["params"] / 1e6, row["gflop_per_window"], row["cpu_ms_per_window"], row["dice"],
+            row["best_f05"], row["checkpoint"]))
+    with open(stem + "_pruned.json", "w") as f:
+        json.dump({"threads": torch.get_num_threads(), "finetune_epochs": args.finetune_epochs, "rows": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import sys
+sys.path.append('..')
+sys.path.append('.')
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+from main import parser
+from utils.data_utils import get_loader
+from utils.myModel import MyModel, MyModel2d
+from utils.quantization import quantize_model, save_quantized, state_dict_bytes
+from utils.threshold_metrics import ThresholdHistogram
+from utils.utils import get_inferer
+
+# Post-training int8 quantization for CPU inference: dynamic int8 Linears in the Swin transformer, static (FX)
+# int8 UNETR conv blocks calibrated on windows of the validation fragments. Writes <name>_int8.ts (TorchScript,
+# run it with test.py --backend torchscript --pretrained_model_name <name>_int8.ts) and <name>_int8.json with the
+# latency, size and Dice / F0.5 change against fp32. Takes main.py's arguments plus the ones below.
+#   python tools/quantize_model.py --model_mode 2dswin --roi_x 256 --roi_y 256 --data_dir <data> --json_list <json> \
+#       --pretrained_dir ./pretrained_models --pretrained_model_name model.pt
+parser.add_argument("--calib_windows", default=64, type=int, help="windows used to calibrate the static conv blocks")
+parser.add_argument("--eval_cases", default=0, type=int, help="validation batches compared with fp32, 0 for all")
+parser.add_argument("--dynamic_only", action="store_true", help="only quantize the transformer Linears")
+parser.add_argument("--latency_repeat", default=5, type=int, help="timed forward passes per model")
+
+
+def window_mask(batch):
+    mask = batch["label"][:, 0]
+    return mask[..., 0] if mask.dim() == 4 else mask
+
+
+def calibration_batches(loader, args):
+    """
+    Random windows of the validation fragments that are at least half inside the fragment mask, batched by
+    ``sw_batch_size``.
+    """
+    h, w = args.roi_x, args.roi_y
+    rng = np.random.RandomState(0)
+    windows = []
+    for batch in loader:
+        mask = window_mask(batch)
+        image = batch["image"]
+        starts = [
+            (b, y, x)
+            for b in range(image.shape[0])
+            for y in range(0, image.shape[2] - h + 1, h)
+            for x in range(0, image.shape[3] - w + 1, w)
+            if float(mask[b, y: y + h, x: x + w].float().mean()) >= 0.5
+        ]
+        rng.shuffle(starts)
+        windows += [image[b: b + 1, :, y: y + h, x: x + w] for b, y, x in starts]
+        if len(windows) >= args.calib_windows:
+            break
+    windows = windows[: args.calib_windows]
+    if not windows:
+        raise ValueError("no validation window of size {}x{} inside the fragment masks".format(h, w))
+    return [torch.cat(windows[i: i + args.sw_batch_size]) for i in range(0, len(windows), args.sw_batch_size)]
+
+
+def evaluate(inferer, loader, args):
+    hist = ThresholdHistogram()
+    start = time.time()
+    with torch.no_grad():
+        for idx, batch in enumerate(loader):
+            if args.eval_cases and idx >= args.eval_cases:
+                break
+            data, target, mask = batch["image"], batch["inklabels"], batch["label"]
+            if args.model_mode == "3dswin":
+                target, mask = target[:, :, :, :, 0:1], mask[:, :, :, :, 0:1]
+                prob = inferer(data, mask=mask).float()
+            else:
+                target, mask = target[:, 0:1], mask[:, 0:1]
+                prob = torch.sigmoid(inferer(data, mask=mask).float())
+            hist.update(prob, target)
+    return hist, time.time() - start
+
+
+def latency(model, batch, repeat):
+    best = float("inf")
+    with torch.no_grad():
+        model(batch)
+        for _ in range(repeat):
+            start = time.time()
+            model(batch)
+            best = min(best, time.time() - start)
+    return best
+
+
+def main():
+    args = parser.parse_args()
+    args.test_mode = True
+    args.amp = False
+    args.rank = 0
+    if args.model_mode == "3dswin":
+        model = MyModel(img_size=(args.roi_x, args.roi_y, args.roi_y), checkpoint_policy="none")
+    elif args.model_mode == "2dswin":
+        model = MyModel2d(img_size=(args.roi_x, args.roi_y), checkpoint_policy="none")
+    else:
+        raise ValueError("model_mode should be ['3dswin', '2dswin']")
+    model_path = os.path.join(args.pretrained_dir, args.pretrained_model_name)
+    model.load_state_dict(torch.load(model_path, map_location="cpu")["state_dict"])
+    model.eval()
+
+    loader = get_loader(args)
+    calibration = calibration_batches(loader, args)
+    start = time.time()
+    qmodel = quantize_model(model, calibration, decoder=not args.dynamic_only)
+    print("Quantized in {:.2f}s on {} calibration windows".format(time.time() - start, sum(len(b) for b in calibration)))
+
+    out_path = os.path.splitext(model_path)[0] + "_int8.ts"
+    save_quantized(qmodel, calibration[0], out_path)
+
+    fp32_hist, fp32_time = evaluate(get_inferer(args, model, "cpu"), loader, args)
+    int8_hist, int8_time = evaluate(get_inferer(args, qmodel, "cpu"), loader, args)
+    fp32_latency = latency(model, calibration[0], args.latency_repeat)
+    int8_latency = latency(qmodel, calibration[0], args.latency_repeat)
+    b = fp32_hist.at(0.5)
+    report = {
+        "threads": torch.get_num_threads(),
+        "engine": torch.backends.quantized.engine,
+        "static_decoder": not args.dynamic_only,
+        "batch_ms_fp32": 1000 * fp32_latency,
+        "batch_ms_int8": 1000 * int8_latency,
+        "speedup": fp32_latency / int8_latency,
+        "validation_s_fp32": fp32_time,
+        "validation_s_int8": int8_time,
+        "size_mb_fp32": state_dict_bytes(model) / 2 ** 20,
+        "size_mb_int8": os.path.getsize(out_path) / 2 ** 20,
+        "dice_fp32": float(fp32_hist.dice()[b]),
+        "dice_int8": float(int8_hist.dice()[b]),
+        "best_f05_fp32": fp32_hist.best("f0.5")[1],
+        "best_f05_int8": int8_hist.best("f0.5")[1],
+    }
+    print("fp32: {}".format(fp32_hist.summary()))
+    print("int8: {}".format(int8_hist.summary()))
+    print(
+        "batch of {}: {:.1f}ms fp32, {:.1f}ms int8 ({:.2f}x), size {:.1f}MB -> {:.1f}MB, dice {:+.4f}, best f0.5 {:+.4f}".format(
+            len(calibration[0]),
+            report["batch_ms_fp32"],
+            report["batch_ms_int8"],
+            report["speedup"],
+            report["size_mb_fp32"],
+            report["size_mb_int8"],
+            report["dice_int8"] - report["dice_fp32"],
+            report["best_f05_int8"] - report["best_f05_fp32"],
+        )
+    )
+    with open(os.path.splitext(out_path)[0] + ".json", "w") as f:
+        json.dump(report, f, indent=2)
+    print("Saved {}".format(out_path))
+
+
+if __name__ == "__main__":
+    main()
@@ -10,7 +10,7 @@
 # limitations under the License.
 
 import os
-import shutil
+import random
 import time
 
 import numpy as np
@@ -19,16 +19,20 @@ import torch.nn.parallel
 import torch.utils.data.distributed
 from tensorboardX import SummaryWriter
 from torch.cuda.amp import GradScaler, autocast
+from utils.checkpoint_io import CheckpointWriter, atomic_save
+from utils.proxy_val import build_proxy_set, proxy_val_epoch
+from utils.threshold_metrics import ThresholdHistogram
+from utils.val_worker import ValidationWorker
 from utils.utils import AverageMeter, distributed_all_gather
 
 from monai.data import decollate_batch
 
 
-def train_epoch(model, loader, optimizer, scaler, epoch, loss_func, args):
+def train_epoch(model, loader, optimizer, scaler, epoch, loss_func, args, start_step=0, on_step=None, teacher=None):
     model.train()
     start_time = time.time()
     run_loss = AverageMeter()
-    for idx, batch_data in enumerate(loader):
+    for idx, batch_data in enumerate(loader, start_step):
         if isinstance(batch_data, list):
             data, target = batch_data
         else:
@@ -39,13 +43,18 @@ def train_epoch(model, loader, optimizer, scaler, epoch, loss_func, args):
         for param in model.parameters():
             param.grad = None
         with autocast(enabled=args.amp):
+            # soft targets of a frozen teacher, see utils.distillation
+            teacher_logits = teacher(batch_data, data) if teacher is not None else None
             logits = model(data)
             # print(logits.shape, data.shape, target.shape)
-            if args.model_mode == "2dswin":
+            if args.model_mode in ["2dswin", "25dswin", "2dunet"]:
                 print(logits.device, target.device)
                 logits, target = logits.cuda(0), target.cuda(0)
                 print(logits.device, target.device)
-                loss = loss_func(logits, target[ :, 0:1, :, :])
+                if teacher_logits is not None:
+                    loss = loss_func(logits, target[ :, 0:1, :, :], teacher_logits.cuda(0))
+                else:
+                    loss = loss_func(logits, target[ :, 0:1, :, :])
             elif args.model_mode == "3dswin":
                 loss = loss_func(logits, target[:, :, :, :, 0:1])
             else:
@@ -66,17 +75,24 @@ def train_epoch(model, loader, optimizer, scaler, epoch, loss_func, args):
             run_loss.update(loss.item(), n=args.batch_size)
         if args.rank == 0:
             print(
-                "Epoch {}/{} {}/{}".format(epoch, args.max_epochs, idx, len(loader)),
+                "Epoch {}/{} {}/{}".format(epoch, args.max_epochs, idx, start_step + len(loader)),
                 "loss: {:.4f}".format(run_loss.avg),
                 "time {:.2f}s".format(time.time() - start_time),
             )
+        if on_step is not None:
+            on_step(epoch, idx + 1)
         start_time = time.time()
     for param in model.parameters():
         param.grad = None
     return run_loss.avg
 
 
-def val_epoch(model, loader, epoch, acc_func, args, model_inferer=None, post_label=None, post_pred=None):
+def val_epoch(
+    model, loader, epoch, acc_func, args, model_inferer=None, post_label=None, post_pred=None, device=None,
+    threshold_hist=None,
+):
+    if device is None:
+        device = args.rank
     model.eval()
     run_acc = AverageMeter()
     start_time = time.time()
@@ -86,15 +102,21 @@ def val_epoch(model, loader, epoch, acc_func, args, model_inferer=None, post_lab
                 data, target = batch_data
             else:
                 data, target = batch_data["image"], batch_data["inklabels"]
+            # fragment mask, lets the inferer skip windows outside the papyrus
+            mask = batch_data.get("label") if isinstance(batch_data, dict) else None
             if args.model_mode == "3dswin":
-                data, target = data.cuda(args.rank), target[:, :, :, :, 0:1].cuda(args.rank)
-            elif args.model_mode == "2dswin":
-                data, target = data.cuda(args.rank), target[ :, 0:1, :, :].cuda(args.rank)
+                data, target = data.to(device), target[:, :, :, :, 0:1].to(device)
+                mask = mask[:, :, :, :, 0:1] if mask is not None else None
+            elif args.model_mode in ["2dswin", "25dswin", "2dunet"]:
+                data, target = data.to(device), target[ :, 0:1, :, :].to(device)
+                mask = mask[:, 0:1, :, :] if mask is not None else None
             else:
                 raise ValueError("model_mode should be ['3dswin', '2dswin', '3dunet', '2dunet']")
             # print(data.shape, target.shape)
             with autocast(enabled=args.amp):
-                if model_inferer is not None:
+                if model_inferer is not None and getattr(model_inferer, "uses_mask", False):
+                    logits = model_inferer(data, mask=mask)
+                elif model_inferer is not None:
                     logits = model_inferer(data)
                 else:
                     logits = model(data)
@@ -107,8 +129,12 @@ def val_epoch(model, loader, epoch, acc_func, args, model_inferer=None, post_lab
             acc_func.reset()
             acc_func(y_pred=val_outputs_list, y=val_labels_list)
             acc, not_nans = acc_func.aggregate()
-            acc = acc.cuda(args.rank)
+            acc = acc.to(device)
             run_acc.update(acc.cpu().numpy(), n=not_nans.cpu().numpy())
+            if threshold_hist is not None:
+                # MyModel already ends with a sigmoid, MyModel2d returns logits
+                prob = logits.float() if args.model_mode == "3dswin" else torch.sigmoid(logits.float())
+                threshold_hist.update(prob, target.to(prob.device))
 
             if args.rank == 0:
                 avg_acc = np.mean(run_acc.avg)
@@ -122,16 +148,78 @@ def val_epoch(model, loader, epoch, acc_func, args, model_inferer=None, post_lab
     return run_acc.avg
 
 
-def save_checkpoint(model, epoch, args, filename="model.pt", best_acc=0, optimizer=None, scheduler=None):
+def save_checkpoint(model, epoch, args, filename="model.pt", best_acc=0, optimizer=None, scheduler=None, ckpt_writer=None):
     state_dict = model.state_dict() if not args.distributed else model.module.state_dict()
     save_dict = {"epoch": epoch, "best_acc": best_acc, "state_dict": state_dict}
     if optimizer is not None:
         save_dict["optimizer"] = optimizer.state_dict()
     if scheduler is not None:
         save_dict["scheduler"] = scheduler.state_dict()
-    filename = os.path.join(args.logdir, filename)
-    torch.save(save_dict, filename)
-    print("Saving checkpoint", filename)
+    if ckpt_writer is not None:
+        ckpt_writer.save(save_dict, filename)
+    else:
+        atomic_save(save_dict, os.path.join(args.logdir, filename))
+    print("Saving checkpoint", os.path.join(args.logdir, filename))
+
+
+def capture_rng_state():
+    np_state = np.random.get_state()
+    state = {
+        "python": random.getstate(),
+        # numpy key as a tensor so the state loads with torch.load(weights_only=True)
+        "numpy": (np_state[0], torch.from_numpy(np_state[1].copy()), np_state[2], np_state[3], np_state[4]),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def restore_rng_state(state):
+    random.setstate(state["python"])
+    np_state = state["numpy"]
+    np.random.set_state((np_state[0], np_state[1].numpy(), np_state[2], np_state[3], np_state[4]))
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def save_training_state(
+    model, epoch, step, args, best_acc=0, optimizer=None, scheduler=None, scaler=None, ckpt_writer=None,
+    filename="resume.pt",
+):
+    """
+    Everything needed to continue training from ``step`` batches into ``epoch``: weights, optimizer, scheduler,
+    GradScaler, the RNG streams of every rank and the sampler position. Crops and augmentations are seeded per sample by
+    :py:class:`utils.data_utils.SeededDataset`, so they need no state here. Must be called on all ranks.
+    """
+    rng = capture_rng_state()
+    if args.distributed:
+        rng_list = [None] * args.world_size
+        torch.distributed.all_gather_object(rng_list, rng)
+    else:
+        rng_list = [rng]
+    if args.rank != 0:
+        return
+    state_dict = model.state_dict() if not args.distributed else model.module.state_dict()
+    save_dict = {
+        "epoch": epoch,
+        "step": step,
+        "best_acc": best_acc,
+        "state_dict": state_dict,
+        "rng": rng_list,
+        "world_size": args.world_size,
+    }
+    if optimizer is not None:
+        save_dict["optimizer"] = optimizer.state_dict()
+    if scheduler is not None:
+        save_dict["scheduler"] = scheduler.state_dict()
+    if scaler is not None:
+        save_dict["scaler"] = scaler.state_dict()
+    if ckpt_writer is not None:
+        ckpt_writer.save(save_dict, filename)
+    else:
+        atomic_save(save_dict, os.path.join(args.logdir, filename))
 
 
 def run_training(
@@ -147,24 +235,79 @@ def run_training(
     start_epoch=0,
     post_label=None,
     post_pred=None,
+    resume_state=None,
+    teacher=None,
 ):
     writer = None
     if args.logdir is not None and args.rank == 0:
         writer = SummaryWriter(log_dir=args.logdir)
         if args.rank == 0:
             print("Writing Tensorboard logs to ", args.logdir)
+    ckpt_writer = None
+    if args.rank == 0 and args.logdir is not None and (args.save_checkpoint or args.snapshot_every > 0):
+        ckpt_writer = CheckpointWriter(args.logdir, keep_last=args.keep_checkpoints)
     scaler = None
     if args.amp:
         scaler = GradScaler()
     val_acc_max = 0.0
+    if resume_state is not None:
+        val_acc_max = resume_state["best_acc"]
+        if scaler is not None and "scaler" in resume_state:
+            scaler.load_state_dict(resume_state["scaler"])
+
+    proxy_set = None
+    if args.proxy_val_every > 0 and args.rank == 0:
+        roi_size = (args.roi_x, args.roi_y, args.roi_z) if args.model_mode == "3dswin" else (args.roi_x, args.roi_y)
+        proxy_set = build_proxy_set(val_loader, roi_size, args.proxy_patches, args, seed=args.proxy_seed)
+
+    val_worker = None
+    val_snapshots = {}
+    if args.async_val and args.rank == 0:
+        val_worker = ValidationWorker(args, args.val_device, acc_func, max_pending=args.async_val_max_pending)
+
+    def record_async_val(results):
+        nonlocal val_acc_max
+        for val_epoch_idx, val_avg_acc, val_time in results:
+            state_dict = val_snapshots.pop(val_epoch_idx)
+            print(
+                "Final validation  {}/{}".format(val_epoch_idx, args.max_epochs - 1),
+                "acc",
+                val_avg_acc,
+                "time {:.2f}s (async)".format(val_time),
+            )
+            if writer is not None:
+                writer.add_scalar("val_acc", val_avg_acc, val_epoch_idx)
+            if args.best_metric == "full" and val_avg_acc > val_acc_max:
+                print("new best ({:.6f} --> {:.6f}). ".format(val_acc_max, val_avg_acc))
+                val_acc_max = val_avg_acc
+                if ckpt_writer is not None and args.save_checkpoint:
+                    ckpt_writer.save({"epoch": val_epoch_idx, "best_acc": val_acc_max, "state_dict": state_dict}, "model.pt")
+
+    def on_step(epoch, step):
+        if args.snapshot_every > 0 and step % args.snapshot_every == 0:
+            save_training_state(
+                model, epoch, step, args, best_acc=val_acc_max, optimizer=optimizer, scheduler=scheduler,
+                scaler=scaler, ckpt_writer=ckpt_writer,
+            )
+
     for epoch in range(start_epoch, args.max_epochs):
+        train_loader.sampler.set_epoch(epoch)
+        if hasattr(train_loader.dataset, "set_epoch"):
+            train_loader.dataset.set_epoch(epoch)
+        start_step = 0
+        if resume_state is not None and epoch == start_epoch:
+            start_step = resume_state["step"]
+            train_loader.sampler.set_start_index(start_step * train_loader.batch_size)
+            if resume_state.get("world_size", args.world_size) == args.world_size:
+                restore_rng_state(resume_state["rng"][args.rank])
+            print(args.rank, "Resuming epoch", epoch, "at step", start_step)
         if args.distributed:
-            train_loader.sampler.set_epoch(epoch)
             torch.distributed.barrier()
         print(args.rank, time.ctime(), "Epoch:", epoch)
         epoch_time = time.time()
         train_loss = train_epoch(
-            model, train_loader, optimizer, scaler=scaler, epoch=epoch, loss_func=loss_func, args=args
+            model, train_loader, optimizer, scaler=scaler, epoch=epoch, loss_func=loss_func, args=args,
+            start_step=start_step, on_step=on_step, teacher=teacher,
         )
         if args.rank == 0:
             print(
@@ -175,11 +318,57 @@ def run_training(
         if args.rank == 0 and writer is not None and epoch % 10 == 0:
             writer.add_scalar("train_loss", train_loss, epoch)
         b_new_best = False
-        if (epoch + 1) % args.val_every == 0:
+        b_validated = False
+        if args.proxy_val_every > 0 and (epoch + 1) % args.proxy_val_every == 0:
+            if args.distributed:
+                torch.distributed.barrier()
+            if args.rank == 0:
+                epoch_time = time.time()
+                proxy_avg_acc = np.mean(
+                    proxy_val_epoch(
+                        model.module if args.distributed else model,
+                        proxy_set,
+                        epoch=epoch,
+                        acc_func=acc_func,
+                        args=args,
+                        batch_size=args.sw_batch_size,
+                    )
+                )
+                print(
+                    "Final proxy validation  {}/{}".format(epoch, args.max_epochs - 1),
+                    "acc",
+                    proxy_avg_acc,
+                    "time {:.2f}s".format(time.time() - epoch_time),
+                )
+                if writer is not None:
+                    writer.add_scalar("proxy_val_acc", proxy_avg_acc, epoch)
+                if args.best_metric == "proxy":
+                    b_validated = True
+                    if proxy_avg_acc > val_acc_max:
+                        print("new best ({:.6f} --> {:.6f}). ".format(val_acc_max, proxy_avg_acc))
+                        val_acc_max = proxy_avg_acc
+                        b_new_best = True
+            if args.distributed:
+                torch.distributed.barrier()
+        if val_worker is not None:
+            record_async_val(val_worker.poll())
+        if args.async_val and (epoch + 1) % args.val_every == 0:
+            if val_worker is not None:
+                state_dict = model.state_dict() if not args.distributed else model.module.state_dict()
+                snapshot = val_worker.submit(epoch, state_dict)
+                if snapshot is None:
+                    print("Validation worker busy, skipping validation of epoch", epoch)
+                else:
+                    val_snapshots[epoch] = snapshot
+                    if args.logdir is not None and args.save_checkpoint:
+                        ckpt_writer.save({"epoch": epoch, "best_acc": val_acc_max, "state_dict": snapshot}, "model_final.pt")
+                        ckpt_writer.add_history("model_final.pt", epoch)
+        elif (epoch + 1) % args.val_every == 0:
             if args.distributed:
                 torch.distributed.barrier()
             epoch_time = time.time()
             print("Start_val")
+            threshold_hist = ThresholdHistogram() if args.threshold_sweep else None
             val_avg_acc = val_epoch(
                 model,
                 val_loader,
@@ -189,9 +378,19 @@ def run_training(
                 args=args,
                 post_label=post_label,
                 post_pred=post_pred,
+                threshold_hist=threshold_hist,
             )
             
             val_avg_acc = np.mean(val_avg_acc)
+            if threshold_hist is not None:
+                if args.distributed:
+                    threshold_hist.all_reduce(device=args.rank)
+                if args.rank == 0:
+                    best_t, best_f = threshold_hist.best("f0.5")
+                    print("Threshold sweep {}/{}".format(epoch, args.max_epochs - 1), threshold_hist.summary())
+                    if writer is not None:
+                        writer.add_scalar("val_best_f05", best_f, epoch)
+                        writer.add_scalar("val_best_f05_threshold", best_t, epoch)
 
             if args.rank == 0:
                 print(
@@ -202,23 +401,35 @@ def run_training(
                 )
                 if writer is not None:
                     writer.add_scalar("val_acc", val_avg_acc, epoch)
-                if val_avg_acc > val_acc_max:
-                    print("new best ({:.6f} --> {:.6f}). ".format(val_acc_max, val_avg_acc))
-                    val_acc_max = val_avg_acc
-                    b_new_best = True
-                    if args.rank == 0 and args.logdir is not None and args.save_checkpoint:
-                        save_checkpoint(
-                            model, epoch, args, best_acc=val_acc_max, optimizer=optimizer, scheduler=scheduler
-                        )
-            if args.rank == 0 and args.logdir is not None and args.save_checkpoint:
-                save_checkpoint(model, epoch, args, best_acc=val_acc_max, filename="model_final.pt")
-                if b_new_best:
-                    print("Copying to model.pt new best model!!!!")
-                    shutil.copyfile(os.path.join(args.logdir, "model_final.pt"), os.path.join(args.logdir, "model.pt"))
+                if args.best_metric == "full":
+                    b_validated = True
+                    if val_avg_acc > val_acc_max:
+                        print("new best ({:.6f} --> {:.6f}). ".format(val_acc_max, val_avg_acc))
+                        val_acc_max = val_avg_acc
+                        b_new_best = True
+        if b_validated and args.rank == 0 and args.logdir is not None and args.save_checkpoint:
+            save_checkpoint(
+                model, epoch, args, best_acc=val_acc_max, filename="model_final.pt", ckpt_writer=ckpt_writer
+            )
+            if b_new_best:
+                print("Linking model.pt to new best model!!!!")
+                ckpt_writer.link("model_final.pt", "model.pt")
+            ckpt_writer.add_history("model_final.pt", epoch)
+            if args.sync_checkpoint:
+                ckpt_writer.wait()
 
         if scheduler is not None:
             scheduler.step()
+        if args.snapshot_every > 0:
+            save_training_state(
+                model, epoch + 1, 0, args, best_acc=val_acc_max, optimizer=optimizer, scheduler=scheduler,
+                scaler=scaler, ckpt_writer=ckpt_writer,
+            )
 
+    if val_worker is not None:
+        record_async_val(val_worker.close())
+    if ckpt_writer is not None:
+        ckpt_writer.close()
     print("Training Finished !, Best Accuracy: ", val_acc_max)
 
     return val_acc_max
@@ -0,0 +1,102 @@
+import os
+
+import numpy as np
+import torch
+
+BACKENDS = ("eager", "torchscript", "onnxruntime")
+
+
+def export_paths(model_path):
+    """
+    ``(torchscript_path, onnx_path)`` written next to a checkpoint by ``tools/export_model.py``.
+    """
+    stem = os.path.splitext(model_path)[0]
+    return stem + ".ts", stem + ".onnx"
+
+
+def window_shape(model_mode, roi_x, roi_y, batch_size=1):
+    """
+    Input shape of one window batch of a model_mode, as fed by :py:class:`utils.inference.StreamingInferer`.
+    """
+    if model_mode == "3dswin":
+        return (batch_size, 1, roi_x, roi_y, 64)
+    if model_mode in ("2dswin", "25dswin", "2dunet"):
+        return (batch_size, 65, roi_x, roi_y)
+    raise ValueError("model_mode should be ['3dswin', '2dswin', '25dswin', '2dunet']")
+
+
+def export_torchscript(model, example, path):
+    with torch.no_grad():
+        traced = torch.jit.trace(model.eval(), example)
+    traced = torch.jit.freeze(traced)
+    traced.save(path)
+    return traced
+
+
+def export_onnx(model, example, path, opset=18):
+    # torch.export based exporter: the legacy one cannot export the layer_norm of SwinUNETR's proj_out with a
+    # dynamic batch. The batch dim stays dynamic so the runtime takes any sw_batch_size, ``example`` should have a
+    # batch of 2 or more or the exporter specialises it to 1.
+    batch = torch.export.Dim("batch", max=4096)
+    with torch.no_grad():
+        torch.onnx.export(
+            model.eval(),
+            (example,),
+            path,
+            input_names=["image"],
+            output_names=["logits"],
+            dynamic_shapes={"x": {0: batch}},
+            opset_version=opset,
+            dynamo=True,
+        )
+    return path
+
+
+class OnnxRuntimePredictor(object):
+    """
+    Predictor running an exported model with ONNX Runtime on the CPU, called like the eager model on a
+    ``(B, ...)`` float tensor. All graph optimisations are enabled; ``threads`` sets the intra-op pool (default
+    all cores) and ``inter_op_threads`` the pool running independent graph nodes in parallel.
+
+    ``onnxruntime`` is only needed for this backend and is imported here.
+    """
+
+    def __init__(self, path, threads=None, inter_op_threads=1):
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError("--backend onnxruntime needs the onnxruntime package (pip install onnxruntime)") from e
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = threads or 0
+        options.inter_op_num_threads = inter_op_threads
+        if inter_op_threads > 1:
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, x):
+        data = np.ascontiguousarray(x.detach().cpu().numpy(), dtype=np.float32)
+        return torch.from_numpy(self.session.run(None, {self.input_name: data})[0])
+
+
+def load_backend(backend, model_path, model=None, device="cpu", threads=None):
+    """
+    Predictor for ``--backend``: the given eager ``model``, or the TorchScript / ONNX export of ``model_path``.
+    A ``model_path`` that already is a ``.ts`` / ``.onnx`` file (e.g. from ``tools/quantize_model.py``) is used as is.
+    """
+    if backend == "eager":
+        return model
+    ts_path, onnx_path = export_paths(model_path)
+    path = ts_path if backend == "torchscript" else onnx_path
+    if os.path.splitext(model_path)[1] in (".ts", ".onnx"):
+        path = model_path
+    if not os.path.exists(path):
+        raise FileNotFoundError("{} not found, run tools/export_model.py first".format(path))
+    if backend == "torchscript":
+        if threads:
+            torch.set_num_threads(threads)
+        return torch.jit.load(path, map_location=device).eval()
+    if backend == "onnxruntime":
+        return OnnxRuntimePredictor(path, threads=threads)
+    raise ValueError("backend should be one of {}".format(BACKENDS))
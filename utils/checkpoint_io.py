@@ -0,0 +1,126 @@
+import glob
+import os
+import queue
+import re
+import shutil
+import threading
+
+import torch
+
+
+def snapshot_to_cpu(obj):
+    """
+    Detached CPU copy of every tensor in a (nested) state dict, so training can keep mutating the originals.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot_to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, filename):
+    """
+    ``torch.save`` into a temporary file next to ``filename`` and rename it over the target, so readers only ever
+    see complete checkpoints.
+    """
+    tmp = "{}.tmp.{}".format(filename, os.getpid())
+    with open(tmp, "wb") as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+
+def atomic_link(src, dst):
+    """
+    Point ``dst`` at the contents of ``src`` with a hard link (a copy where links are not supported), replacing
+    ``dst`` atomically.
+    """
+    tmp = "{}.tmp.{}".format(dst, os.getpid())
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class CheckpointWriter(object):
+    """
+    Serializes checkpoints on a background thread.
+
+    ``save`` snapshots the state dicts to CPU on the calling thread and returns, the worker then writes them with
+    :py:func:`atomic_save`. ``link`` and history pruning go through the same queue, so they always see the files
+    queued before them. Errors raised by the worker are re-raised on the next call from the training loop.
+
+    Args:
+        logdir: directory the checkpoints are written to.
+        keep_last: number of ``model_epoch{N}.pt`` history checkpoints kept, 0 disables history.
+    """
+
+    history_pattern = "model_epoch{}.pt"
+
+    def __init__(self, logdir, keep_last=0):
+        self.logdir = logdir
+        self.keep_last = keep_last
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                if self.error is None:
+                    job[0](*job[1:])
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("background checkpoint write failed") from error
+
+    def save(self, save_dict, filename):
+        self._check()
+        self.queue.put((atomic_save, snapshot_to_cpu(save_dict), os.path.join(self.logdir, filename)))
+
+    def link(self, src, dst):
+        self._check()
+        self.queue.put((atomic_link, os.path.join(self.logdir, src), os.path.join(self.logdir, dst)))
+
+    def add_history(self, src, epoch):
+        """
+        Keep ``src`` as the history checkpoint of ``epoch`` and drop the oldest ones beyond ``keep_last``.
+        """
+        if self.keep_last <= 0:
+            return
+        self.link(src, self.history_pattern.format(epoch))
+        self.queue.put((self._prune_history,))
+
+    def _prune_history(self):
+        def epoch_of(path):
+            return int(re.search(r"model_epoch(\d+)\.pt$", path).group(1))
+
+        files = glob.glob(os.path.join(self.logdir, self.history_pattern.format("*")))
+        files = sorted((f for f in files if re.search(r"model_epoch\d+\.pt$", f)), key=epoch_of)
+        for f in files[: max(len(files) - self.keep_last, 0)]:
+            os.remove(f)
+
+    def wait(self):
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
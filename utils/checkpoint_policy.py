@@ -0,0 +1,161 @@
+from functools import partial
+
+import numpy as np
+import torch
+import torch.utils.checkpoint as checkpoint
+
+SWIN_STAGES = ("layers1", "layers2", "layers3", "layers4")
+UNETR_BLOCKS = (
+    "encoder1",
+    "encoder2",
+    "encoder3",
+    "encoder4",
+    "encoder10",
+    "decoder5",
+    "decoder4",
+    "decoder3",
+    "decoder2",
+    "decoder1",
+)
+POLICIES = ("none", "swin", "all", "auto")
+
+# (spatial downsample factor, channel multiplier) of every UNETR conv block
+_UNETR_GEOMETRY = {
+    "encoder1": (1, 1),
+    "encoder2": (2, 1),
+    "encoder3": (4, 2),
+    "encoder4": (8, 4),
+    "encoder10": (32, 16),
+    "decoder5": (16, 8),
+    "decoder4": (8, 4),
+    "decoder3": (4, 2),
+    "decoder2": (2, 1),
+    "decoder1": (1, 1),
+}
+
+
+def parse_checkpoint_policy(policy):
+    """
+    Turn a policy spec into the set of stage/block names that should be recomputed in backward.
+
+    Args:
+        policy: one of ``"none"``, ``"swin"`` (every Swin encoder stage, the historical default),
+            ``"all"`` (Swin stages and every UNETR conv block), or a comma separated list / sequence of
+            names taken from ``SWIN_STAGES`` and ``UNETR_BLOCKS``. ``"auto"`` is resolved by
+            :py:func:`auto_checkpoint_policy` and is rejected here.
+    """
+    if policy is None or policy is False:
+        return set()
+    if policy is True:
+        return set(SWIN_STAGES)
+    if isinstance(policy, str):
+        if policy == "none":
+            return set()
+        if policy == "swin":
+            return set(SWIN_STAGES)
+        if policy == "all":
+            return set(SWIN_STAGES + UNETR_BLOCKS)
+        if policy == "auto":
+            raise ValueError("'auto' checkpoint policy needs a memory budget, use auto_checkpoint_policy")
+        policy = [p.strip() for p in policy.split(",") if p.strip()]
+    names = set(policy)
+    unknown = names - set(SWIN_STAGES + UNETR_BLOCKS)
+    if unknown:
+        raise ValueError(f"Unknown checkpoint stages {sorted(unknown)}, choose from {SWIN_STAGES + UNETR_BLOCKS}")
+    return names
+
+
+def _checkpointed_call(module, *args):
+    forward = partial(type(module).forward, module)
+    if torch.is_grad_enabled() and any(isinstance(a, torch.Tensor) and a.requires_grad for a in args):
+        return checkpoint.checkpoint(forward, *args, use_reentrant=False)
+    return forward(*args)
+
+
+def _set_block_checkpoint(module, enabled):
+    # instance level override keeps the state dict untouched; a partial (not a closure) so deepcopy
+    # rebinds it to the copied module
+    if enabled:
+        module.forward = partial(_checkpointed_call, module)
+    elif "forward" in module.__dict__:
+        del module.forward
+
+
+def apply_checkpoint_policy(swin_unetr, policy):
+    """
+    Enable activation checkpointing on the selected parts of a MONAI ``SwinUNETR`` and disable it elsewhere.
+
+    Returns the sorted list of checkpointed names.
+    """
+    names = parse_checkpoint_policy(policy)
+    for stage in SWIN_STAGES:
+        for layer in getattr(swin_unetr.swinViT, stage):
+            layer.use_checkpoint = stage in names
+            for blk in layer.blocks:
+                blk.use_checkpoint = stage in names
+    for block in UNETR_BLOCKS:
+        _set_block_checkpoint(getattr(swin_unetr, block), block in names)
+    return sorted(names)
+
+
+def estimate_activation_bytes(img_size, feature_size, batch_size=1, window_size=7, mlp_ratio=4.0,
+                              num_heads=(3, 6, 12, 24), depths=(2, 2, 2, 2), bytes_per_el=4):
+    """
+    Rough per-stage activation memory kept for backward, without and with checkpointing.
+
+    The counts follow the tensors each Swin block / UNETR res block saves for autograd: norms, qkv, attention
+    scores and softmax, projections and the MLP for Swin blocks, conv/norm/activation outputs for the conv
+    blocks. It is only meant to rank stages and compare against a budget, not to be byte exact.
+
+    Returns:
+        dict name -> (bytes_without_checkpoint, bytes_with_checkpoint)
+    """
+    img_size = np.array(img_size)
+    if len(img_size) not in (2, 3):
+        raise ValueError("img_size should be 2D or 3D")
+    out = {}
+    for i, stage in enumerate(SWIN_STAGES):
+        res = np.maximum(img_size // 2 ** (i + 1), 1)
+        win = np.minimum(res, window_size)
+        tokens = int(np.prod(np.ceil(res / win) * win))
+        n = int(np.prod(win))
+        dim = feature_size * 2**i
+        block = tokens * dim * (10 + 2 * mlp_ratio) + tokens * num_heads[i] * n * 2
+        full = depths[i] * block
+        ckpt = depths[i] * 2 * tokens * dim
+        out[stage] = (full * batch_size * bytes_per_el, ckpt * batch_size * bytes_per_el)
+    for name in UNETR_BLOCKS:
+        factor, mult = _UNETR_GEOMETRY[name]
+        voxels = int(np.prod(np.maximum(img_size // factor, 1)))
+        channels = feature_size * mult
+        per_el = 11 if name.startswith("decoder") else 8
+        full = per_el * channels * voxels
+        # recomputation of a single block is transient, only the inputs stay resident between blocks
+        ckpt = 2 * channels * voxels
+        out[name] = (full * batch_size * bytes_per_el, ckpt * batch_size * bytes_per_el)
+    return out
+
+
+def auto_checkpoint_policy(img_size, feature_size, budget_mb, batch_size=1, amp=False, **kwargs):
+    """
+    Pick the smallest set of stages to checkpoint so that the estimated activation memory fits ``budget_mb``.
+
+    Stages are added greedily in order of the memory they save, so recomputation is only paid where it
+    buys the most memory.
+    """
+    estimate = estimate_activation_bytes(
+        img_size, feature_size, batch_size=batch_size, bytes_per_el=2 if amp else 4, **kwargs
+    )
+    budget = budget_mb * 2**20
+    total = sum(full for full, _ in estimate.values())
+    chosen = []
+    for name in sorted(estimate, key=lambda k: estimate[k][1] - estimate[k][0]):
+        if total <= budget:
+            break
+        full, ckpt = estimate[name]
+        total -= full - ckpt
+        chosen.append(name)
+    if total > budget:
+        print("Estimated activations {:.0f}MB exceed budget {:.0f}MB even with full checkpointing".format(
+            total / 2**20, budget_mb))
+    return chosen
@@ -0,0 +1,156 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import traceback
+
+import numpy as np
+import torch
+
+from utils.inference import get_window_grid
+
+
+def split_threads(workers, cores=None):
+    """
+    Intra-op threads per worker when ``cores`` (default all) are divided among ``workers`` model replicas.
+    """
+    cores = cores or os.cpu_count() or 1
+    return max(cores // workers, 1)
+
+
+def _worker_loop(rank, threads, inferer, tasks, results, lock):
+    torch.set_num_threads(threads)
+    volume_path, volume = None, None
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        path, acc_path, rows, skipped = task
+        try:
+            start = time.time()
+            if path != volume_path:
+                volume_path, volume = path, np.load(path, mmap_mode="r")
+            # opened per task, the file goes away with the fragment
+            shared = np.load(acc_path, mmap_mode="r+")
+            h = inferer.roi_size[0]
+            y0, y1 = min(rows), min(max(rows) + h, volume.shape[1])
+            # predict into a private band, then add it to the shared sums in one locked step
+            acc = np.zeros((max(rows) + h - y0, shared.shape[2]), dtype=np.float32)
+            weight = np.zeros_like(acc)
+            n_windows = inferer.predict_rows(volume, rows, skipped, acc, weight, y0)
+            with lock:
+                shared[0, y0:y1] += acc[: y1 - y0]
+                shared[1, y0:y1] += weight[: y1 - y0]
+            del shared
+            results.put((rank, n_windows, time.time() - start, None))
+        except Exception:
+            results.put((rank, 0, 0.0, traceback.format_exc()))
+
+
+class CPUInferencePool(object):
+    """
+    Runs a :py:class:`utils.inference.StreamingInferer` in ``workers`` forked processes, each with
+    ``threads_per_worker`` intra-op threads, for CPU boxes where one process stops scaling after a few cores.
+
+    The model weights are moved to shared memory before forking, so the replicas share one copy. A fragment's window
+    rows are split into bands of ``band_rows`` rows that the workers take from a queue; each worker adds its blended
+    band into shared ``(2, H, W)`` float32 sums (probability * weight, weight) memmapped in ``tmp_dir``, and the sums
+    are normalised into ``output`` at the end. Linux only (fork start method).
+
+    Args:
+        inferer: configured streaming inferer, its predictor is the model shared by the workers.
+        workers: number of worker processes.
+        threads_per_worker: ``torch.set_num_threads`` of each worker, default the cores divided among the workers.
+        band_rows: window rows per task, default about four tasks per worker and fragment.
+        tmp_dir: directory of the shared sums, default ``/dev/shm`` when it exists.
+    """
+
+    def __init__(self, inferer, workers=4, threads_per_worker=None, band_rows=None, tmp_dir=None):
+        self.inferer = inferer
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker or split_threads(workers)
+        self.band_rows = band_rows
+        self.tmp_dir = tmp_dir or ("/dev/shm" if os.path.isdir("/dev/shm") else None)
+        if isinstance(inferer.predictor, torch.nn.Module):
+            inferer.predictor.share_memory()
+        ctx = multiprocessing.get_context("fork")
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.lock = ctx.Lock()
+        self.processes = [
+            ctx.Process(
+                target=_worker_loop,
+                args=(rank, self.threads_per_worker, inferer, self.tasks, self.results, self.lock),
+                daemon=True,
+            )
+            for rank in range(workers)
+        ]
+        for p in self.processes:
+            p.start()
+
+    def __call__(self, volume, output, mask=None):
+        """
+        Same as ``StreamingInferer.__call__``, ``volume`` has to be a memmapped ``.npy`` (workers open it by path).
+        The returned stats also hold ``worker_windows_per_s``, one entry per worker.
+        """
+        if getattr(volume, "filename", None) is None:
+            raise ValueError("CPUInferencePool needs a memmapped volume (np.load(path, mmap_mode='r'))")
+        start_time = time.time()
+        inferer = self.inferer
+        image_shape = tuple(volume.shape[1:])
+        grid = get_window_grid(image_shape, inferer.roi_size, inferer.overlap)
+        skipped, n_masked = inferer.skipped_windows(grid, mask)
+        rows = {}
+        for y, x in grid:
+            rows.setdefault(y, []).append(x)
+        ys = sorted(rows)
+        band_rows = self.band_rows or max(len(ys) // (4 * self.workers), 1)
+        tmp = tempfile.mkdtemp(prefix="cpu_pool_", dir=self.tmp_dir)
+        try:
+            acc_path = os.path.join(tmp, "sums.npy")
+            width = max(image_shape[1], inferer.roi_size[1])
+            sums = np.lib.format.open_memmap(acc_path, mode="w+", dtype=np.float32, shape=(2, image_shape[0], width))
+            sums.flush()
+            n_tasks = 0
+            for i in range(0, len(ys), band_rows):
+                band = {y: rows[y] for y in ys[i: i + band_rows]}
+                band_skipped = {s for s in skipped if s[0] in band}
+                self.tasks.put((volume.filename, acc_path, band, band_skipped))
+                n_tasks += 1
+            windows = np.zeros(self.workers, dtype=np.int64)
+            busy = np.zeros(self.workers)
+            errors = []
+            for _ in range(n_tasks):
+                # collect every task, even after a failure, so no stale result is left for the next fragment
+                rank, n_windows, elapsed, error = self.results.get()
+                if error is not None:
+                    errors.append("inference worker {} failed:\n{}".format(rank, error))
+                windows[rank] += n_windows
+                busy[rank] += elapsed
+            if errors:
+                raise RuntimeError(errors[0])
+            for r in range(0, image_shape[0], 1024):
+                n = min(1024, image_shape[0] - r)
+                inferer._flush(output, sums[0, r: r + n], sums[1, r: r + n], r, n, image_shape)
+            if hasattr(output, "flush"):
+                output.flush()
+            del sums
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        elapsed = time.time() - start_time
+        return {
+            "windows": int(windows.sum()),
+            "skipped": len(skipped),
+            "masked": n_masked,
+            "filtered": len(skipped) - n_masked,
+            "time": elapsed,
+            "windows_per_s": windows.sum() / max(elapsed, 1e-8),
+            "worker_windows_per_s": (windows / np.maximum(busy, 1e-8)).tolist(),
+        }
+
+    def close(self):
+        for _ in self.processes:
+            self.tasks.put(None)
+        for p in self.processes:
+            p.join()
@@ -17,6 +17,7 @@ import torch
 
 from monai import data
 from monai.data import load_decathlon_datalist
+from utils.distillation import add_teacher_cache
 from utils.utils import get_transforms
 
 class Sampler(torch.utils.data.Sampler):
@@ -37,6 +38,7 @@ class Sampler(torch.utils.data.Sampler):
         self.num_replicas = num_replicas
         self.rank = rank
         self.epoch = 0
+        self.start_index = 0
         self.num_samples = int(
             math.ceil(len(self.dataset) * 1.0 / self.num_replicas))
         self.total_size = self.num_samples * self.num_replicas
@@ -45,9 +47,9 @@ class Sampler(torch.utils.data.Sampler):
             indices[self.rank: self.total_size: self.num_replicas])
 
     def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.epoch)
         if self.shuffle:
-            g = torch.Generator()
-            g.manual_seed(self.epoch)
             indices = torch.randperm(len(self.dataset), generator=g).tolist()
         else:
             indices = list(range(len(self.dataset)))
@@ -56,19 +58,52 @@ class Sampler(torch.utils.data.Sampler):
                 if self.total_size - len(indices) < len(indices):
                     indices += indices[: (self.total_size - len(indices))]
                 else:
-                    extra_ids = np.random.randint(low=0, high=len(
-                        indices), size=self.total_size - len(indices))
+                    extra_ids = torch.randint(low=0, high=len(
+                        indices), size=(self.total_size - len(indices),), generator=g).tolist()
                     indices += [indices[ids] for ids in extra_ids]
             assert len(indices) == self.total_size
         indices = indices[self.rank: self.total_size: self.num_replicas]
         self.num_samples = len(indices)
-        return iter(indices)
+        return iter(indices[self.start_index:])
 
     def __len__(self):
-        return self.num_samples
+        return self.num_samples - self.start_index
 
     def set_epoch(self, epoch):
         self.epoch = epoch
+        self.start_index = 0
+
+    def set_start_index(self, start_index):
+        """
+        Skip the first ``start_index`` samples of this rank in the current epoch, used to resume mid-epoch.
+        Reset by the next :py:meth:`set_epoch`.
+        """
+        self.start_index = start_index
+
+
+class SeededDataset(torch.utils.data.Dataset):
+    """
+    Training dataset wrapper that seeds the random transforms of every sample from ``(seed, epoch, index)``.
+
+    Crops and augmentations then depend neither on the loader worker a sample lands on nor on the RNG state when the
+    loader iterator was created, so resuming mid-epoch draws the same samples the interrupted run would have.
+    """
+
+    def __init__(self, dataset, seed=0):
+        self.dataset = dataset
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __getitem__(self, index):
+        state = np.random.SeedSequence([self.seed, self.epoch, index]).generate_state(1)[0]
+        self.dataset.transform.set_random_state(seed=int(state))
+        return self.dataset[index]
 
 
 def get_loader(args):
@@ -88,20 +123,29 @@ def get_loader(args):
     else:
         datalist = load_decathlon_datalist(
             datalist_json, True, "training", base_dir=data_dir)
+        if getattr(args, "teacher_cache", None):
+            # value scale of the cached maps, read back by CachedTeacher
+            args.teacher_scale = add_teacher_cache(datalist, args.teacher_cache)
+        seed = getattr(args, "seed", 0)
         if args.use_normal_dataset:
             train_ds = data.Dataset(data=datalist, transform=train_transform)
         else:
+            # no replacement cycle is started, so the cached subset is fixed by the seed
             train_ds = data.SmartCacheDataset(
-                data=datalist, transform=train_transform, cache_rate=0.2, num_init_workers=args.workers
+                data=datalist, transform=train_transform, cache_rate=0.2, num_init_workers=args.workers, seed=seed
             )
-        train_sampler = Sampler(train_ds) if args.distributed else None
+        train_ds = SeededDataset(train_ds, seed=seed)
+        # the sampler is also used on a single gpu so the epoch order is reproducible when resuming
+        train_sampler = Sampler(train_ds) if args.distributed else Sampler(train_ds, num_replicas=1, rank=0)
         train_loader = data.DataLoader(
             train_ds,
             batch_size=1,
-            shuffle=True,
+            shuffle=False,
             num_workers=args.workers,
             sampler=train_sampler,
             pin_memory=True,
+            # worker seeds come from here instead of the global torch RNG, which is restored on resume
+            generator=torch.Generator().manual_seed(seed),
         )
         val_files = load_decathlon_datalist(
             datalist_json, True, "validation", base_dir=data_dir)
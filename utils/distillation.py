@@ -0,0 +1,157 @@
+import copy
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from utils.threshold_metrics import ThresholdHistogram
+
+# model modes whose (B, 65, H, W) windows a 2D student shares, so one batch feeds teacher and student
+TEACHER_MODES = ("2dswin", "25dswin", "2dunet")
+
+
+class DistillationLoss(nn.Module):
+    """
+    ``(1 - alpha) * hard_loss(logits, target) + alpha * T^2 * BCE(logits / T, sigmoid(teacher_logits / T))``.
+
+    The soft term is the binary form of Hinton's temperature-scaled distillation, the ``T^2`` keeps its gradient
+    scale independent of ``temperature``. Without ``teacher_logits`` only the hard loss is returned.
+    """
+
+    def __init__(self, hard_loss, alpha=0.5, temperature=1.0):
+        super().__init__()
+        if not 0.0 <= alpha <= 1.0:
+            raise ValueError("distillation alpha should be in [0, 1], got {}".format(alpha))
+        self.hard_loss = hard_loss
+        self.alpha = alpha
+        self.temperature = temperature
+
+    def forward(self, logits, target, teacher_logits=None):
+        hard = self.hard_loss(logits, target)
+        if teacher_logits is None or self.alpha == 0:
+            return hard
+        t = self.temperature
+        soft_target = torch.sigmoid(teacher_logits.float() / t)
+        soft = F.binary_cross_entropy_with_logits(logits.float() / t, soft_target) * (t * t)
+        return (1 - self.alpha) * hard + self.alpha * soft
+
+
+class OnlineTeacher(object):
+    """
+    Frozen teacher model run on every training batch, returns its logits.
+    """
+
+    def __init__(self, model):
+        self.model = model.eval()
+        for param in self.model.parameters():
+            param.requires_grad_(False)
+
+    def __call__(self, batch_data, data):
+        with torch.no_grad():
+            return self.model(data)
+
+
+class CachedTeacher(object):
+    """
+    Teacher probabilities read from the ``"teacher"`` key of the batch (see :py:func:`add_teacher_cache`), turned
+    back into logits. ``scale`` maps the stored values to [0, 1], 1 / 255 for uint8 maps.
+    """
+
+    def __init__(self, scale=1.0, eps=1e-4):
+        self.scale = scale
+        self.eps = eps
+
+    def __call__(self, batch_data, data):
+        prob = batch_data["teacher"][:, 0:1].to(data.device).float() * self.scale
+        return torch.logit(prob, eps=self.eps)
+
+
+def add_teacher_cache(datalist, cache_dir):
+    """
+    Point every training item at its cached teacher map ``<cache_dir>/<image name>_prob.npy``, as written by
+    ``test.py --streaming --split training`` with the teacher checkpoint. Returns the value scale of the maps.
+    """
+    scale = None
+    for item in datalist:
+        image = item["image"][0] if isinstance(item["image"], list) else item["image"]
+        path = os.path.join(cache_dir, os.path.basename(image).replace(".npy", "") + "_prob.npy")
+        if not os.path.exists(path):
+            raise FileNotFoundError("no cached teacher probabilities for {} at {}".format(image, path))
+        item["teacher"] = path
+        if scale is None:
+            scale = 1.0 / 255 if np.load(path, mmap_mode="r").dtype == np.uint8 else 1.0
+    return scale if scale is not None else 1.0
+
+
+def load_teacher(args, device):
+    """
+    Frozen teacher of ``--teacher_mode`` from the ``--teacher_model`` checkpoint (a path, or a name in
+    ``--pretrained_dir``), built like the student by ``get_model`` on the same windows.
+    """
+    from utils.myModel import get_model
+
+    if args.teacher_mode not in TEACHER_MODES:
+        raise ValueError("teacher_mode should be one of {}, the student's 2D windows".format(list(TEACHER_MODES)))
+    teacher_args = copy.copy(args)
+    teacher_args.model_mode = args.teacher_mode
+    teacher_args.slice_band = args.teacher_slice_band
+    model = get_model(teacher_args)
+    if hasattr(model, "set_checkpoint_policy"):
+        model.set_checkpoint_policy("none")
+    path = args.teacher_model
+    if not os.path.exists(path):
+        path = os.path.join(args.pretrained_dir, path)
+    model.load_state_dict(torch.load(path, map_location="cpu")["state_dict"])
+    return model.to(device).eval()
+
+
+def compare_models(models, loader, inferer_fn, device, verbose=True):
+    """
+    Validation throughput against accuracy of ``(name, model)`` pairs of the 2D layout: tiled inference over every
+    ``loader`` item through ``inferer_fn(model)`` (see ``utils.utils.get_inferer``), timed, then params, Mpixel/s,
+    Dice at 0.5 and the best F0.5 with its threshold per model. Returns the rows as dicts, printed with ``verbose``.
+    """
+    rows = []
+    for name, model in models:
+        model.eval()
+        inferer = inferer_fn(model)
+        hist = ThresholdHistogram()
+        elapsed = 0.0
+        with torch.no_grad():
+            for batch_data in loader:
+                data, target = batch_data["image"], batch_data["inklabels"][:, 0:1]
+                mask = batch_data.get("label")
+                mask = mask[:, 0:1] if mask is not None else None
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                start = time.time()
+                if getattr(inferer, "uses_mask", False):
+                    logits = inferer(data.to(device), mask=mask)
+                else:
+                    logits = inferer(data.to(device))
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                elapsed += time.time() - start
+                hist.update(torch.sigmoid(logits.float()).cpu(), target.cpu())
+        best_t, best_f = hist.best("f0.5")
+        pixels = int(hist.pos.sum() + hist.neg.sum())
+        rows.append({
+            "name": name,
+            "params": sum(p.numel() for p in model.parameters()),
+            "time": elapsed,
+            "mpixel_s": pixels / max(elapsed, 1e-8) / 1e6,
+            "dice": float(hist.dice()[hist.at(0.5)]),
+            "f05": float(best_f),
+            "threshold": float(best_t),
+        })
+    if not verbose:
+        return rows
+    print("{:<10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        "model", "params (M)", "time (s)", "Mpixel/s", "dice@0.5", "best f0.5", "threshold"))
+    for row in rows:
+        print("{:<10} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.4f} {:>10.4f} {:>10.3f}".format(
+            row["name"], row["params"] / 1e6, row["time"], row["mpixel_s"], row["dice"], row["f05"], row["threshold"]))
+    return rows
@@ -0,0 +1,85 @@
+import copy
+
+import torch
+from torch.func import functional_call, stack_module_state, vmap
+
+
+def _state_bytes(model):
+    return sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+
+
+class EnsemblePredictor(torch.nn.Module):
+    """
+    Averages the logits of K models of the same architecture on every window batch, so each window is read,
+    normalised and transferred once for all members.
+
+    With ``mode="vmap"`` the members' parameters are stacked and evaluated with ``torch.func.functional_call``
+    under ``vmap`` in a single call; ``mode="loop"`` runs the members one after the other on the same input
+    and keeps a running sum (less peak memory, no vmap restrictions).
+
+    Args:
+        models: list of models, already in eval mode and on the inference device.
+        mode: ``"vmap"`` or ``"loop"``.
+    """
+
+    def __init__(self, models, mode="vmap"):
+        super().__init__()
+        if mode not in ("vmap", "loop"):
+            raise ValueError("ensemble mode should be 'vmap' or 'loop'")
+        self.mode = mode
+        self.num_members = len(models)
+        if mode == "vmap":
+            self.stacked_params, self.stacked_buffers = stack_module_state(models)
+            # structure only, the weights come from the stacked tensors
+            self.base = [copy.deepcopy(models[0]).to("meta")]
+        else:
+            self.members = torch.nn.ModuleList(models)
+
+    def weight_bytes(self):
+        if self.mode == "vmap":
+            tensors = list(self.stacked_params.values()) + list(self.stacked_buffers.values())
+            return sum(t.numel() * t.element_size() for t in tensors)
+        return sum(_state_bytes(m) for m in self.members)
+
+    def _call_member(self, params, buffers, x):
+        return functional_call(self.base[0], (params, buffers), (x,))
+
+    def forward(self, x):
+        if self.mode == "vmap":
+            logits = vmap(self._call_member, in_dims=(0, 0, None))(self.stacked_params, self.stacked_buffers, x)
+            return logits.float().mean(0)
+        out = None
+        for member in self.members:
+            logits = member(x).float()
+            out = logits if out is None else out + logits
+        return out / self.num_members
+
+
+def load_ensemble(checkpoints, build_model, device, mode="vmap"):
+    """
+    Load every checkpoint (``{"state_dict": ...}`` as written by the trainer) into a model from ``build_model``
+    and wrap them in an :py:class:`EnsemblePredictor`. Prints the memory each added member costs.
+    """
+    device = torch.device(device)
+    models = []
+    for i, path in enumerate(checkpoints):
+        before = torch.cuda.memory_allocated(device) if device.type == "cuda" else None
+        model = build_model()
+        model.load_state_dict(torch.load(path, map_location="cpu")["state_dict"])
+        model.eval()
+        model.to(device)
+        models.append(model)
+        if before is not None:
+            added = torch.cuda.memory_allocated(device) - before
+        else:
+            added = _state_bytes(model)
+        print("Ensemble member {} ({}): +{:.1f} MB".format(i, path, added / 2 ** 20))
+    ensemble = EnsemblePredictor(models, mode=mode)
+    if mode == "vmap":
+        # the stacked copies replace the per-member weights
+        del models
+        if device.type == "cuda":
+            torch.cuda.empty_cache()
+    total = torch.cuda.memory_allocated(device) if device.type == "cuda" else ensemble.weight_bytes()
+    print("Ensemble of {} members ({}): {:.1f} MB of weights".format(len(checkpoints), mode, total / 2 ** 20))
+    return ensemble
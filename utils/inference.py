@@ -0,0 +1,451 @@
+import functools
+import itertools
+import time
+
+import numpy as np
+import torch
+
+from utils.mask_pyramid import MaskPyramid
+
+
+def window_starts(size, roi, overlap=0.0):
+    """
+    Start offsets of sliding windows along one axis, the last window is aligned to the end like MONAI's
+    ``dense_patch_slices``.
+    """
+    if size <= roi:
+        return [0]
+    stride = max(int(roi * (1 - overlap)), 1)
+    starts = list(range(0, size - roi + 1, stride))
+    if starts[-1] != size - roi:
+        starts.append(size - roi)
+    return starts
+
+
+def _per_dim(overlap, ndim):
+    if isinstance(overlap, (int, float)):
+        return (float(overlap),) * ndim
+    overlap = tuple(float(o) for o in overlap)
+    if len(overlap) != ndim:
+        raise ValueError("overlap {} does not match {} spatial dims".format(overlap, ndim))
+    return overlap
+
+
+@functools.lru_cache(maxsize=64)
+def _window_grid(image_shape, roi_size, overlap):
+    return tuple(itertools.product(*[window_starts(s, r, o) for s, r, o in zip(image_shape, roi_size, overlap)]))
+
+
+def get_window_grid(image_shape, roi_size, overlap=0.0):
+    """
+    Window starts in row-major order over ``image_shape``. ``overlap`` is a fraction or one fraction per dim,
+    e.g. ``(0.5, 0.5, 0)`` to overlap in y/x only. Grids are cached, tiles of the same shape share one.
+    """
+    image_shape, roi_size = tuple(image_shape), tuple(roi_size)
+    return _window_grid(image_shape, roi_size, _per_dim(overlap, len(roi_size)))
+
+
+@functools.lru_cache(maxsize=16)
+def _importance_map(roi_size, mode, sigma_scale, blended_dims):
+    if mode not in ("constant", "gaussian", "cosine"):
+        raise ValueError("blend mode should be 'constant', 'gaussian' or 'cosine', got {}".format(mode))
+    weight = np.ones((), dtype=np.float32)
+    for r, blended in zip(roi_size, blended_dims):
+        if not blended or mode == "constant":
+            w = np.ones(r)
+        elif mode == "gaussian":
+            w = np.exp(-0.5 * ((np.arange(r) - (r - 1) / 2.0) / (sigma_scale * r)) ** 2)
+        else:
+            w = 0.5 - 0.5 * np.cos(2 * np.pi * (np.arange(r) + 0.5) / r)
+        weight = np.multiply.outer(weight, w.astype(np.float32))
+    weight /= weight.max()
+    # keep the window borders from dividing by ~0 where they are not overlapped
+    weight = np.maximum(weight, 1e-3).astype(np.float32)
+    weight.flags.writeable = False
+    return weight
+
+
+def get_importance_map(roi_size, mode="gaussian", sigma_scale=0.125, overlap=0.0):
+    """
+    Blending weight of one window, cached per ``(roi_size, mode, sigma_scale)``. The weight is constant along dims
+    without overlap (e.g. depth), where there is nothing to blend.
+    """
+    roi_size = tuple(roi_size)
+    blended = tuple(o > 0 for o in _per_dim(overlap, len(roi_size)))
+    return _importance_map(roi_size, mode, float(sigma_scale), blended)
+
+
+class StreamingInferer(object):
+    """
+    Sliding window inference over a surface volume that never holds more than one band of window rows in memory.
+
+    Windows are read straight from a ``(C, H, W)`` array (an ``np.load(..., mmap_mode="r")`` memmap or any
+    chunked array supporting slicing), scaled like ``ScaleIntensityRanged`` and run through ``predictor`` in
+    batches of ``sw_batch_size``. Overlapping outputs are blended into a ``roi_h x W`` accumulator; rows that no
+    later window can touch are flushed to ``output`` as uint8 (probability * 255) or float16.
+
+    Args:
+        predictor: callable mapping a batch of windows to logits ``(B, 1, h, w)`` or ``(B, 1, h, w, 1)``.
+        roi_size: window size ``(h, w)``.
+        sw_batch_size: windows per forward pass.
+        overlap: fraction of overlap between neighbouring windows, one value or ``(y, x)``.
+        device: device the windows are sent to.
+        layout: ``"2d"`` feeds ``(C, h, w)`` windows (MyModel2d), ``"3d"`` feeds ``(1, h, w, C)`` (MyModel).
+        depth: number of leading slices fed to the model, None for all.
+        intensity: ``(a_min, a_max, b_min, b_max)`` of the intensity scaling.
+        activation: ``"sigmoid"`` to turn logits into probabilities, None if the model already outputs them.
+        mask_threshold: windows whose fragment mask coverage is below this are not predicted, 0 disables the check.
+            As in :py:class:`TileInferer`, pixels no predicted window covers are background (probability 0) and
+            the others are blended over the windows that ran.
+        blend_mode: ``"gaussian"``, ``"cosine"`` or ``"constant"`` weighting of overlapping windows.
+        sigma_scale: gaussian sigma as a fraction of the window size.
+    """
+
+    def __init__(
+        self,
+        predictor,
+        roi_size,
+        sw_batch_size=4,
+        overlap=0.0,
+        device="cpu",
+        layout="2d",
+        depth=None,
+        intensity=(0.0, 65535.0, 0.0, 1.0),
+        activation="sigmoid",
+        mask_threshold=0.0,
+        blend_mode="gaussian",
+        sigma_scale=0.125,
+    ):
+        if layout not in ("2d", "3d"):
+            raise ValueError("layout should be '2d' or '3d'")
+        self.predictor = predictor
+        self.roi_size = tuple(roi_size)
+        self.sw_batch_size = sw_batch_size
+        self.overlap = overlap
+        self.device = torch.device(device)
+        self.layout = layout
+        self.depth = depth
+        self.intensity = intensity
+        self.activation = activation
+        self.mask_threshold = mask_threshold
+        self.blend_mode = blend_mode
+        self.sigma_scale = sigma_scale
+
+    def read_window(self, volume, y, x):
+        h, w = self.roi_size
+        patch = np.asarray(volume[: self.depth, y: y + h, x: x + w], dtype=np.float32)
+        if patch.shape[1:] != (h, w):
+            pad = ((0, 0), (0, h - patch.shape[1]), (0, w - patch.shape[2]))
+            patch = np.pad(patch, pad, mode="reflect")
+        a_min, a_max, b_min, b_max = self.intensity
+        patch = (patch - a_min) / (a_max - a_min) * (b_max - b_min) + b_min
+        np.clip(patch, b_min, b_max, out=patch)
+        if self.layout == "3d":
+            patch = patch.transpose(1, 2, 0)[None]
+        return patch
+
+    def read_mask(self, mask, y, x):
+        """
+        Fragment mask window in the layout of :py:meth:`read_window`, zero padded, for predictors that skip empty
+        Swin windows (``predictor.sparse_windows``).
+        """
+        h, w = self.roi_size
+        window = np.zeros((h, w), dtype=np.float32)
+        m = np.asarray(mask[y: y + h, x: x + w])
+        window[: m.shape[0], : m.shape[1]] = m > 0
+        return window[None] if self.layout == "2d" else window[None, :, :, None]
+
+    def window_weight(self):
+        return get_importance_map(self.roi_size, self.blend_mode, self.sigma_scale, self.overlap)
+
+    def predict(self, windows, masks=None):
+        batch = torch.from_numpy(np.stack(windows)).to(self.device)
+        with torch.no_grad():
+            if masks is not None:
+                logits = self.predictor(batch, mask=torch.from_numpy(np.stack(masks)).to(self.device))
+            else:
+                logits = self.predictor(batch)
+        if logits.dim() == 5:
+            logits = logits[..., 0]
+        logits = logits[:, 0].float()
+        if self.activation == "sigmoid":
+            logits = torch.sigmoid(logits)
+        return logits.cpu().numpy()
+
+    def _flush(self, output, acc, weight, acc_y0, rows, image_shape):
+        rows = min(rows, image_shape[0] - acc_y0)
+        if rows <= 0:
+            return
+        prob = acc[:rows, : image_shape[1]] / np.maximum(weight[:rows, : image_shape[1]], 1e-8)
+        if output.dtype == np.uint8:
+            output[acc_y0: acc_y0 + rows] = np.rint(np.clip(prob, 0, 1) * 255).astype(np.uint8)
+        else:
+            output[acc_y0: acc_y0 + rows] = prob.astype(output.dtype)
+
+    def skipped_windows(self, grid, mask=None, window_filter=None):
+        """
+        ``(skipped, n_masked)``: the set of window starts of ``grid`` that are not predicted, below the mask coverage
+        threshold or vetoed by ``window_filter(y, x)``, and how many of them the mask removed.
+        """
+        skipped = set()
+        if mask is not None and self.mask_threshold > 0:
+            pyramid = MaskPyramid(mask)
+            skipped = {s for s in grid if pyramid.window_coverage(s, self.roi_size) < self.mask_threshold}
+        n_masked = len(skipped)
+        if window_filter is not None:
+            skipped |= {s for s in grid if s not in skipped and not window_filter(*s)}
+        return skipped, n_masked
+
+    def predict_rows(self, volume, rows, skipped, acc, weight, y0=0, mask=None):
+        """
+        Add the weighted probabilities and the weights of the windows ``rows`` (``{y: [x, ...]}``) to ``acc`` and
+        ``weight``, whose first row is image row ``y0``. ``mask`` is passed on to sparse window predictors. Returns
+        the number of windows predicted.
+        """
+        h, w = self.roi_size
+        base = self.window_weight()
+        if not getattr(self.predictor, "sparse_windows", False):
+            mask = None
+        n_windows = 0
+        for y in sorted(rows):
+            r = y - y0
+            xs = [x for x in rows[y] if (y, x) not in skipped]
+            for i in range(0, len(xs), self.sw_batch_size):
+                batch_xs = xs[i: i + self.sw_batch_size]
+                masks = [self.read_mask(mask, y, x) for x in batch_xs] if mask is not None else None
+                probs = self.predict([self.read_window(volume, y, x) for x in batch_xs], masks)
+                for x, prob in zip(batch_xs, probs):
+                    acc[r: r + h, x: x + w] += prob * base
+                    # skipped windows add no weight, pixels without any stay at probability 0
+                    weight[r: r + h, x: x + w] += base
+                n_windows += len(batch_xs)
+        return n_windows
+
+    def __call__(self, volume, output, mask=None, window_filter=None):
+        """
+        Run inference on ``volume`` (``(C, H, W)``) and write the probability map into ``output`` (``(H, W)``,
+        uint8 or float). ``mask`` is the ``(H, W)`` fragment mask used to skip windows outside the papyrus,
+        ``window_filter(y, x)`` can veto further windows (e.g. :py:class:`CascadeInferer`). Pixels covered only by
+        skipped windows are background. Returns a dict of timing statistics.
+        """
+        start_time = time.time()
+        image_shape = tuple(volume.shape[1:])
+        h, w = self.roi_size
+        grid = get_window_grid(image_shape, self.roi_size, self.overlap)
+        skipped, n_masked = self.skipped_windows(grid, mask, window_filter)
+        rows = {}
+        for y, x in grid:
+            rows.setdefault(y, []).append(x)
+        width = max(image_shape[1], w)
+        acc = np.zeros((h, width), dtype=np.float32)
+        weight = np.zeros((h, width), dtype=np.float32)
+        acc_y0 = 0
+        n_windows = 0
+        for y in sorted(rows):
+            # rows above y are final: every later window starts at or below y
+            shift = y - acc_y0
+            if shift > 0:
+                self._flush(output, acc, weight, acc_y0, shift, image_shape)
+                acc = np.roll(acc, -shift, axis=0)
+                weight = np.roll(weight, -shift, axis=0)
+                acc[h - min(shift, h):] = 0
+                weight[h - min(shift, h):] = 0
+                acc_y0 = y
+            n_windows += self.predict_rows(volume, {y: rows[y]}, skipped, acc, weight, acc_y0, mask=mask)
+        self._flush(output, acc, weight, acc_y0, h, image_shape)
+        if hasattr(output, "flush"):
+            output.flush()
+        elapsed = time.time() - start_time
+        return {
+            "windows": n_windows,
+            "skipped": len(skipped),
+            "masked": n_masked,
+            "filtered": len(skipped) - n_masked,
+            "time": elapsed,
+            "windows_per_s": n_windows / max(elapsed, 1e-8),
+        }
+
+
+class CascadeInferer(object):
+    """
+    Coarse-to-fine inference for sparse ink.
+
+    ``coarse`` (a :py:class:`StreamingInferer`, e.g. the same or a smaller model) first predicts a heatmap on the
+    volume subsampled by ``scale`` in y/x; ``fine`` then runs only on windows whose coarse score (max of the heatmap
+    over the window) reaches ``threshold``, the other windows are background.
+
+    Args:
+        coarse: inferer of the first stage.
+        fine: full resolution inferer.
+        scale: y/x subsampling of the first stage input.
+        threshold: minimum coarse probability for a window to be refined.
+    """
+
+    def __init__(self, coarse, fine, scale=4, threshold=0.1):
+        self.coarse = coarse
+        self.fine = fine
+        self.scale = scale
+        self.threshold = threshold
+
+    def coarse_heatmap(self, volume, mask=None):
+        s = self.scale
+        # strided views of a memmap stay lazy, windows are read from disk as usual
+        small = volume[:, ::s, ::s]
+        heatmap = np.zeros(small.shape[1:], dtype=np.float16)
+        stats = self.coarse(small, heatmap, mask=None if mask is None else mask[::s, ::s])
+        return heatmap, stats
+
+    def __call__(self, volume, output, mask=None):
+        heatmap, coarse_stats = self.coarse_heatmap(volume, mask)
+        s = self.scale
+        h, w = self.fine.roi_size
+
+        def refine(y, x):
+            cells = heatmap[y // s: -(-(y + h) // s), x // s: -(-(x + w) // s)]
+            return cells.size > 0 and float(cells.max()) >= self.threshold
+
+        stats = self.fine(volume, output, mask=mask, window_filter=refine)
+        total = stats["windows"] + stats["skipped"]
+        stats["coarse_time"] = coarse_stats["time"]
+        stats["cascade_skip_fraction"] = stats["filtered"] / float(max(total, 1))
+        stats["time"] += coarse_stats["time"]
+        return stats
+
+
+class TileInferer(object):
+    """
+    Sliding window inference over a batch of tiles ``(B, C, *spatial)`` that can skip windows outside the fragment
+    mask. Uses the window grid of MONAI's ``sliding_window_inference`` (with ``overlap=0`` the output is the same).
+    Pixels covered only by skipped windows are set to ``background``; pixels partly covered are blended over the
+    windows that ran.
+
+    Overlapping windows are blended with a gaussian/cosine importance map. Window grids, importance maps and the
+    normalisation map are cached per tile shape, so validation tiles of one shape pay for them once.
+
+    Args:
+        predictor: model called on ``(sw_batch_size, C, *roi_size)`` windows.
+        roi_size: window size over the spatial dims, the first two are the fragment's ``(H, W)``.
+        sw_batch_size: windows per forward pass.
+        overlap: fraction of overlap between neighbouring windows, one value or one per spatial dim, e.g.
+            ``(0.5, 0.5, 0)`` to never overlap in depth.
+        device: device the blended output is kept on.
+        sw_device: device the windows are predicted on.
+        mask_threshold: windows whose mask coverage is below this are skipped, 0 disables the check.
+        padding_mode: ``torch.nn.functional.pad`` mode for tiles smaller than ``roi_size``.
+        blend_mode: ``"gaussian"``, ``"cosine"`` or ``"constant"`` weighting of overlapping windows.
+        sigma_scale: gaussian sigma as a fraction of the window size.
+        background: output value of pixels no window ran on, in the predictor's output space: a large negative
+            logit for models returning logits, 0 for models ending with a sigmoid.
+    """
+
+    uses_mask = True
+
+    def __init__(
+        self,
+        predictor,
+        roi_size,
+        sw_batch_size=8,
+        overlap=0.0,
+        device="cpu",
+        sw_device="cuda",
+        mask_threshold=0.0,
+        padding_mode="reflect",
+        blend_mode="gaussian",
+        sigma_scale=0.125,
+        background=-20.0,
+    ):
+        self.predictor = predictor
+        self.roi_size = tuple(roi_size)
+        self.sw_batch_size = sw_batch_size
+        self.overlap = overlap
+        self.device = torch.device(device)
+        self.sw_device = torch.device(sw_device)
+        self.mask_threshold = mask_threshold
+        self.padding_mode = padding_mode
+        self.background = background
+        # the cached map is read-only, torch wants its own copy
+        self.importance = torch.from_numpy(get_importance_map(self.roi_size, blend_mode, sigma_scale, overlap).copy())
+        self.importance = self.importance.to(self.device)
+        self._norm_cache = {}
+
+    def _normalization(self, padded):
+        # summed importance of all windows of a tile shape, reused by every tile of that shape
+        if padded not in self._norm_cache:
+            norm = torch.zeros(padded, device=self.device)
+            for start in get_window_grid(padded, self.roi_size, self.overlap):
+                norm[self._window(start)] += self.importance
+            self._norm_cache[padded] = norm
+        return self._norm_cache[padded]
+
+    def _pad(self, inputs):
+        before, pad = [], []
+        for s, r in zip(inputs.shape[2:], self.roi_size):
+            diff = max(r - s, 0)
+            before.append(diff // 2)
+            pad = [diff // 2, diff - diff // 2] + pad
+        if any(pad):
+            inputs = torch.nn.functional.pad(inputs, pad, mode=self.padding_mode)
+        return inputs, before
+
+    def _window(self, start):
+        return tuple(slice(s, s + r) for s, r in zip(start, self.roi_size))
+
+    def __call__(self, inputs, mask=None):
+        """
+        ``mask`` is the fragment mask of the tiles, ``(B, 1, H, W, ...)``, only its first slice is used.
+        """
+        spatial = tuple(inputs.shape[2:])
+        inputs, before = self._pad(inputs)
+        padded = tuple(inputs.shape[2:])
+        grid = get_window_grid(padded, self.roi_size, self.overlap)
+        windows = []
+        for b in range(inputs.shape[0]):
+            keep = grid
+            if mask is not None and self.mask_threshold > 0:
+                m = mask[b, 0]
+                while m.ndim > 2:
+                    m = m[..., 0]
+                pyramid = MaskPyramid(m.cpu().numpy())
+                keep = [
+                    s for s in grid
+                    if pyramid.window_coverage((s[0] - before[0], s[1] - before[1]), self.roi_size[:2])
+                    >= self.mask_threshold
+                ]
+            windows += [(b, s) for s in keep]
+        sparse_mask = None
+        if mask is not None and getattr(self.predictor, "sparse_windows", False):
+            # (B, 1, H, W) fragment mask of the padded tiles, broadcast over depth, padding counts as outside
+            sparse_mask = mask[:, :1].float()
+            while sparse_mask.dim() > 4:
+                sparse_mask = sparse_mask[..., 0]
+            pad = (before[1], padded[1] - spatial[1] - before[1], before[0], padded[0] - spatial[0] - before[0])
+            sparse_mask = torch.nn.functional.pad(sparse_mask, pad)
+            sparse_mask = sparse_mask.view(sparse_mask.shape + (1,) * (len(spatial) - 2))
+        output = None
+        # importance summed over the windows that ran, only needed when some were skipped
+        dense = len(windows) == inputs.shape[0] * len(grid)
+        coverage = None if dense else torch.zeros((inputs.shape[0], 1) + padded, device=self.device)
+        for i in range(0, max(len(windows), 1), self.sw_batch_size):
+            # with every window outside the mask one window is still run to get the output channels
+            batch = windows[i: i + self.sw_batch_size] or [(0, grid[0])]
+            data = torch.stack([inputs[(b, slice(None)) + self._window(start)] for b, start in batch])
+            if sparse_mask is not None:
+                window_mask = torch.stack([sparse_mask[(b, slice(None)) + self._window(start)] for b, start in batch])
+                logits = self.predictor(data.to(self.sw_device), mask=window_mask.to(self.sw_device))
+            else:
+                logits = self.predictor(data.to(self.sw_device))
+            logits = logits.to(self.device, torch.float32)
+            if output is None:
+                output = torch.zeros((inputs.shape[0], logits.shape[1]) + padded, device=self.device)
+            if not windows:
+                break
+            for (b, start), logit in zip(batch, logits):
+                output[(b, slice(None)) + self._window(start)] += logit * self.importance
+                if coverage is not None:
+                    coverage[(b, slice(None)) + self._window(start)] += self.importance
+        if dense:
+            output = output / self._normalization(padded)
+        else:
+            output = torch.where(coverage > 0, output / coverage.clamp_min(1e-12), torch.full_like(output, self.background))
+        crop = tuple(slice(p, p + s) for p, s in zip(before, spatial))
+        return output[(slice(None), slice(None)) + crop]
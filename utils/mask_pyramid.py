@@ -0,0 +1,69 @@
+import numpy as np
+import scipy.ndimage as ndimage
+
+
+def _block_mean(mask, factor):
+    h, w = mask.shape
+    ph, pw = -h % factor, -w % factor
+    if ph or pw:
+        mask = np.pad(mask, ((0, ph), (0, pw)))
+    return mask.reshape(mask.shape[0] // factor, factor, mask.shape[1] // factor, factor).mean(axis=(1, 3))
+
+
+class MaskPyramid(object):
+    """
+    Coarse coverage pyramid of a fragment mask (``mask.npy``, the ``label`` key).
+
+    ``levels[i]`` holds the fraction of in-mask pixels of every ``2**i x 2**i`` block for ``i >= 1`` (the full
+    resolution level 0 is not kept), so window coverage can be looked up on a level a few cells across instead of
+    summing the full resolution mask.
+
+    Args:
+        mask: ``(H, W)`` array, anything above zero is papyrus. Memmaps are read in row chunks.
+        min_size: stop adding levels once a side would be smaller than this.
+        chunk_rows: rows of ``mask`` read at a time.
+    """
+
+    def __init__(self, mask, min_size=8, chunk_rows=2048):
+        if mask.ndim != 2:
+            raise ValueError("MaskPyramid expects a (H, W) mask, got shape {}".format(mask.shape))
+        self.shape = tuple(mask.shape)
+        # level 1 straight from the (possibly memmapped) mask, chunked so the full resolution is never float
+        chunk_rows -= chunk_rows % 2
+        level1 = [_block_mean((np.asarray(mask[r: r + chunk_rows]) > 0).astype(np.float32), 2)
+                  for r in range(0, self.shape[0], chunk_rows)]
+        self.levels = [None, np.concatenate(level1, axis=0)]
+        while min(self.levels[-1].shape) // 2 >= min_size:
+            self.levels.append(_block_mean(self.levels[-1], 2))
+
+    def level_for(self, roi_size, cells=4):
+        """
+        Coarsest level that still has ``cells`` cells across the smaller side of ``roi_size``.
+        """
+        level = int(np.floor(np.log2(max(min(roi_size) / float(cells), 1.0))))
+        return min(max(level, 1), len(self.levels) - 1)
+
+    def window_coverage(self, start, roi_size, level=None):
+        """
+        Approximate fraction of in-mask pixels of the window at ``start`` (``(y, x)``) with size ``roi_size``.
+        """
+        if level is None:
+            level = self.level_for(roi_size)
+        f = 2 ** level
+        y0, x0 = start[0] // f, start[1] // f
+        y1 = max(-(-(start[0] + roi_size[0]) // f), y0 + 1)
+        x1 = max(-(-(start[1] + roi_size[1]) // f), x0 + 1)
+        cells = self.levels[level][y0:y1, x0:x1]
+        return float(cells.mean()) if cells.size else 0.0
+
+    def center_coverage(self, roi_size, level=None):
+        """
+        Coverage of a ``roi_size`` window centred on every cell of ``level``, returned with that level's factor.
+        Used to screen crop centres without touching the full resolution mask.
+        """
+        if level is None:
+            level = self.level_for(roi_size)
+        f = 2 ** level
+        size = (max(int(round(roi_size[0] / float(f))), 1), max(int(round(roi_size[1] / float(f))), 1))
+        coverage = ndimage.uniform_filter(self.levels[level], size=size, mode="constant", cval=0.0)
+        return coverage, f
@@ -1,29 +1,141 @@
+import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from monai.networks.nets import SwinUNETR, UNet
 from monai.networks.blocks.convolutions import Convolution
 
-class MyModel(nn.Module):
-    def __init__(self):
+from utils.checkpoint_policy import apply_checkpoint_policy, auto_checkpoint_policy
+from utils.pruning import resize_to_state_dict
+from utils.swin_attention import use_sdpa_attention
+from utils.sparse_windows import set_token_keep, use_sparse_windows
+from utils.swin_freeze import freeze_swin_unetr
+
+
+class _SwinWrapper(nn.Module):
+    """
+    Shared plumbing of the SwinUNETR based wrappers, subclasses set ``img_size``, ``feature_size`` and ``swinUNETR``.
+    """
+    sparse_windows = False
+
+    def set_checkpoint_policy(self, policy="swin", budget_mb=None, batch_size=1, amp=False):
+        """
+        Args:
+            policy: ``"none"``, ``"swin"``, ``"all"``, ``"auto"`` or a list of stage names,
+                see :py:func:`utils.checkpoint_policy.parse_checkpoint_policy`.
+            budget_mb: activation memory budget used by ``"auto"``.
+            batch_size: number of crops per step, used by ``"auto"``.
+            amp: whether activations are kept in half precision, used by ``"auto"``.
+        """
+        if policy == "auto":
+            if budget_mb is None:
+                raise ValueError("checkpoint policy 'auto' needs a memory budget")
+            policy = auto_checkpoint_policy(
+                self.img_size, self.feature_size, budget_mb, batch_size=batch_size, amp=amp
+            )
+        self.checkpoint_stages = apply_checkpoint_policy(self.swinUNETR, policy)
+        return self.checkpoint_stages
+
+    def set_attention(self, mode="stock", recompute=True):
+        """
+        Args:
+            mode: ``"stock"`` for MONAI's window attention, ``"sdpa"`` for
+                :py:class:`utils.swin_attention.SDPAWindowAttention` (same state dict).
+            recompute: with ``"sdpa"``, recompute the attention core in backward instead of storing it.
+        """
+        if mode not in ("stock", "sdpa"):
+            raise ValueError("attention should be 'stock' or 'sdpa', got {}".format(mode))
+        self.attention = mode
+        use_sdpa_attention(self.swinUNETR, enable=mode == "sdpa", recompute=recompute)
+        return self
+
+    def set_sparse_windows(self, enabled=True, intensity_floor=0.0):
+        """
+        Skip Swin windows over empty input in eval mode: a window runs attention and MLP only if one of its tokens
+        covers a pixel above ``intensity_floor`` (in any channel) and inside the fragment mask passed to ``forward``,
+        the others get the update of one constant window. See :py:class:`utils.sparse_windows.SparseSwinBlock`. The
+        input outside the mask is zeroed, so with ``intensity_floor=0`` the skipped input is uniform and the output
+        equals the dense one on that masked input (near the mask border it differs from the dense one on the raw
+        input). A higher floor is an approximation. Skipped and total window counts accumulate in ``sparse_stats``.
+        """
+        self.sparse_windows = enabled
+        self.intensity_floor = intensity_floor
+        self.sparse_stats = {"windows": 0, "skipped": 0}
+        use_sparse_windows(self.swinUNETR, enable=enabled, stats=self.sparse_stats)
+        return self
+
+    def sparse_report(self):
+        stats = self.sparse_stats
+        return "Sparse windows: skipped {} of {} Swin windows ({:.1%})".format(
+            stats["skipped"], stats["windows"], stats["skipped"] / max(stats["windows"], 1)
+        )
+
+    def _mask_input(self, x, mask=None):
+        # zero the input outside the fragment mask, so the windows skipped there are uniform and their update exact
+        if not self.sparse_windows or self.training or mask is None:
+            return x
+        return x * (mask > 0).to(x.dtype)
+
+    def _valid_pixels(self, x, mask=None):
+        valid = x.amax(1) > self.intensity_floor
+        if mask is not None:
+            valid = valid & (mask[:, 0] > 0)
+        return valid
+
+    def _run_swin(self, x, mask=None, valid=None):
+        if not self.sparse_windows or self.training:
+            return self.swinUNETR(x)
+        if valid is None:
+            x = self._mask_input(x, mask)
+            valid = self._valid_pixels(x, mask)
+        set_token_keep(self.swinUNETR, valid)
+        try:
+            return self.swinUNETR(x)
+        finally:
+            set_token_keep(self.swinUNETR, None)
+
+    def load_state_dict(self, state_dict, strict=True, **kwargs):
+        # checkpoints of tools/prune_model.py have smaller hidden layers, shrink ours to match first
+        resize_to_state_dict(self, state_dict)
+        return super().load_state_dict(state_dict, strict, **kwargs)
+
+    def freeze_for_inference(self, roi_size=None):
+        """
+        Specialise the Swin transformer to windows of spatial size ``roi_size`` (default ``img_size``): attention
+        bias and shifted-window masks become buffers, padding and window sizes constants, LayerNorm affines are folded
+        into the following Linears and attention uses ``scaled_dot_product_attention``. Inference only and in place,
+        see :py:func:`utils.swin_freeze.freeze_swin_unetr`.
+        """
+        self.eval()
+        self.frozen_roi = tuple(roi_size or self.img_size)
+        freeze_swin_unetr(self.swinUNETR, self.frozen_roi)
+        return self
+
+
+class MyModel(_SwinWrapper):
+    def __init__(self, img_size=(96, 96, 96), checkpoint_policy="swin", checkpoint_budget_mb=None):
         super().__init__()
-        self.model = SwinUNETR(
-            img_size=(96,96,96),
+        self.img_size = img_size
+        self.feature_size = 48
+        self.swinUNETR = SwinUNETR(
+            img_size=img_size,
             in_channels=1,
-            out_channels=14,
-            feature_size=48,
+            # single ink channel, conv2 collapses the depth of it
+            out_channels=1,
+            feature_size=self.feature_size,
             drop_rate=0.0,
             attn_drop_rate=0.0,
             dropout_path_rate=0.0,
-            use_checkpoint=True,
         )
         # self.conv1 = Convolution(spatial_dims=3, in_channels=14, out_channels=1, kernel_size=1)
         self.conv2 = Convolution(spatial_dims=3, in_channels=1, out_channels=1, kernel_size=(1, 1, 64), strides=1, padding=0, act="sigmoid")
+        self.set_checkpoint_policy(checkpoint_policy, checkpoint_budget_mb)
 
     
-    def forward(self, x):
+    def forward(self, x, mask=None):
         if x[0].size() != (1, 64, 64, 64):
             print(x.size())
             raise ValueError("Input size is not correct")
-        x_out = self.swinUNETR(x)
+        x_out = self._run_swin(x, mask)
         # x_out = self.conv1(x_out)
         x_out = self.conv2(x_out)
         return x_out
@@ -32,27 +144,112 @@ class MyModel(nn.Module):
         self.swinUNETR.load_state_dict(model_dict, strict)
         pass
     
-class MyModel2d(nn.Module):
-    def __init__(self,img_size=(192, 192)):
+class MyModel2d(_SwinWrapper):
+    def __init__(self,img_size=(192, 192), checkpoint_policy="swin", checkpoint_budget_mb=None):
         super().__init__()
+        self.img_size = img_size
+        self.feature_size = 12
         self.swinUNETR = SwinUNETR(
                                 img_size=img_size,
                                 in_channels=65,
                                 out_channels=1,
-                                feature_size=12,
-                                use_checkpoint=True, 
+                                feature_size=self.feature_size,
                                 spatial_dims=2
                                 )
+        self.set_checkpoint_policy(checkpoint_policy, checkpoint_budget_mb)
 
     
-    def forward(self, x):
-        x_out = self.swinUNETR(x)
+    def forward(self, x, mask=None):
+        x_out = self._run_swin(x, mask)
         return x_out
     
     def load_swin_ckpt(self, model_dict, strict: bool = True):
         self.swinUNETR.load_state_dict(model_dict, strict)
         pass
     
+def _stem_block(in_channels, out_channels, kernel_size, depth_stride):
+    # replicate padding keeps constant (empty) input constant up to the window edges, see set_sparse_windows
+    return nn.Sequential(
+        nn.Conv3d(
+            in_channels, out_channels, kernel_size, stride=(depth_stride, 1, 1),
+            padding=tuple(k // 2 for k in kernel_size),
+            padding_mode="replicate",
+        ),
+        nn.InstanceNorm3d(out_channels),
+        nn.PReLU(),
+    )
+
+
+class SliceStem(nn.Module):
+    """
+    Shallow 3D stem of :py:class:`MyModel25d`: the slices of a ``(B, D, H, W)`` window are a depth axis, two convs
+    reduce it 8x (65 slices -> 9) and a learned per-pixel softmax over the remaining depth collapses it to
+    ``(B, C, H, W)``. Channels are kept small, the stem adds about a quarter to the 2D trunk per pixel.
+    """
+    def __init__(self, out_channels=12, mid_channels=4):
+        super().__init__()
+        self.conv1 = _stem_block(1, mid_channels, (5, 3, 3), depth_stride=4)
+        self.conv2 = _stem_block(mid_channels, out_channels, (3, 3, 3), depth_stride=2)
+        self.score = nn.Conv3d(out_channels, 1, kernel_size=1)
+
+    def forward(self, x):
+        x = self.conv2(self.conv1(x.unsqueeze(1)))
+        weights = torch.softmax(self.score(x), dim=2)
+        return (x * weights).sum(2)
+
+
+class MyModel25d(_SwinWrapper):
+    """
+    2.5D variant: :py:class:`SliceStem` over a band of the slices, then the 2D SwinUNETR of :py:class:`MyModel2d`
+    on the collapsed features. Takes the ``(B, slices, H, W)`` windows of MyModel2d at any ``H, W``, the trunk
+    sees them zero padded to multiples of 32 (``img_size``).
+
+    Args:
+        img_size: window size ``(H, W)``.
+        slice_band: ``(start, stop)`` of the input slices fed to the stem, None for all of them.
+        stem_channels: channels of the collapsed features.
+    """
+    def __init__(self, img_size=(192, 192), slice_band=None, stem_channels=12, checkpoint_policy="swin",
+                 checkpoint_budget_mb=None):
+        super().__init__()
+        self.roi_size = tuple(img_size)
+        self.img_size = tuple(-(-s // 32) * 32 for s in img_size)
+        self.slice_band = tuple(slice_band) if slice_band is not None else None
+        self.feature_size = 12
+        self.stem = SliceStem(stem_channels)
+        self.swinUNETR = SwinUNETR(
+                                img_size=self.img_size,
+                                in_channels=stem_channels,
+                                out_channels=1,
+                                feature_size=self.feature_size,
+                                spatial_dims=2
+                                )
+        self.set_checkpoint_policy(checkpoint_policy, checkpoint_budget_mb)
+
+    def forward(self, x, mask=None):
+        if self.slice_band is not None:
+            x = x[:, self.slice_band[0]: self.slice_band[1]]
+        h, w = x.shape[2:]
+        pad = (0, -(-w // 32) * 32 - w, 0, -(-h // 32) * 32 - h)
+        if any(pad):
+            x = F.pad(x, pad)
+            mask = F.pad(mask, pad) if mask is not None else None
+        valid = None
+        if self.sparse_windows and not self.training:
+            x = self._mask_input(x, mask)
+            # the stem mixes 2 pixels on each side into a feature, so do not skip tokens next to valid pixels
+            valid = F.max_pool2d(self._valid_pixels(x, mask).float().unsqueeze(1), 5, stride=1, padding=2)[:, 0] > 0
+        x_out = self._run_swin(self.stem(x), valid=valid)
+        return x_out[:, :, :h, :w]
+
+    def freeze_for_inference(self, roi_size=None):
+        roi_size = tuple(-(-s // 32) * 32 for s in roi_size) if roi_size is not None else None
+        return super().freeze_for_inference(roi_size)
+
+    def load_swin_ckpt(self, model_dict, strict: bool = True):
+        self.swinUNETR.load_state_dict(model_dict, strict)
+
+
 class MyModel3dunet(nn.Module):
     def __init__(self) -> None:
         super().__init__()
@@ -67,4 +264,53 @@ class MyModel3dunet(nn.Module):
     
     def forward(self, x):
         x_out = self.unet(x)
-        return x_out
\ No newline at end of file
+        return x_out
+
+
+class MyModel2dunet(nn.Module):
+    """
+    2D counterpart of :py:class:`MyModel3dunet` on the 65 slices as channels, the small student of
+    ``main.py --teacher_model``. Input sides must be multiples of 8.
+    """
+    def __init__(self, in_channels=65, channels=(16, 32, 64, 128), num_res_units=2) -> None:
+        super().__init__()
+        self.unet = UNet(
+            spatial_dims=2,
+            in_channels=in_channels,
+            out_channels=1,
+            channels=channels,
+            strides=(2,) * (len(channels) - 1),
+            num_res_units=num_res_units,
+        )
+
+    def forward(self, x):
+        x_out = self.unet(x)
+        return x_out
+
+
+def get_model(args):
+    if args.model_mode == "3dswin":
+        model = MyModel(img_size=(args.roi_x,args.roi_y,args.roi_y))
+    elif args.model_mode == "2dswin":
+        model = MyModel2d(img_size=(args.roi_x,args.roi_y))
+    elif args.model_mode == "25dswin":
+        model = MyModel25d(img_size=(args.roi_x,args.roi_y), slice_band=parse_slice_band(args.slice_band))
+    elif args.model_mode == "3dunet":
+        model = MyModel3dunet()
+    elif args.model_mode == "2dunet":
+        model = MyModel2dunet()
+    else:
+        raise ValueError("model mode error")
+    return model
+
+
+def parse_slice_band(band):
+    """
+    ``"start,stop"`` of ``--slice_band`` to a tuple, None or an empty string for every slice.
+    """
+    if not band:
+        return None
+    start, stop = (int(v) for v in band.split(","))
+    if not 0 <= start < stop:
+        raise ValueError("slice band should be 'start,stop' with 0 <= start < stop, got {}".format(band))
+    return start, stop
@@ -3,7 +3,9 @@ from monai.transforms.transform import MapTransform
 from monai.config import KeysCollection
 from typing import Dict, Hashable, Mapping
 from monai.config.type_definitions import NdarrayOrTensor
+import numpy as np
 import torch
+from utils.mask_pyramid import MaskPyramid
 
 class remove_channel(Transform):
     def __init__(self):
@@ -209,4 +211,49 @@ class CustomPadd(MapTransform):
         d = dict(data)
         for key in self.key_iterator(d):
             d[key] = self.adder(d[key])
-        return d
\ No newline at end of file
+        return d
+
+class MaskedCropIndicesd(MapTransform):
+    """
+    Precompute the crop centre indices of :py:class:`monai.transforms.RandCropByPosNegLabeld` and drop negative
+    centres whose crop would lie mostly outside the fragment mask.
+
+    Positives are the ink pixels of ``keys``, negatives the remaining pixels whose ``spatial_size`` window has at
+    least ``threshold`` mask coverage, looked up on a coarse :py:class:`utils.mask_pyramid.MaskPyramid` level.
+    The indices are stored as ``<key>_fg_indices``/``<key>_bg_indices`` (flattened over the ``(H, W, D)`` spatial
+    shape, centred in depth) for ``fg_indices_key``/``bg_indices_key``. The transform is deterministic, so cached
+    datasets keep the indices instead of recomputing them for every crop.
+    """
+    def __init__(self, keys: KeysCollection, mask_key="label", spatial_size=(96, 96, 96), threshold=0.1) -> None:
+        """
+        Args:
+            keys: label keys of ``(1, H, W, D)`` ink labels, e.g. ``"inklabels"``.
+            mask_key: key of the ``(1, H, W, D)`` fragment mask.
+            spatial_size: crop size of the following RandCropByPosNegLabeld.
+            threshold: minimum mask coverage of a negative crop, 0 keeps every negative centre.
+        """
+        super().__init__(keys, )
+        self.mask_key = mask_key
+        self.spatial_size = spatial_size
+        self.threshold = threshold
+
+    def __call__(self, data: Mapping[Hashable, NdarrayOrTensor]) -> Dict[Hashable, NdarrayOrTensor]:
+        d = dict(data)
+        for key in self.key_iterator(d):
+            label = np.asarray(d[key][0])
+            spatial = label.shape
+            ink = label[..., 0] > 0
+            ys, xs = np.nonzero(ink)
+            fg = np.ravel_multi_index((ys, xs, np.full_like(ys, spatial[2] // 2)), spatial)
+            ys, xs = np.nonzero(~ink)
+            if self.threshold > 0:
+                pyramid = MaskPyramid(np.asarray(d[self.mask_key][0][..., 0]))
+                coverage, f = pyramid.center_coverage(self.spatial_size[:2])
+                inside = coverage[ys // f, xs // f] >= self.threshold
+                # a tile without enough papyrus keeps all its negatives rather than failing the crop
+                if inside.any():
+                    ys, xs = ys[inside], xs[inside]
+            bg = np.ravel_multi_index((ys, xs, np.full_like(ys, spatial[2] // 2)), spatial)
+            d[key + "_fg_indices"] = fg
+            d[key + "_bg_indices"] = bg
+        return d
@@ -0,0 +1,182 @@
+import json
+import os
+import zlib
+
+import numpy as np
+
+META_NAME = "meta.json"
+INDEX_NAME = "index.npy"
+DATA_NAME = "tiles.bin"
+
+
+class ProbStoreWriter(object):
+    """
+    Writes a fragment probability map as uint8 (probability * 255) tiles into a directory:
+    ``meta.json`` (shape, tile size, compression), ``index.npy`` (``(ny, nx, 2)`` offset/length of every tile) and
+    ``tiles.bin`` (the tiles, zlib compressed or raw). Tiles without any ink probability are not stored.
+
+    Rows must be written top to bottom (``writer[y0:y1] = rows``), which is what
+    :py:class:`utils.inference.StreamingInferer` does, so the writer can be passed as its ``output``. Only one row
+    of tiles is buffered. The store is complete once the last row is written.
+
+    Args:
+        path: store directory, created if needed.
+        shape: ``(H, W)`` of the fragment.
+        tile: tile size ``(th, tw)``.
+        compression: ``"zlib"`` or ``"none"`` (raw tiles can be viewed straight from the memory map).
+        level: zlib level, low levels are fast and already compress background well.
+    """
+
+    dtype = np.dtype(np.uint8)
+
+    def __init__(self, path, shape, tile=(256, 256), compression="zlib", level=1):
+        if compression not in ("zlib", "none"):
+            raise ValueError("compression should be 'zlib' or 'none'")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.shape = tuple(int(s) for s in shape)
+        self.tile = tuple(int(t) for t in tile)
+        self.compression = compression
+        self.level = level
+        self.grid = (-(-self.shape[0] // self.tile[0]), -(-self.shape[1] // self.tile[1]))
+        self.index = np.zeros(self.grid + (2,), dtype=np.int64)
+        self.buffer = np.zeros((self.tile[0], self.shape[1]), dtype=np.uint8)
+        self.next_row = 0
+        self.offset = 0
+        self.closed = False
+        self.data = open(os.path.join(path, DATA_NAME), "wb")
+
+    def __setitem__(self, key, value):
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError("ProbStoreWriter only supports row slices, writer[y0:y1] = rows")
+        y0, y1, _ = key.indices(self.shape[0])
+        if y0 != self.next_row:
+            raise ValueError("rows must be written in order, expected row {} got {}".format(self.next_row, y0))
+        value = np.asarray(value)
+        if value.dtype != np.uint8:
+            value = np.rint(np.clip(value, 0, 1) * 255).astype(np.uint8)
+        start = y0
+        while y0 < y1:
+            ty, r = divmod(y0, self.tile[0])
+            n = min(self.tile[0] - r, y1 - y0)
+            self.buffer[r: r + n] = value[y0 - start: y0 - start + n]
+            y0 += n
+            if r + n == self.tile[0] or y0 == self.shape[0]:
+                self._write_tile_row(ty, r + n)
+        self.next_row = y1
+        if self.next_row == self.shape[0]:
+            self.close()
+
+    def _write_tile_row(self, ty, rows):
+        th, tw = self.tile
+        for tx in range(self.grid[1]):
+            tile = self.buffer[:rows, tx * tw: (tx + 1) * tw]
+            if not tile.any():
+                continue
+            raw = np.ascontiguousarray(tile).tobytes()
+            blob = zlib.compress(raw, self.level) if self.compression == "zlib" else raw
+            self.data.write(blob)
+            self.index[ty, tx] = (self.offset, len(blob))
+            self.offset += len(blob)
+        self.buffer[:] = 0
+
+    def flush(self):
+        if not self.closed:
+            self.data.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.data.close()
+        np.save(os.path.join(self.path, INDEX_NAME), self.index)
+        meta = {"shape": list(self.shape), "tile": list(self.tile), "compression": self.compression, "scale": 255}
+        # meta.json last: a store without it is incomplete
+        with open(os.path.join(self.path, META_NAME), "w") as f:
+            json.dump(meta, f)
+
+
+class ProbStore(object):
+    """
+    Read side of :py:class:`ProbStoreWriter`: the stitched ``(H, W)`` uint8 map of a fragment, sliced like an array
+    (``store[y0:y1, x0:x1]``) without decompressing more than the touched tiles. ``tiles.bin`` is memory mapped,
+    raw stores are read without a copy.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, META_NAME)) as f:
+            meta = json.load(f)
+        self.path = path
+        self.shape = tuple(meta["shape"])
+        self.tile = tuple(meta["tile"])
+        self.compression = meta["compression"]
+        self.scale = meta["scale"]
+        self.dtype = np.dtype(np.uint8)
+        self.ndim = 2
+        self.index = np.load(os.path.join(path, INDEX_NAME))
+        data_path = os.path.join(path, DATA_NAME)
+        self.data = np.memmap(data_path, dtype=np.uint8, mode="r") if os.path.getsize(data_path) else None
+
+    def tile_shape(self, ty, tx):
+        th, tw = self.tile
+        return min(th, self.shape[0] - ty * th), min(tw, self.shape[1] - tx * tw)
+
+    def read_tile(self, ty, tx):
+        offset, length = self.index[ty, tx]
+        shape = self.tile_shape(ty, tx)
+        if length == 0:
+            return np.zeros(shape, dtype=np.uint8)
+        blob = self.data[offset: offset + length]
+        if self.compression == "zlib":
+            return np.frombuffer(zlib.decompress(blob), dtype=np.uint8).reshape(shape)
+        return blob.reshape(shape)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (2 - len(key))
+        if not all(isinstance(k, slice) and k.step in (None, 1) for k in key):
+            raise TypeError("ProbStore only supports contiguous slices")
+        (y0, y1, _), (x0, x1, _) = key[0].indices(self.shape[0]), key[1].indices(self.shape[1])
+        out = np.zeros((max(y1 - y0, 0), max(x1 - x0, 0)), dtype=np.uint8)
+        th, tw = self.tile
+        for ty in range(y0 // th, -(-y1 // th)):
+            for tx in range(x0 // tw, -(-x1 // tw)):
+                if self.index[ty, tx, 1] == 0:
+                    continue
+                tile = self.read_tile(ty, tx)
+                ys, xs = max(y0, ty * th), max(x0, tx * tw)
+                ye, xe = min(y1, ty * th + tile.shape[0]), min(x1, tx * tw + tile.shape[1])
+                out[ys - y0: ye - y0, xs - x0: xe - x0] = tile[ys - ty * th: ye - ty * th, xs - tx * tw: xe - tx * tw]
+        return out
+
+    def __len__(self):
+        return self.shape[0]
+
+    def probabilities(self, key=(slice(None), slice(None))):
+        return self[key].astype(np.float32) / self.scale
+
+    def to_memmap(self, filename):
+        """
+        Write the stitched fragment as a uint8 ``.npy`` memmap, one row of tiles at a time.
+        """
+        out = np.lib.format.open_memmap(filename, mode="w+", dtype=np.uint8, shape=self.shape)
+        for y in range(0, self.shape[0], self.tile[0]):
+            out[y: y + self.tile[0]] = self[y: y + self.tile[0]]
+        out.flush()
+        return out
+
+
+def average_stores(paths, out_path, compression="zlib"):
+    """
+    Ensemble stored predictions of one fragment: mean probability of every store, written as a new store.
+    """
+    stores = [ProbStore(p) for p in paths]
+    shape, tile = stores[0].shape, stores[0].tile
+    if any(s.shape != shape for s in stores):
+        raise ValueError("stores have different shapes: {}".format([s.shape for s in stores]))
+    writer = ProbStoreWriter(out_path, shape, tile=tile, compression=compression)
+    for y in range(0, shape[0], tile[0]):
+        rows = sum(s[y: y + tile[0]].astype(np.uint16) for s in stores)
+        writer[y: y + tile[0]] = np.rint(rows / float(len(stores))).astype(np.uint8)
+    return ProbStore(out_path)
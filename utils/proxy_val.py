@@ -0,0 +1,121 @@
+import itertools
+import time
+
+import numpy as np
+import torch
+from torch.cuda.amp import autocast
+
+from monai.data import decollate_batch
+from utils.utils import AverageMeter
+
+
+def _split_batch(batch_data, args):
+    if isinstance(batch_data, list):
+        data, target = batch_data
+    else:
+        data, target = batch_data["image"], batch_data["inklabels"]
+    if args.model_mode == "3dswin":
+        target = target[:, :, :, :, 0:1]
+    elif args.model_mode in ["2dswin", "25dswin", "2dunet"]:
+        target = target[:, 0:1, :, :]
+    else:
+        raise ValueError("model_mode should be ['3dswin', '2dswin', '3dunet', '2dunet']")
+    return data, target
+
+
+def _window_starts(size, roi):
+    if size <= roi:
+        return [0]
+    starts = list(range(0, size - roi + 1, roi))
+    if starts[-1] != size - roi:
+        starts.append(size - roi)
+    return starts
+
+
+def _patch_grid(spatial_shape, roi_size):
+    return itertools.product(*[_window_starts(s, r) for s, r in zip(spatial_shape, roi_size)])
+
+
+def _patch_slices(start, roi_size):
+    return (slice(None),) + tuple(slice(s, s + r) for s, r in zip(start, roi_size))
+
+
+def stratified_patch_choice(ink_ratios, num_patches, num_bins=4, seed=0):
+    """
+    Pick ``num_patches`` indices spread evenly over ink-ratio strata: one stratum for patches without ink and
+    ``num_bins - 1`` quantile strata for the rest. Quota left by small strata goes to the remaining ones.
+    """
+    ink_ratios = np.asarray(ink_ratios)
+    rng = np.random.RandomState(seed)
+    strata = [np.flatnonzero(ink_ratios == 0)]
+    inked = np.flatnonzero(ink_ratios > 0)
+    if len(inked) > 0 and num_bins > 1:
+        order = inked[np.argsort(ink_ratios[inked], kind="stable")]
+        strata += [s for s in np.array_split(order, num_bins - 1) if len(s) > 0]
+    strata = [rng.permutation(s) for s in strata if len(s) > 0]
+    chosen = []
+    taken = [0] * len(strata)
+    while len(chosen) < min(num_patches, len(ink_ratios)):
+        open_strata = [i for i, s in enumerate(strata) if taken[i] < len(s)]
+        quota = max((num_patches - len(chosen)) // len(open_strata), 1)
+        for i in open_strata:
+            take = strata[i][taken[i]: taken[i] + quota]
+            taken[i] += len(take)
+            chosen.extend(take[: num_patches - len(chosen)])
+    return sorted(int(c) for c in chosen)
+
+
+def build_proxy_set(loader, roi_size, num_patches, args, num_bins=4, seed=0):
+    """
+    Fixed, stratified subset of validation patches for the cheap proxy validation.
+
+    Every validation tile is cut into non-overlapping ``roi_size`` patches, the patches are stratified by their
+    ink ratio and ``num_patches`` of them are kept (images as float16) so the proxy pass needs no data loading.
+    """
+    start_time = time.time()
+    ink_ratios, keys = [], []
+    for idx, batch_data in enumerate(loader):
+        data, target = _split_batch(batch_data, args)
+        for b in range(data.shape[0]):
+            for start in _patch_grid(target.shape[2:], roi_size):
+                patch = target[b][_patch_slices(start, roi_size)]
+                ink_ratios.append(float((patch > 0).float().mean()))
+                keys.append((idx, b, start))
+    chosen = set(stratified_patch_choice(ink_ratios, num_patches, num_bins=num_bins, seed=seed))
+    chosen_keys = {keys[i]: i for i in chosen}
+    images, labels, ratios = [], [], []
+    for idx, batch_data in enumerate(loader):
+        data, target = _split_batch(batch_data, args)
+        for b in range(data.shape[0]):
+            for start in _patch_grid(target.shape[2:], roi_size):
+                if (idx, b, start) not in chosen_keys:
+                    continue
+                sl = _patch_slices(start, roi_size)
+                images.append(torch.as_tensor(data[b][sl]).half())
+                labels.append(torch.as_tensor(target[b][sl]).to(torch.uint8))
+                ratios.append(ink_ratios[chosen_keys[(idx, b, start)]])
+    print(
+        "Proxy validation set: {} of {} patches, ink ratio mean {:.4f}, built in {:.2f}s".format(
+            len(images), len(ink_ratios), np.mean(ratios) if ratios else 0.0, time.time() - start_time
+        )
+    )
+    return {"image": torch.stack(images), "inklabels": torch.stack(labels), "ink_ratio": ratios}
+
+
+def proxy_val_epoch(model, proxy_set, epoch, acc_func, args, batch_size=8):
+    """
+    Direct (no sliding window) forward over the proxy patches, accumulated like :py:func:`trainer.val_epoch`.
+    """
+    model.eval()
+    run_acc = AverageMeter()
+    with torch.no_grad():
+        for i in range(0, len(proxy_set["image"]), batch_size):
+            data = proxy_set["image"][i: i + batch_size].cuda(args.rank).float()
+            target = proxy_set["inklabels"][i: i + batch_size].cuda(args.rank).float()
+            with autocast(enabled=args.amp):
+                logits = model(data)
+            acc_func.reset()
+            acc_func(y_pred=decollate_batch(logits), y=decollate_batch(target))
+            acc, not_nans = acc_func.aggregate()
+            run_acc.update(acc.cpu().numpy(), n=not_nans.cpu().numpy())
+    return run_acc.avg
@@ -0,0 +1,153 @@
+import copy
+
+import torch
+import torch.nn as nn
+from monai.networks.blocks.dynunet_block import UnetBasicBlock, UnetResBlock
+from monai.networks.blocks.mlp import MLPBlock
+
+PRUNE_SCORES = ("l1", "taylor")
+
+
+def prunable_groups(model):
+    """
+    ``(producer, norm, consumer)`` module names of every hidden layer whose channels can be removed without touching
+    the block interfaces: the hidden units of the Swin MLPs (``linear1`` -> ``linear2``) and the middle channels of
+    the UNETR conv blocks (``conv1`` -> ``norm1`` -> ``conv2``). ``norm`` is None for the MLPs.
+    """
+    groups = []
+    for name, module in model.named_modules():
+        if isinstance(module, MLPBlock) and module.linear1.out_features == module.linear2.in_features:
+            groups.append((name + ".linear1", None, name + ".linear2"))
+        elif isinstance(module, (UnetResBlock, UnetBasicBlock)):
+            groups.append((name + ".conv1.conv", name + ".norm1", name + ".conv2.conv"))
+    return groups
+
+
+def _select(module, index, dim):
+    # copy of a Linear / ConvNd / norm layer keeping ``index`` of its output (dim 0) or input (dim 1) channels
+    new = copy.deepcopy(module)
+    with torch.no_grad():
+        if isinstance(module, (nn.Linear, nn.modules.conv._ConvNd)):
+            new.weight = nn.Parameter(module.weight.index_select(dim, index).clone())
+            if dim == 0 and module.bias is not None:
+                new.bias = nn.Parameter(module.bias[index].clone())
+            if isinstance(module, nn.Linear):
+                setattr(new, "out_features" if dim == 0 else "in_features", len(index))
+            else:
+                setattr(new, "out_channels" if dim == 0 else "in_channels", len(index))
+        else:
+            new.num_features = len(index)
+            for key, value in module._parameters.items():
+                if value is not None:
+                    new._parameters[key] = nn.Parameter(value[index].clone())
+            for key, value in module._buffers.items():
+                if value is not None and value.dim() > 0:
+                    new._buffers[key] = value[index].clone()
+    return new
+
+
+def _replace(model, name, module):
+    parent, _, attr = name.rpartition(".")
+    setattr(model.get_submodule(parent) if parent else model, attr, module)
+
+
+def prune_group(model, group, index):
+    """
+    Keep only the hidden channels ``index`` (sorted long tensor) of one :py:func:`prunable_groups` entry, in place.
+    """
+    producer, norm, consumer = group
+    index = index.to(model.get_submodule(producer).weight.device)
+    _replace(model, producer, _select(model.get_submodule(producer), index, 0))
+    if norm is not None:
+        _replace(model, norm, _select(model.get_submodule(norm), index, 0))
+    _replace(model, consumer, _select(model.get_submodule(consumer), index, 1))
+
+
+def l1_scores(model, groups=None):
+    """
+    Magnitude of every hidden channel: L1 norm of the consumer weights reading it, times the L1 norm of the producer
+    weights writing it. A norm layer in between rescales the channel anyway, so there only its affine scale (if any)
+    counts. Returns ``{consumer name: (channels,) tensor}``.
+    """
+    scores = {}
+    for producer, norm, consumer in groups if groups is not None else prunable_groups(model):
+        weight = model.get_submodule(consumer).weight.detach()
+        score = weight.abs().transpose(0, 1).flatten(1).sum(1)
+        if norm is None:
+            score = score * model.get_submodule(producer).weight.detach().abs().flatten(1).sum(1)
+        elif getattr(model.get_submodule(norm), "weight", None) is not None:
+            score = score * model.get_submodule(norm).weight.detach().abs()
+        scores[consumer] = score.float().cpu()
+    return scores
+
+
+def taylor_scores(model, batches, loss_func, groups=None):
+    """
+    First-order Taylor importance of every hidden channel: ``|sum(a * dL/da)|`` of its activation ``a`` at the
+    consumer input per sample, summed over the ``(data, target)`` ``batches``. Run it on a model without activation
+    checkpointing, recomputed forwards would be counted twice. Returns ``{consumer name: (channels,) tensor}``.
+    """
+    groups = groups if groups is not None else prunable_groups(model)
+    scores = {}
+    hooks = []
+
+    def pre_hook(module, args, name):
+        x = args[0]
+        if not x.requires_grad:
+            return
+
+        def grad_hook(grad):
+            t = x.detach() * grad
+            t = t.movedim(-1, 1) if isinstance(module, nn.Linear) else t
+            score = t.flatten(2).sum(2).abs().sum(0).float().cpu()
+            scores[name] = scores[name] + score if name in scores else score
+
+        x.register_hook(grad_hook)
+
+    for _, _, consumer in groups:
+        module = model.get_submodule(consumer)
+        hooks.append(module.register_forward_pre_hook(lambda m, args, name=consumer: pre_hook(m, args, name)))
+    was_training = model.training
+    model.eval()
+    try:
+        for data, target in batches:
+            loss = loss_func(model(data), target)
+            loss.backward()
+            model.zero_grad(set_to_none=True)
+    finally:
+        for hook in hooks:
+            hook.remove()
+        model.train(was_training)
+    return scores
+
+
+def prune_channels(model, sparsity, scores, groups=None, min_channels=4):
+    """
+    Remove the ``sparsity`` fraction of lowest scoring hidden channels of every group in place (at least
+    ``min_channels`` are kept per layer), so the pruned layers hold smaller tensors. Returns
+    ``{consumer name: kept channels}``.
+    """
+    if not 0.0 <= sparsity < 1.0:
+        raise ValueError("sparsity should be in [0, 1), got {}".format(sparsity))
+    kept = {}
+    for group in groups if groups is not None else prunable_groups(model):
+        score = scores[group[2]]
+        keep = max(min(min_channels, len(score)), int(round(len(score) * (1.0 - sparsity))))
+        index = score.argsort(descending=True)[:keep].sort().values
+        prune_group(model, group, index)
+        kept[group[2]] = keep
+    return kept
+
+
+def resize_to_state_dict(model, state_dict):
+    """
+    Shrink the prunable layers of a freshly built ``model`` to the hidden sizes stored in ``state_dict``, so a
+    checkpoint pruned by :py:func:`prune_channels` loads into it. Returns the number of resized groups.
+    """
+    resized = 0
+    for group in prunable_groups(model):
+        key = group[0] + ".weight"
+        if key in state_dict and state_dict[key].shape[0] != model.get_submodule(group[0]).weight.shape[0]:
+            prune_group(model, group, torch.arange(state_dict[key].shape[0]))
+            resized += 1
+    return resized
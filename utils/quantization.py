@@ -0,0 +1,88 @@
+import copy
+import io
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+# UNETR conv blocks of SwinUNETR, quantized statically; the Swin transformer in between stays float with int8 Linears
+DECODER_BLOCKS = (
+    "encoder1", "encoder2", "encoder3", "encoder4", "encoder10",
+    "decoder5", "decoder4", "decoder3", "decoder2", "decoder1", "out",
+)
+
+
+def select_engine():
+    """
+    Use the x86 (fbgemm + onednn) kernels when available, qnnpack otherwise (ARM). Returns the engine name.
+    """
+    engines = torch.backends.quantized.supported_engines
+    for engine in ("x86", "fbgemm", "qnnpack"):
+        if engine in engines:
+            torch.backends.quantized.engine = engine
+            return engine
+    raise RuntimeError("no quantized engine available in this torch build")
+
+
+def _block_inputs(model, blocks, batch):
+    inputs = {}
+    hooks = [
+        getattr(model.swinUNETR, name).register_forward_pre_hook(lambda m, args, name=name: inputs.setdefault(name, args))
+        for name in blocks
+    ]
+    with torch.no_grad():
+        model(batch)
+    for hook in hooks:
+        hook.remove()
+    return inputs
+
+
+def quantize_model(model, calibration, decoder=True, blocks=DECODER_BLOCKS):
+    """
+    Post-training int8 copy of a ``MyModel2d``/``MyModel`` for CPU inference.
+
+    The ``nn.Linear`` layers of the Swin transformer (qkv, proj, MLP, patch merging) get dynamic int8 quantization,
+    so activations are quantized per batch and nothing needs calibrating there. With ``decoder`` the UNETR conv blocks
+    are quantized statically with FX graph mode, one block at a time (their inputs come from the float transformer),
+    using activation ranges observed on the ``calibration`` window batches.
+
+    Args:
+        model: float model in eval mode, left unchanged.
+        calibration: iterable of ``(B, ...)`` window batches as fed to the model.
+        decoder: also quantize the conv blocks statically.
+        blocks: names of the conv blocks in ``model.swinUNETR``.
+    """
+    engine = select_engine()
+    qmodel = copy.deepcopy(model).cpu().eval()
+    quantize_dynamic(qmodel.swinUNETR.swinViT, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    if not decoder:
+        return qmodel
+    calibration = list(calibration)
+    qconfig_mapping = get_default_qconfig_mapping(engine)
+    example_inputs = _block_inputs(qmodel, blocks, calibration[0])
+    for name in blocks:
+        block = getattr(qmodel.swinUNETR, name)
+        setattr(qmodel.swinUNETR, name, prepare_fx(block, qconfig_mapping, example_inputs=example_inputs[name]))
+    with torch.no_grad():
+        for batch in calibration:
+            qmodel(batch)
+    for name in blocks:
+        setattr(qmodel.swinUNETR, name, convert_fx(getattr(qmodel.swinUNETR, name)))
+    return qmodel
+
+
+def save_quantized(qmodel, example, path):
+    """
+    Trace the quantized model to TorchScript, loadable without this module by ``test.py --backend torchscript``.
+    """
+    with torch.no_grad():
+        traced = torch.jit.trace(qmodel, example)
+    traced.save(path)
+    return traced
+
+
+def state_dict_bytes(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
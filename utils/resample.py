@@ -0,0 +1,84 @@
+import functools
+
+import numpy as np
+import torch
+
+
+@functools.lru_cache(maxsize=64)
+def nearest_indices(src, dst, edge="clamp"):
+    """
+    Source index of every output sample along one axis of a ``src -> dst`` nearest-neighbour resize, with the
+    sample positions of ``scipy.ndimage.zoom`` (first and last samples aligned). Cached per ``(src, dst, edge)``.
+
+    ``ndimage.zoom`` computes the last position in floating point and can land just past the last source sample;
+    with ``edge="zoom"`` those samples are returned as invalid (zoom fills them with 0), with ``edge="clamp"`` they
+    take the last source sample. Returns ``(indices, valid)``, ``valid`` is None when every sample is inside.
+    """
+    if edge not in ("clamp", "zoom"):
+        raise ValueError("edge should be 'clamp' or 'zoom'")
+    if dst > 1 and src > 1:
+        pos = np.arange(dst) * ((src - 1) / float(dst - 1))
+    else:
+        pos = np.zeros(dst)
+    indices = np.clip(np.floor(pos + 0.5).astype(np.int64), 0, src - 1)
+    indices.flags.writeable = False
+    valid = None
+    if edge == "zoom" and (pos > src - 1).any():
+        valid = pos <= src - 1
+        valid.flags.writeable = False
+    return indices, valid
+
+
+def _gather(img, indices):
+    # one axis at a time, several times faster than a single np.ix_ gather
+    if isinstance(img, torch.Tensor):
+        for axis in reversed(range(len(indices))):
+            img = img.index_select(axis, torch.from_numpy(np.array(indices[axis])).to(img.device))
+        return img
+    img = np.asarray(img)
+    for axis in reversed(range(len(indices))):
+        img = np.take(img, indices[axis], axis=axis)
+    return img
+
+
+def _zero_invalid(out, valids, offset=0):
+    for axis, valid in enumerate(valids):
+        if valid is None:
+            continue
+        if axis == 0:
+            valid = valid[offset: offset + out.shape[0]]
+        sl = [slice(None)] * out.ndim
+        sl[axis] = ~valid if not isinstance(out, torch.Tensor) else torch.from_numpy(~valid).to(out.device)
+        out[tuple(sl)] = 0
+    return out
+
+
+def resample_nearest(img, target_shape, edge="clamp", out=None, chunk_rows=None):
+    """
+    Nearest-neighbour resize of a label or probability map to ``target_shape`` by index gathering (``np.take``,
+    ``index_select`` for torch tensors), same samples as ``ndimage.zoom(order=0, prefilter=False)``.
+
+    With ``chunk_rows`` the output is produced ``chunk_rows`` rows at a time, reading only the source rows those need,
+    so memmapped inputs and ``out`` (e.g. ``np.lib.format.open_memmap``) never have to fit in memory.
+    """
+    target_shape = tuple(int(t) for t in target_shape)
+    if len(target_shape) != img.ndim:
+        raise ValueError("target shape {} does not match input shape {}".format(target_shape, img.shape))
+    maps = [nearest_indices(int(s), t, edge) for s, t in zip(img.shape, target_shape)]
+    indices = [m[0] for m in maps]
+    valids = [m[1] for m in maps]
+    if chunk_rows is None:
+        result = _zero_invalid(_gather(img, indices), valids)
+        if out is not None:
+            out[...] = result
+            return out
+        return result
+    if out is None:
+        out = np.empty(target_shape, dtype=img.dtype)
+    for r in range(0, target_shape[0], chunk_rows):
+        rows = indices[0][r: r + chunk_rows]
+        # output rows map to a sorted, contiguous range of source rows
+        lo, hi = int(rows[0]), int(rows[-1]) + 1
+        block = _gather(img[lo:hi], [rows - lo] + indices[1:])
+        out[r: r + len(rows)] = _zero_invalid(block, valids, offset=r)
+    return out
@@ -0,0 +1,105 @@
+import csv
+
+import numpy as np
+
+
+def binarize(prob, threshold=0.5):
+    """
+    Ink mask of a probability chunk, uint8 maps are read as probability * 255 like in
+    :py:class:`utils.threshold_metrics.ThresholdHistogram`; bool chunks pass through.
+    """
+    prob = np.asarray(prob)
+    if prob.dtype == bool:
+        return prob
+    if prob.dtype == np.uint8:
+        return prob.astype(np.float32) / np.float32(255) >= threshold
+    return prob >= threshold
+
+
+def rle_runs(mask, threshold=0.5, rows=1024):
+    """
+    Yield ``(starts, lengths)`` arrays of the ink runs of ``mask`` (``(H, W)``, flattened row-major, 1-indexed
+    starts as in the Vesuvius submission format), ``rows`` rows at a time so memmapped maps and
+    :py:class:`utils.prob_store.ProbStore` stay out of RAM. Runs crossing chunk borders are joined.
+    """
+    height, width = mask.shape
+    prev = 0
+    open_start = None
+    for r in range(0, height, rows):
+        flat = binarize(mask[r: r + rows], threshold).ravel().view(np.int8)
+        edges = np.flatnonzero(np.diff(flat, prepend=np.int8(prev)))
+        rising = flat[edges] == 1
+        offset = r * width
+        starts, ends = edges[rising] + offset, edges[~rising] + offset
+        if open_start is not None:
+            starts = np.concatenate([[open_start], starts])
+        open_start = None
+        if len(starts) > len(ends):
+            open_start, starts = starts[-1], starts[:-1]
+        if len(starts):
+            yield starts + 1, ends - starts
+        prev = flat[-1] if len(flat) else prev
+    if open_start is not None:
+        yield np.array([open_start + 1]), np.array([height * width - open_start])
+
+
+def rle_encode(mask, threshold=0.5, rows=1024):
+    """
+    Submission string ``"start length start length ..."`` of ``mask``.
+    """
+    return " ".join(_format_runs(starts, lengths) for starts, lengths in rle_runs(mask, threshold, rows))
+
+
+def _format_runs(starts, lengths):
+    return " ".join(map(str, np.stack([starts, lengths], axis=1).ravel().tolist()))
+
+
+def rle_decode(rle, shape):
+    """
+    Inverse of :py:func:`rle_encode`, returns a ``(H, W)`` uint8 mask.
+    """
+    values = np.array(rle.split(), dtype=np.int64)
+    starts, lengths = values[0::2] - 1, values[1::2]
+    size = int(np.prod(shape))
+    edges = np.zeros(size + 1, dtype=np.int8)
+    # runs never touch, so every start and end index is unique
+    edges[starts] += 1
+    edges[starts + lengths] -= 1
+    # the running sum is 0 or 1, so it is the mask itself
+    return np.cumsum(edges[:-1], dtype=np.int8).view(np.uint8).reshape(shape)
+
+
+class SubmissionWriter(object):
+    """
+    Streams ``Id,Predicted`` rows of run-length encoded fragment masks to a CSV file, one chunk of runs at a time.
+    """
+
+    def __init__(self, filename):
+        self.file = open(filename, "w")
+        self.file.write("Id,Predicted\n")
+
+    def add(self, fragment_id, mask, threshold=0.5, rows=1024):
+        self.file.write("{},".format(fragment_id))
+        sep = ""
+        for starts, lengths in rle_runs(mask, threshold, rows):
+            self.file.write(sep + _format_runs(starts, lengths))
+            sep = " "
+        self.file.write("\n")
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_submission(filename):
+    """
+    ``{fragment_id: rle}`` of a submission CSV.
+    """
+    csv.field_size_limit(2 ** 31 - 1)
+    with open(filename, newline="") as f:
+        return {row["Id"]: row["Predicted"] for row in csv.DictReader(f)}
@@ -0,0 +1,351 @@
+import asyncio
+import json
+import queue
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import torch
+
+
+class BatchingWorker(object):
+    """
+    Worker thread that owns the model and merges windows of concurrent requests into micro-batches.
+
+    A batch is run once ``max_batch`` windows are waiting or the oldest waiting window is ``max_latency`` seconds
+    old, whichever comes first. Callers block in :py:meth:`predict` (from executor threads), so any number of
+    requests can share one forward pass.
+
+    Args:
+        model: predictor applied to ``(B, ...)`` window batches.
+        device: device the model runs on.
+        max_batch: windows per forward pass at most.
+        max_latency: seconds the first window of a batch may wait for more.
+        amp: run the forward pass under autocast.
+    """
+
+    def __init__(self, model, device, max_batch=16, max_latency=0.01, amp=False):
+        self.model = model
+        self.device = torch.device(device)
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.amp = amp
+        self.jobs = queue.Queue()
+        self.metrics = ServerMetrics()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def predict(self, windows):
+        """
+        Logits of a ``(n, ...)`` tensor of windows, returned once every window has been through a batch.
+        """
+        pending = []
+        for window in windows:
+            done = threading.Event()
+            job = {"window": window, "enqueued": time.time(), "done": done, "result": None, "error": None}
+            self.jobs.put(job)
+            pending.append(job)
+        for job in pending:
+            job["done"].wait()
+            if job["error"] is not None:
+                raise RuntimeError("inference worker failed") from job["error"]
+        return torch.stack([job["result"] for job in pending])
+
+    __call__ = predict
+
+    def _collect(self):
+        batch = [self.jobs.get()]
+        if batch[0] is None:
+            return None
+        deadline = batch[0]["enqueued"] + self.max_latency
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            try:
+                job = self.jobs.get(timeout=timeout) if timeout > 0 else self.jobs.get_nowait()
+            except queue.Empty:
+                break
+            if job is None:
+                self.jobs.put(None)
+                break
+            batch.append(job)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            start = time.time()
+            try:
+                data = torch.stack([job["window"] for job in batch]).to(self.device)
+                with torch.no_grad(), torch.autocast(self.device.type, enabled=self.amp):
+                    logits = self.model(data)
+                logits = logits.float().cpu()
+                for job, logit in zip(batch, logits):
+                    job["result"] = logit
+            except Exception as e:
+                for job in batch:
+                    job["error"] = e
+            self.metrics.record_batch(len(batch), time.time() - start, [start - job["enqueued"] for job in batch])
+            for job in batch:
+                job["done"].set()
+
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
+
+
+class ServerMetrics(object):
+    """
+    Thread-safe counters behind the ``/metrics`` endpoint, latencies over the last ``window`` events.
+    """
+
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.window = window
+        self.start = time.time()
+        self.batches = 0
+        self.windows = 0
+        self.requests = 0
+        self.batch_sizes = []
+        self.forward_times = []
+        self.queue_waits = []
+        self.request_latencies = []
+
+    def _keep(self, values, new):
+        values.extend(new)
+        del values[: max(len(values) - self.window, 0)]
+
+    def record_batch(self, size, forward_time, waits):
+        with self.lock:
+            self.batches += 1
+            self.windows += size
+            self._keep(self.batch_sizes, [size])
+            self._keep(self.forward_times, [forward_time])
+            self._keep(self.queue_waits, waits)
+
+    def record_request(self, latency):
+        with self.lock:
+            self.requests += 1
+            self._keep(self.request_latencies, [latency])
+
+    def snapshot(self, queue_depth=0):
+        def pct(values, q):
+            return float(np.percentile(values, q)) if values else 0.0
+
+        with self.lock:
+            uptime = time.time() - self.start
+            return {
+                "uptime_s": uptime,
+                "requests": self.requests,
+                "batches": self.batches,
+                "windows": self.windows,
+                "windows_per_s": self.windows / max(uptime, 1e-8),
+                "queue_depth": queue_depth,
+                "mean_batch_size": float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+                "forward_ms_p50": 1000 * pct(self.forward_times, 50),
+                "queue_wait_ms_p50": 1000 * pct(self.queue_waits, 50),
+                "queue_wait_ms_p95": 1000 * pct(self.queue_waits, 95),
+                "request_ms_p50": 1000 * pct(self.request_latencies, 50),
+                "request_ms_p95": 1000 * pct(self.request_latencies, 95),
+            }
+
+
+# raw window dtypes accepted by POST /window, uint16 being the surface volumes themselves
+WINDOW_DTYPES = ("uint16", "uint8", "float16", "float32")
+
+
+class StreamAborted(Exception):
+    """
+    Inference failed or the client went away after the 200 headers of a streamed response were sent.
+    """
+
+
+class RequestCancelled(Exception):
+    """
+    Raised in the inference thread of a request whose client disconnected.
+    """
+
+
+class CancellablePredictor(object):
+    """
+    Predictor of one request: forwards to ``predictor`` until :py:meth:`cancel`, then raises
+    :py:class:`RequestCancelled` on the next batch, so the inference of a dropped request stops queueing windows.
+    """
+
+    def __init__(self, predictor):
+        self.predictor = predictor
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def __call__(self, windows):
+        if self.cancelled.is_set():
+            raise RequestCancelled("client disconnected")
+        return self.predictor(windows)
+
+
+class RowStream(object):
+    """
+    ``output`` for :py:class:`utils.inference.StreamingInferer` that forwards finished uint8 rows to an asyncio queue
+    instead of storing them, so a response can be streamed while the region is still being predicted.
+    """
+
+    dtype = np.dtype(np.uint8)
+
+    def __init__(self, loop, rows_queue):
+        self.loop = loop
+        self.rows_queue = rows_queue
+
+    def __setitem__(self, key, value):
+        self.loop.call_soon_threadsafe(self.rows_queue.put_nowait, np.ascontiguousarray(value).tobytes())
+
+    def flush(self):
+        pass
+
+
+class InferenceServer(object):
+    """
+    Small HTTP/1.1 front end (asyncio, TCP on localhost or a UNIX socket) over a :py:class:`BatchingWorker`.
+
+    Endpoints:
+        ``POST /region`` JSON ``{"fragment", "y", "x", "h", "w"}`` of a registered fragment, streams the uint8
+        probabilities of the region row by row (chunked encoding, shape in ``X-Shape``).
+        ``POST /window?c=&h=&w=&dtype=`` with a raw ``(c, h, w)`` array as body, same response for that array.
+        ``GET /metrics`` JSON latency and throughput counters.
+
+    Args:
+        make_inferer: callable returning a :py:class:`utils.inference.StreamingInferer` around a predictor.
+        worker: the batching worker.
+        fragments: ``{fragment_id: (volume, mask or None)}`` of memmapped fragments.
+    """
+
+    def __init__(self, make_inferer, worker, fragments):
+        self.make_inferer = make_inferer
+        self.worker = worker
+        self.fragments = fragments
+
+    async def _read_request(self, reader):
+        request_line = (await reader.readline()).decode("latin-1").strip()
+        if not request_line:
+            return None
+        method, target, _ = request_line.split(" ", 2)
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+        return method, target, headers, body
+
+    async def _respond(self, writer, status, body, content_type="application/json"):
+        reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}[status]
+        head = "HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(
+            status, reason, content_type, len(body)
+        )
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+    async def _next_chunk(self, rows_queue, task):
+        # next finished row of the running inference, None once it ended (its error, if any, is raised)
+        getter = asyncio.ensure_future(rows_queue.get())
+        await asyncio.wait([getter, task], return_when=asyncio.FIRST_COMPLETED)
+        if getter.done():
+            return getter.result()
+        getter.cancel()
+        if not rows_queue.empty():
+            return rows_queue.get_nowait()
+        task.result()
+        return None
+
+    async def _stream_region(self, writer, volume, mask):
+        loop = asyncio.get_running_loop()
+        rows_queue = asyncio.Queue()
+        predictor = CancellablePredictor(self.worker)
+        inferer = self.make_inferer(predictor)
+        task = loop.run_in_executor(None, inferer, volume, RowStream(loop, rows_queue), mask)
+        # the 200 headers wait for the first row, so errors of the first band still get a proper error response
+        chunk = await self._next_chunk(rows_queue, task)
+        head = (
+            "HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\nTransfer-Encoding: chunked\r\n"
+            "X-Shape: {},{}\r\nConnection: close\r\n\r\n".format(volume.shape[1], volume.shape[2])
+        )
+        writer.write(head.encode("latin-1"))
+        received = 0
+        try:
+            while chunk is not None:
+                received += len(chunk)
+                writer.write("{:x}\r\n".format(len(chunk)).encode("latin-1") + chunk + b"\r\n")
+                await writer.drain()
+                if received >= volume.shape[1] * volume.shape[2]:
+                    break
+                chunk = await self._next_chunk(rows_queue, task)
+            await task
+        except ConnectionError as e:
+            # the client is gone: stop the inference at its next batch and wait for the thread to let go
+            predictor.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            raise StreamAborted("client disconnected: {!r}".format(e)) from e
+        except Exception as e:
+            # too late for an error status: close without the terminating chunk, the client sees a truncated body
+            raise StreamAborted(repr(e)) from e
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        start = time.time()
+        try:
+            request = await self._read_request(reader)
+            if request is None:
+                return
+            method, target, headers, body = request
+            url = urlparse(target)
+            if method == "GET" and url.path == "/metrics":
+                metrics = self.worker.metrics.snapshot(queue_depth=self.worker.jobs.qsize())
+                await self._respond(writer, 200, json.dumps(metrics).encode())
+                return
+            if method == "POST" and url.path == "/region":
+                spec = json.loads(body.decode() or "{}")
+                if spec.get("fragment") not in self.fragments:
+                    await self._respond(writer, 404, b'{"error": "unknown fragment"}')
+                    return
+                volume, mask = self.fragments[spec["fragment"]]
+                y, x, h, w = (int(spec[k]) for k in ("y", "x", "h", "w"))
+                if min(y, x) < 0 or h <= 0 or w <= 0 or y >= volume.shape[1] or x >= volume.shape[2]:
+                    raise ValueError("region outside fragment of shape {}".format(volume.shape[1:]))
+                region_mask = None if mask is None else mask[y: y + h, x: x + w]
+                await self._stream_region(writer, volume[:, y: y + h, x: x + w], region_mask)
+            elif method == "POST" and url.path == "/window":
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                shape = tuple(int(query[k]) for k in ("c", "h", "w"))
+                dtype = query.get("dtype", "uint16")
+                if dtype not in WINDOW_DTYPES:
+                    raise ValueError("dtype should be one of {}, got {}".format(", ".join(WINDOW_DTYPES), dtype))
+                window = np.frombuffer(body, dtype=dtype).reshape(shape)
+                await self._stream_region(writer, window, None)
+            else:
+                await self._respond(writer, 404, b'{"error": "unknown endpoint"}')
+                return
+            self.worker.metrics.record_request(time.time() - start)
+        except StreamAborted as e:
+            print("Aborted streamed response: {}".format(e))
+        except (KeyError, ValueError) as e:
+            await self._respond(writer, 400, json.dumps({"error": str(e)}).encode())
+        except Exception as e:
+            await self._respond(writer, 500, json.dumps({"error": repr(e)}).encode())
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8008, socket_path=None):
+        if socket_path:
+            server = await asyncio.start_unix_server(self.handle, path=socket_path)
+            print("Serving on unix socket {}".format(socket_path))
+        else:
+            server = await asyncio.start_server(self.handle, host=host, port=port)
+            print("Serving on http://{}:{}".format(host, port))
+        async with server:
+            await server.serve_forever()
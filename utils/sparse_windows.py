@@ -0,0 +1,137 @@
+import torch
+import torch.nn.functional as F
+from monai.networks.nets.swin_unetr import SwinTransformerBlock, get_window_size, window_partition, window_reverse
+
+SWIN_STAGES = ("layers1", "layers2", "layers3", "layers4")
+
+
+class SparseSwinBlock(SwinTransformerBlock):
+    """
+    ``SwinTransformerBlock`` that runs attention and the MLP only on windows holding a kept token.
+
+    Tokens of the other windows are assumed to be equal within an image (empty input: zero padding or air clipped to
+    ``b_min``), so they all get the block update of one such token, computed on a single constant window. This is exact when the
+    skipped input is uniform (the wrappers zero the input outside the fragment mask) and an approximation otherwise. Every
+    token of a computed window is kept from then on, windows reaching into the window padding are always computed.
+
+    ``sparse_state`` is a dict shared by all blocks whose ``"keep"`` entry is the keep map of the last block input (or
+    the ``(B, *spatial)`` pixel map before the first block), set around each forward by :py:func:`set_token_keep`;
+    without it the block is the stock one. Inference only, same parameters and state dict as the stock block.
+    """
+
+    sparse_state = None
+    sparse_stats = None
+
+    def _sparse_part1(self, x, mask_matrix, keep):
+        b, c = x.shape[0], x.shape[-1]
+        spatial = x.shape[1:-1]
+        dims = tuple(range(1, len(spatial) + 1))
+        window_size, shift_size = get_window_size(spatial, self.window_size, self.shift_size)
+        pads = [(w - s % w) % w for s, w in zip(spatial, window_size)]
+        padded = [s + p for s, p in zip(spatial, pads)]
+        pad = tuple(v for p in reversed(pads) for v in (0, p))
+        x = F.pad(self.norm1(x), (0, 0) + pad)
+        # channel-last keep map so it goes through the same pad / roll / partition as x, padded windows are kept
+        keep = F.pad(keep.unsqueeze(-1).to(x.dtype), (0, 0) + pad, value=1.0)
+        shifted = any(s > 0 for s in shift_size)
+        if shifted:
+            x = torch.roll(x, shifts=tuple(-s for s in shift_size), dims=dims)
+            keep = torch.roll(keep, shifts=tuple(-s for s in shift_size), dims=dims)
+        windows = window_partition(x, window_size)
+        kept = window_partition(keep, window_size).flatten(1).amax(1) > 0
+        index = kept.nonzero().squeeze(1)
+        out = torch.zeros_like(windows)
+        if len(index):
+            # windows are ordered image-major, index % nw is the window position the shift mask is laid out by
+            mask = mask_matrix[index % (len(kept) // b)] if shifted else None
+            out[index] = self.attn(windows[index], mask=mask)
+        if self.sparse_stats is not None:
+            self.sparse_stats["windows"] += len(kept)
+            self.sparse_stats["skipped"] += len(kept) - len(index)
+        out = window_reverse(out.view(-1, *(tuple(window_size) + (c,))), window_size, [b] + padded)
+        updated = kept.to(x.dtype).view(-1, *([1] * len(window_size))).expand(-1, *window_size).unsqueeze(-1)
+        updated = window_reverse(updated, window_size, [b] + padded)
+        if shifted:
+            out = torch.roll(out, shifts=tuple(shift_size), dims=dims)
+            updated = torch.roll(updated, shifts=tuple(shift_size), dims=dims)
+        crop = (slice(None),) + tuple(slice(0, s) for s in spatial)
+        return out[crop], updated[crop][..., 0] > 0, windows.shape[1]
+
+    def _constant_update(self, tokens, n):
+        # attention over a window of equal tokens returns their value projection whatever the weights and mask
+        attn = self.attn(self.norm1(tokens).unsqueeze(1).expand(-1, n, -1).contiguous(), mask=None)[:, 0]
+        return attn + self.forward_part2(tokens + attn)
+
+    def forward(self, x, mask_matrix):
+        state = self.sparse_state
+        if state is None or self.training:
+            return super().forward(x, mask_matrix)
+        keep = _stage_keep(state["keep"], x.shape[1:-1])
+        out, updated, n = self._sparse_part1(x, mask_matrix, keep)
+        x = x + self.drop_path(out)
+        c = x.shape[-1]
+        flat = x.reshape(-1, c)
+        computed = updated.reshape(-1)
+        index = computed.nonzero().squeeze(1)
+        rest = (~computed).nonzero().squeeze(1)
+        if len(index):
+            flat = flat.index_add(0, index, self.forward_part2(flat[index]))
+        if len(rest):
+            # one representative skipped token per image, the empty value can differ between images (input norms)
+            b = x.shape[0]
+            image = rest // (flat.shape[0] // b)
+            first = torch.full((b,), flat.shape[0], dtype=rest.dtype, device=rest.device)
+            first = first.scatter_reduce(0, image, rest, reduce="amin")
+            present = first < flat.shape[0]
+            update = torch.zeros(b, c, dtype=flat.dtype, device=flat.device)
+            update[present] = self._constant_update(flat[first[present]], n)
+            flat = flat.index_add(0, rest, update[image])
+        state["keep"] = updated
+        return flat.view_as(x)
+
+
+def _stage_keep(keep, spatial):
+    """
+    Bring ``keep`` (``(B, *spatial)`` bool) down to the token grid ``spatial`` of the next block, halving per patch
+    embedding / merging. Odd sizes are zero padded by those layers, so the tokens on that border are kept.
+    """
+    pool = F.max_pool3d if keep.dim() == 4 else F.max_pool2d
+    while tuple(keep.shape[1:]) != tuple(spatial):
+        size = keep.shape[1:]
+        if any(-(-k // 2) < s for k, s in zip(size, spatial)):
+            raise ValueError("keep map {} does not reduce to {}".format(tuple(size), tuple(spatial)))
+        keep = pool(keep.float().unsqueeze(1), 2, ceil_mode=True)[:, 0] > 0
+        for dim, k in enumerate(size):
+            if k % 2:
+                keep.select(dim + 1, -1).fill_(True)
+    return keep
+
+
+def use_sparse_windows(swin_unetr, enable=True, stats=None):
+    """
+    Switch every ``SwinTransformerBlock`` of a MONAI ``SwinUNETR`` to :py:class:`SparseSwinBlock` in place, or back to
+    the stock block with ``enable=False``. ``stats`` is an optional dict counting ``"windows"`` and ``"skipped"``.
+    """
+    for block in _blocks(swin_unetr):
+        if not isinstance(block, SwinTransformerBlock):
+            raise ValueError("sparse windows need the stock Swin blocks, not {}".format(type(block).__name__))
+        block.__class__ = SparseSwinBlock if enable else SwinTransformerBlock
+        block.sparse_stats = stats
+        block.sparse_state = None
+
+
+def set_token_keep(swin_unetr, valid):
+    """
+    Start the next forward of the :py:class:`SparseSwinBlock` s from the ``(B, *spatial)`` input pixel map ``valid``
+    (pixels that are not empty), ``valid=None`` switches them back to dense.
+    """
+    state = {"keep": valid} if valid is not None else None
+    for block in _blocks(swin_unetr):
+        block.sparse_state = state
+
+
+def _blocks(swin_unetr):
+    for stage in SWIN_STAGES:
+        for layer in getattr(swin_unetr.swinViT, stage):
+            for block in getattr(layer, "blocks", ()):
+                yield block
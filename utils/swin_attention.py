@@ -0,0 +1,95 @@
+import torch
+import torch.nn.functional as F
+from monai.networks.nets.swin_unetr import WindowAttention
+
+
+def _attention(q, k, v, bias, mask):
+    """
+    Window attention ``softmax(q k^T * scale + bias [+ mask]) v`` through SDPA.
+
+    ``q/k/v`` are ``(b, heads, n, head_dim)`` with ``b = images * nw``, ``bias`` is ``(heads, n, n)`` and ``mask``
+    the ``(nw, n, n)`` shifted-window mask or None. Only the windows on the wrapped-around border carry a mask; the
+    others share the bias, which SDPA broadcasts without materialising a ``(b, heads, n, n)`` tensor.
+    """
+    if mask is None:
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=bias.unsqueeze(0))
+    b, heads, n, d = q.shape
+    nw = mask.shape[0]
+    border = mask.ne(0).flatten(1).any(1)
+    if not bool(border.any()):
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=bias.unsqueeze(0))
+    q, k, v = (t.view(b // nw, nw, heads, n, d) for t in (q, k, v))
+    out = torch.empty_like(q)
+    inner = ~border
+    if bool(inner.any()):
+        out[:, inner] = F.scaled_dot_product_attention(
+            *(t[:, inner].flatten(0, 1) for t in (q, k, v)), attn_mask=bias.unsqueeze(0)
+        ).view(b // nw, -1, heads, n, d)
+    edge_mask = (bias.unsqueeze(0) + mask[border].unsqueeze(1)).repeat(b // nw, 1, 1, 1)
+    out[:, border] = F.scaled_dot_product_attention(
+        *(t[:, border].flatten(0, 1) for t in (q, k, v)), attn_mask=edge_mask
+    ).view(b // nw, -1, heads, n, d)
+    return out.view(b, heads, n, d)
+
+
+class _RecomputedAttention(torch.autograd.Function):
+    """
+    :py:func:`_attention` keeping only its inputs for backward, where it is run again under autograd.
+    """
+
+    @staticmethod
+    def forward(ctx, q, k, v, bias, mask):
+        ctx.save_for_backward(q, k, v, bias, mask)
+        return _attention(q, k, v, bias, mask)
+
+    @staticmethod
+    def backward(ctx, grad):
+        q, k, v, bias, mask = ctx.saved_tensors
+        inputs = [t.detach().requires_grad_(need) for t, need in zip((q, k, v, bias), ctx.needs_input_grad)]
+        with torch.enable_grad():
+            out = _attention(*inputs, mask)
+        wanted = [t for t in inputs if t.requires_grad]
+        grads = iter(torch.autograd.grad(out, wanted, grad))
+        return tuple(next(grads) if t.requires_grad else None for t in inputs) + (None,)
+
+
+class SDPAWindowAttention(WindowAttention):
+    """
+    ``WindowAttention`` with the attention core in ``F.scaled_dot_product_attention``; same parameters and buffers,
+    so state dicts load unchanged. The relative position bias is added as an attention mask.
+
+    With ``recompute`` the attention core is recomputed in backward instead of keeping its ``(windows, heads, N, N)``
+    intermediates: SDPA cannot return a gradient for a mask on CPU (the bias table is trained) and falls back to the
+    math kernel, which stores the attention matrix like the stock code. The Linear layers are not recomputed.
+    """
+
+    recompute = True
+
+    def forward(self, x, mask):
+        b, n, c = x.shape
+        heads = self.num_heads
+        q, k, v = self.qkv(x).reshape(b, n, 3, heads, c // heads).permute(2, 0, 3, 1, 4).unbind(0)
+        bias = self.relative_position_bias_table[self.relative_position_index[:n, :n].reshape(-1)]
+        bias = bias.reshape(n, n, -1).permute(2, 0, 1).to(q.dtype)
+        mask = mask.to(q.dtype) if mask is not None else None
+        if self.recompute and torch.is_grad_enabled():
+            x = _RecomputedAttention.apply(q, k, v, bias, mask)
+        else:
+            x = _attention(q, k, v, bias, mask)
+        x = self.attn_drop(x) if self.training and self.attn_drop.p > 0 else x
+        x = x.transpose(1, 2).reshape(b, n, c)
+        return self.proj_drop(self.proj(x))
+
+
+def use_sdpa_attention(swin_unetr, enable=True, recompute=True):
+    """
+    Switch every ``WindowAttention`` of a MONAI ``SwinUNETR`` to :py:class:`SDPAWindowAttention` in place, or back to
+    the stock module with ``enable=False``. Returns the number of attention modules.
+    """
+    count = 0
+    for module in swin_unetr.modules():
+        if isinstance(module, WindowAttention):
+            module.__class__ = SDPAWindowAttention if enable else WindowAttention
+            module.recompute = recompute
+            count += 1
+    return count
@@ -0,0 +1,172 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from monai.networks.nets.swin_unetr import BasicLayer, compute_mask, get_window_size, window_partition, window_reverse
+
+
+def fold_layer_norm(norm, linear):
+    """
+    Fold the affine of ``norm`` into the following ``linear``: ``linear(norm(x))`` becomes ``linear'(norm'(x))`` with
+    an affine-free ``norm'``. Exact as long as nothing (e.g. zero padding) sits between the two. Returns
+    ``(norm', linear')``.
+    """
+    gamma, beta = norm.weight.detach(), norm.bias.detach()
+    folded = nn.Linear(linear.in_features, linear.out_features, bias=True).to(linear.weight.device)
+    with torch.no_grad():
+        folded.weight.copy_(linear.weight * gamma)
+        bias = linear.weight @ beta
+        if linear.bias is not None:
+            bias = bias + linear.bias
+        folded.bias.copy_(bias)
+    return nn.LayerNorm(norm.normalized_shape, eps=norm.eps, elementwise_affine=False), folded
+
+
+class FrozenWindowAttention(nn.Module):
+    """
+    ``WindowAttention`` for one window size: the relative position bias (and the shifted-window mask) are gathered
+    once into the ``attn_bias`` buffer and attention runs through ``F.scaled_dot_product_attention``.
+    """
+
+    def __init__(self, attn, n, mask=None):
+        super().__init__()
+        self.qkv = attn.qkv
+        self.proj = attn.proj
+        self.num_heads = attn.num_heads
+        with torch.no_grad():
+            # same gather as WindowAttention.forward, including its [:n, :n] crop for shrunken windows
+            index = attn.relative_position_index[:n, :n].reshape(-1)
+            bias = attn.relative_position_bias_table[index].reshape(n, n, -1).permute(2, 0, 1)
+            bias = bias.unsqueeze(0) if mask is None else mask.unsqueeze(1) + bias.unsqueeze(0)
+        # (windows per image or 1, heads, n, n)
+        self.register_buffer("attn_bias", bias.contiguous())
+        self._expanded = None
+
+    def _attn_mask(self, b, dtype):
+        nw = self.attn_bias.shape[0]
+        if nw == 1:
+            return self.attn_bias.to(dtype)
+        # SDPA is several times faster on CPU with a 4D mask covering every window than with a broadcast 5D
+        # layout, so the mask is repeated over the batch once and kept while the batch size stays the same
+        cached = self._expanded
+        if cached is None or cached.shape[0] != b or cached.dtype != dtype or cached.device != self.attn_bias.device:
+            self._expanded = self.attn_bias.to(dtype).repeat(b // nw, 1, 1, 1)
+        return self._expanded
+
+    def forward(self, x):
+        b, n, c = x.shape
+        heads = self.num_heads
+        q, k, v = self.qkv(x).reshape(b, n, 3, heads, c // heads).permute(2, 0, 3, 1, 4).unbind(0)
+        x = F.scaled_dot_product_attention(q, k, v, attn_mask=self._attn_mask(b, q.dtype))
+        x = x.transpose(1, 2).reshape(b, n, c)
+        return self.proj(x)
+
+
+class FrozenSwinBlock(nn.Module):
+    """
+    ``SwinTransformerBlock`` for a fixed input size: window size, shift and padding are Python constants, the
+    attention bias is precomputed and the LayerNorm affines are folded into the Linears that follow them.
+    """
+
+    def __init__(self, block, spatial, mask):
+        super().__init__()
+        window_size, shift_size = get_window_size(spatial, block.window_size, block.shift_size)
+        self.window_size = tuple(window_size)
+        self.shift = tuple(shift_size) if any(s > 0 for s in shift_size) else None
+        self.spatial = tuple(spatial)
+        pads = [(w - s % w) % w for s, w in zip(spatial, window_size)]
+        self.padded = [s + p for s, p in zip(spatial, pads)]
+        # F.pad order: channels (not padded) first, then the spatial dims from the last
+        self.pad = (0, 0) + tuple(v for p in reversed(pads) for v in (0, p)) if any(pads) else None
+        n = 1
+        for w in window_size:
+            n *= w
+        attn = FrozenWindowAttention(block.attn, n, mask if self.shift else None)
+        if self.pad is None:
+            # the zero padding sits between norm1 and qkv, so the fold is exact only without it
+            block.norm1, attn.qkv = fold_layer_norm(block.norm1, attn.qkv)
+        self.norm1 = block.norm1
+        self.attn = attn
+        self.norm2, linear1 = fold_layer_norm(block.norm2, block.mlp.linear1)
+        block.mlp.linear1 = linear1
+        self.mlp = block.mlp
+
+    def forward(self, x, mask_matrix=None):
+        shortcut = x
+        b, c = x.shape[0], x.shape[-1]
+        dims = tuple(range(1, len(self.spatial) + 1))
+        x = self.norm1(x)
+        if self.pad is not None:
+            x = F.pad(x, self.pad)
+        if self.shift is not None:
+            x = torch.roll(x, shifts=tuple(-s for s in self.shift), dims=dims)
+        windows = self.attn(window_partition(x, self.window_size))
+        windows = windows.view(-1, *(self.window_size + (c,)))
+        x = window_reverse(windows, self.window_size, [b] + self.padded)
+        if self.shift is not None:
+            x = torch.roll(x, shifts=self.shift, dims=dims)
+        if self.pad is not None:
+            x = x[(slice(None),) + tuple(slice(0, s) for s in self.spatial)].contiguous()
+        x = shortcut + x
+        return x + self.mlp(self.norm2(x))
+
+
+class FrozenBasicLayer(nn.Module):
+    """
+    ``BasicLayer`` for a fixed input size, the shifted-window mask is computed once at freezing time.
+    """
+
+    def __init__(self, layer, spatial):
+        super().__init__()
+        self.spatial = tuple(spatial)
+        window_size, shift_size = get_window_size(spatial, layer.window_size, layer.shift_size)
+        padded = [-(-s // w) * w for s, w in zip(spatial, window_size)]
+        device = layer.blocks[0].attn.relative_position_bias_table.device
+        mask = compute_mask(padded, window_size, shift_size, device)
+        self.blocks = nn.ModuleList([FrozenSwinBlock(block, spatial, mask) for block in layer.blocks])
+        self.downsample = layer.downsample
+        if self.downsample is not None:
+            self.downsample.norm, self.downsample.reduction = fold_layer_norm(
+                self.downsample.norm, self.downsample.reduction
+            )
+
+    def forward(self, x):
+        if tuple(x.shape[2:]) != self.spatial:
+            raise ValueError("layer frozen for spatial size {}, got {}".format(self.spatial, tuple(x.shape[2:])))
+        b = x.shape[0]
+        # channels last, as BasicLayer's rearrange
+        x = x.movedim(1, -1)
+        for block in self.blocks:
+            x = block(x)
+        x = x.view(b, *self.spatial, -1)
+        if self.downsample is not None:
+            x = self.downsample(x)
+        return x.movedim(-1, 1)
+
+
+def freeze_swin_unetr(swin_unetr, roi_size):
+    """
+    Specialise the Swin transformer of a MONAI ``SwinUNETR`` to inputs of spatial size ``roi_size`` for inference,
+    in place: every ``BasicLayer`` becomes a :py:class:`FrozenBasicLayer`. Weights are modified (LayerNorm folding),
+    reload the checkpoint to train again. Returns the stage input sizes.
+    """
+    swin_unetr.eval()
+    vit = swin_unetr.swinViT
+    shapes = {}
+    layers = [(name, getattr(vit, name)[0]) for name in ("layers1", "layers2", "layers3", "layers4")]
+
+    def record(name):
+        def hook(module, args):
+            shapes[name] = tuple(args[0].shape[2:])
+
+        return hook
+
+    hooks = [layer.register_forward_pre_hook(record(name)) for name, layer in layers]
+    device = vit.patch_embed.proj.weight.device
+    with torch.no_grad():
+        vit(torch.zeros((1, vit.patch_embed.proj.in_channels) + tuple(roi_size), device=device))
+    for hook in hooks:
+        hook.remove()
+    for name, layer in layers:
+        if isinstance(layer, BasicLayer):
+            getattr(vit, name)[0] = FrozenBasicLayer(layer, shapes[name])
+    return shapes
@@ -0,0 +1,134 @@
+import numpy as np
+import torch
+
+
+class ThresholdHistogram(object):
+    """
+    Streaming TP/FP/FN counts for every probability threshold at once.
+
+    Each update bins the predicted probabilities (``num_bins`` equal bins over [0, 1], uint8 maps are read as
+    probability * 255) separately for ink and background pixels. Predicting ink for ``prob >= b / num_bins``
+    then gives ``TP = ink pixels in bins >= b`` and ``FP = background pixels in bins >= b``, so Dice, IoU and F-beta
+    curves over all thresholds come from the two histograms. Histograms of tiles, fragments or DDP ranks are merged
+    by adding them.
+
+    Args:
+        num_bins: number of probability bins (thresholds).
+    """
+
+    def __init__(self, num_bins=256):
+        self.num_bins = num_bins
+        self.pos = np.zeros(num_bins, dtype=np.int64)
+        self.neg = np.zeros(num_bins, dtype=np.int64)
+
+    def _bins(self, prob):
+        if isinstance(prob, torch.Tensor):
+            scale = self.num_bins / 255.0 if prob.dtype == torch.uint8 else self.num_bins
+            return (prob.float() * scale).long().clamp_(0, self.num_bins - 1)
+        prob = np.asarray(prob)
+        scale = np.float32(self.num_bins / 255.0 if prob.dtype == np.uint8 else self.num_bins)
+        return np.clip((prob.astype(np.float32) * scale).astype(np.int64), 0, self.num_bins - 1)
+
+    def update(self, prob, label, mask=None):
+        """
+        Add a probability map and its label (anything above zero is ink), numpy arrays or torch tensors of the same
+        shape. Pixels where ``mask`` is zero are ignored.
+        """
+        bins = self._bins(prob)
+        if isinstance(bins, torch.Tensor):
+            label = torch.as_tensor(label, device=bins.device) > 0
+            if mask is not None:
+                keep = torch.as_tensor(mask, device=bins.device) > 0
+                bins, label = bins[keep], label[keep]
+            pos = torch.bincount(bins[label], minlength=self.num_bins)
+            neg = torch.bincount(bins[~label], minlength=self.num_bins)
+            self.pos += pos.cpu().numpy()
+            self.neg += neg.cpu().numpy()
+            return self
+        label = np.asarray(label) > 0
+        if mask is not None:
+            keep = np.asarray(mask) > 0
+            bins, label = bins[keep], label[keep]
+        self.pos += np.bincount(bins[label].ravel(), minlength=self.num_bins)
+        self.neg += np.bincount(bins[~label].ravel(), minlength=self.num_bins)
+        return self
+
+    def update_chunked(self, prob, label, mask=None, rows=1024):
+        """
+        :py:meth:`update` over ``rows`` rows at a time, for memmapped maps larger than RAM.
+        """
+        for r in range(0, label.shape[0], rows):
+            self.update(prob[r: r + rows], label[r: r + rows], None if mask is None else mask[r: r + rows])
+        return self
+
+    def merge(self, other):
+        if other.num_bins != self.num_bins:
+            raise ValueError("cannot merge histograms with {} and {} bins".format(self.num_bins, other.num_bins))
+        self.pos += other.pos
+        self.neg += other.neg
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def all_reduce(self, device=None):
+        """
+        Sum the histograms of all DDP ranks in place.
+        """
+        counts = torch.as_tensor(np.stack([self.pos, self.neg]), device=device)
+        torch.distributed.all_reduce(counts)
+        counts = counts.cpu().numpy()
+        self.pos, self.neg = counts[0].copy(), counts[1].copy()
+        return self
+
+    def counts(self):
+        """
+        ``(thresholds, tp, fp, fn)`` arrays with one entry per bin.
+        """
+        tp = np.cumsum(self.pos[::-1])[::-1]
+        fp = np.cumsum(self.neg[::-1])[::-1]
+        fn = self.pos.sum() - tp
+        thresholds = np.arange(self.num_bins) / float(self.num_bins)
+        return thresholds, tp, fp, fn
+
+    def fbeta(self, beta=1.0):
+        _, tp, fp, fn = self.counts()
+        b2 = beta * beta
+        denom = (1 + b2) * tp + b2 * fn + fp
+        return np.where(denom > 0, (1 + b2) * tp / np.maximum(denom, 1), 0.0)
+
+    def dice(self):
+        return self.fbeta(1.0)
+
+    def iou(self):
+        _, tp, fp, fn = self.counts()
+        denom = tp + fp + fn
+        return np.where(denom > 0, tp / np.maximum(denom, 1), 0.0)
+
+    def at(self, threshold):
+        """
+        Bin index of a probability threshold.
+        """
+        return min(int(round(threshold * self.num_bins)), self.num_bins - 1)
+
+    def best(self, metric="f0.5"):
+        """
+        ``(threshold, value)`` maximising ``"dice"``, ``"iou"`` or ``"f<beta>"`` (e.g. ``"f0.5"``).
+        """
+        if metric == "dice":
+            curve = self.dice()
+        elif metric == "iou":
+            curve = self.iou()
+        elif metric.startswith("f"):
+            curve = self.fbeta(float(metric[1:]))
+        else:
+            raise ValueError("metric should be 'dice', 'iou' or 'f<beta>'")
+        b = int(np.argmax(curve))
+        return b / float(self.num_bins), float(curve[b])
+
+    def summary(self, threshold=0.5):
+        b = self.at(threshold)
+        best_t, best_f = self.best("f0.5")
+        return "dice@{:.2f} {:.4f} iou@{:.2f} {:.4f} f0.5@{:.2f} {:.4f}, best f0.5 {:.4f} at {:.3f}".format(
+            threshold, self.dice()[b], threshold, self.iou()[b], threshold, self.fbeta(0.5)[b], best_f, best_t
+        )
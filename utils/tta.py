@@ -0,0 +1,118 @@
+import time
+
+import torch
+
+# dihedral variants of a window: (flip W first, number of rot90 turns in the (H, W) plane)
+TTA_VARIANTS = {
+    "identity": (False, 0),
+    "rot90": (False, 1),
+    "rot180": (False, 2),
+    "rot270": (False, 3),
+    "flip": (True, 0),
+    "flip_rot90": (True, 1),
+    "flip_rot180": (True, 2),
+    "flip_rot270": (True, 3),
+}
+
+
+def parse_tta(tta):
+    """
+    ``"none"``, ``"flips"`` (identity and flip), ``"rot"`` (the four rotations), ``"all"`` (the 8 dihedral
+    variants) or a comma separated list of :py:data:`TTA_VARIANTS` names.
+    """
+    presets = {
+        "none": ["identity"],
+        "flips": ["identity", "flip"],
+        "rot": ["identity", "rot90", "rot180", "rot270"],
+        "all": list(TTA_VARIANTS),
+    }
+    if tta in presets:
+        return presets[tta]
+    variants = [v.strip() for v in tta.split(",") if v.strip()]
+    unknown = [v for v in variants if v not in TTA_VARIANTS]
+    if unknown or not variants:
+        raise ValueError("unknown TTA variants {}, choose from {}".format(unknown, list(TTA_VARIANTS)))
+    return variants
+
+
+class TTAPredictor(torch.nn.Module):
+    """
+    Test-time augmentation in one forward pass: the dihedral variants of every window are stacked into a single
+    batch, the outputs are mapped back with the inverse transform and averaged, so the inferer blends one
+    prediction per window.
+
+    Works for ``(B, C, H, W)`` windows of MyModel2d and ``(B, 1, H, W, D)`` windows of MyModel, the variants act
+    on the ``(H, W)`` plane. Rotations by 90/270 degrees need square windows.
+
+    Args:
+        predictor: model or callable applied to the stacked batch.
+        variants: list of :py:data:`TTA_VARIANTS` names, or a string understood by :py:func:`parse_tta`.
+    """
+
+    def __init__(self, predictor, variants="all"):
+        super().__init__()
+        self.predictor = predictor
+        self.variants = parse_tta(variants) if isinstance(variants, str) else list(variants)
+        self.reset_timing()
+
+    def reset_timing(self):
+        self.timing = {"forward": 0.0, "calls": 0}
+        self.timing.update({v: 0.0 for v in self.variants})
+
+    @staticmethod
+    def _apply(x, variant):
+        flip, k = TTA_VARIANTS[variant]
+        if flip:
+            x = torch.flip(x, dims=(3,))
+        return torch.rot90(x, k, dims=(2, 3)) if k else x
+
+    @staticmethod
+    def _invert(y, variant):
+        flip, k = TTA_VARIANTS[variant]
+        if k:
+            y = torch.rot90(y, -k, dims=(2, 3))
+        return torch.flip(y, dims=(3,)) if flip else y
+
+    def _sync(self, x):
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+        return time.time()
+
+    def forward(self, x):
+        if x.shape[2] != x.shape[3] and any(TTA_VARIANTS[v][1] % 2 for v in self.variants):
+            raise ValueError("rot90/rot270 TTA needs square windows, got {}".format(tuple(x.shape[2:4])))
+        batch = []
+        for v in self.variants:
+            start = self._sync(x)
+            batch.append(self._apply(x, v))
+            self.timing[v] += self._sync(x) - start
+        start = self._sync(x)
+        out = self.predictor(torch.cat(batch))
+        self.timing["forward"] += self._sync(x) - start
+        self.timing["calls"] += 1
+        out = out.float().split(x.shape[0])
+        acc = None
+        for v, y in zip(self.variants, out):
+            start = self._sync(x)
+            y = self._invert(y, v)
+            acc = y if acc is None else acc + y
+            self.timing[v] += self._sync(x) - start
+        return acc / len(self.variants)
+
+    def report(self):
+        """
+        Timing summary: the shared forward pass and the transform + inverse time of every variant.
+        """
+        calls = max(self.timing["calls"], 1)
+        lines = [
+            "TTA {} variants, {} batches, forward {:.3f}s ({:.4f}s/batch, {:.4f}s/batch/variant)".format(
+                len(self.variants),
+                self.timing["calls"],
+                self.timing["forward"],
+                self.timing["forward"] / calls,
+                self.timing["forward"] / calls / len(self.variants),
+            )
+        ]
+        for v in self.variants:
+            lines.append("  {:<12} transform+inverse {:.4f}s".format(v, self.timing[v]))
+        return "\n".join(lines)
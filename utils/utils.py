@@ -9,34 +9,36 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+
 import numpy as np
-import scipy.ndimage as ndimage
 import torch
 from monai import data, transforms
+from utils.inference import TileInferer
+from utils.resample import resample_nearest
 from utils.my_transform import *
 
+# number of random crops RandCropByPosNegLabeld draws from every training tile
+CROP_SAMPLES = {"3dswin": 8, "2dswin": 32, "25dswin": 32, "2dunet": 32}
 
 def resample_3d(img, target_size):
-    imx, imy, imz = img.shape
-    tx, ty, tz = target_size
-    zoom_ratio = (float(tx) / float(imx), float(ty) / float(imy), float(tz) / float(imz))
-    img_resampled = ndimage.zoom(img, zoom_ratio, order=0, prefilter=False)
+    # same samples as ndimage.zoom(order=0, prefilter=False), gathered with cached index vectors
+    img_resampled = resample_nearest(img, target_size, edge="zoom")
     return img_resampled
 
 def resample_2d(img, target_size):
-    imx, imy = img.shape
-    tx, ty = target_size
-    zoom_ratio = (float(tx) / float(imx), float(ty) / float(imy))
-    img_resampled = ndimage.zoom(img, zoom_ratio, order=0, prefilter=False)
+    img_resampled = resample_nearest(img, target_size, edge="zoom")
     return img_resampled
 
 
 def dice(x, y):
-    intersect = np.sum(np.sum(np.sum(x * y)))
-    y_sum = np.sum(np.sum(np.sum(y)))
+    x, y = np.asarray(x), np.asarray(y)
+    if x.dtype == bool and y.dtype == bool:
+        # masks: count instead of summing float products
+        intersect, y_sum, x_sum = np.count_nonzero(x & y), np.count_nonzero(y), np.count_nonzero(x)
+    else:
+        intersect, y_sum, x_sum = np.sum(x * y), np.sum(y), np.sum(x)
     if y_sum == 0:
         return 0.0
-    x_sum = np.sum(np.sum(np.sum(x)))
     return 2 * intersect / (x_sum + y_sum)
 
 
@@ -87,6 +89,32 @@ def distributed_all_gather(
             tensor_list_out.append(gather_list)
     return tensor_list_out
 
+def get_inferer(args, model, sw_device="cuda"):
+    if args.model_mode in ["3dswin", "3dunet"]:
+        roi_size = (args.roi_x, args.roi_y, args.roi_z)
+        # windows span the whole depth, only y/x overlap
+        overlap = (args.val_overlap, args.val_overlap, 0)
+    elif args.model_mode in ["2dswin", "25dswin", "2dunet"]:
+        roi_size = (args.roi_x, args.roi_y)
+        overlap = args.val_overlap
+    else:
+        raise ValueError("model mode error")
+    model_inferer = TileInferer(
+        model,
+        roi_size=roi_size,
+        sw_batch_size=8,
+        overlap=overlap,
+        device="cpu",
+        sw_device=sw_device,
+        mask_threshold=args.mask_threshold,
+        padding_mode="reflect",
+        blend_mode=args.blend_mode,
+        # MyModel ends with a sigmoid, the others return logits
+        background=0.0 if args.model_mode == "3dswin" else -20.0,
+    )
+    return model_inferer
+
+
 def get_transforms(args):
     if args.model_mode == "3dswin":
         train_transform = transforms.Compose(
@@ -109,13 +137,21 @@ def get_transforms(args):
                 printShaped(keys=["image", "label", 'inklabels']),
                 transforms.CropForegroundd(
                     keys=["image", "label", 'inklabels'], source_key="image"),
+                MaskedCropIndicesd(
+                    keys=['inklabels'],
+                    mask_key="label",
+                    spatial_size=(args.roi_x, args.roi_y, args.roi_z),
+                    threshold=args.crop_mask_threshold,
+                ),
                 transforms.RandCropByPosNegLabeld(
                     keys=["image", "label", 'inklabels'],
                     label_key="inklabels",
+                    fg_indices_key="inklabels_fg_indices",
+                    bg_indices_key="inklabels_bg_indices",
                     spatial_size=(args.roi_x, args.roi_y, args.roi_z),
                     pos=1,
                     neg=1,
-                    num_samples=8,
+                    num_samples=CROP_SAMPLES["3dswin"],
                     image_key="image",
                     image_threshold=0,
                     allow_smaller=False,
@@ -174,17 +210,19 @@ def get_transforms(args):
             transforms.ToTensord(keys=["image"]),
         ]
     )
-    elif args.model_mode == "2dswin":
+    elif args.model_mode in ["2dswin", "25dswin", "2dunet"]:
+        # cached teacher probabilities (main.py --teacher_cache) are cropped and augmented like the ink labels
+        soft = ["teacher"] if getattr(args, "teacher_cache", None) else []
         train_transform = transforms.Compose(
             [
                 transforms.LoadImaged(
-                    keys=["image", "label", 'inklabels'], reader="NumpyReader"),
+                    keys=["image", "label", 'inklabels'] + soft, reader="NumpyReader"),
                 transforms.AddChanneld(keys=["image"]),
-                Copyd(keys=["label", 'inklabels'],
+                Copyd(keys=["label", 'inklabels'] + soft,
                       num_channel=args.num_channel, add_channel=True),
-                change_channeld(keys=["image", "label", 'inklabels']),
+                change_channeld(keys=["image", "label", 'inklabels'] + soft),
                 transforms.Orientationd(
-                    keys=["image", "label", 'inklabels'], axcodes="RAS"),
+                    keys=["image", "label", 'inklabels'] + soft, axcodes="RAS"),
                 # transforms.Spacingd(
                 #     keys=["image", "label", 'inklabels'], pixdim=(args.space_x, args.space_y, args.space_z), mode=("bilinear", "nearest", "nearest")
                 # ),
@@ -194,35 +232,43 @@ def get_transforms(args):
                 # Drop1Layerd(keys=["image", "label", 'inklabels']),
                 # transforms.CropForegroundd(keys=["image", "label", 'inklabels'], source_key="image"),
                 # printShaped(keys=["image", "label", 'inklabels']),
+                MaskedCropIndicesd(
+                    keys=['inklabels'],
+                    mask_key="label",
+                    spatial_size=(args.roi_x, args.roi_y, args.roi_z),
+                    threshold=args.crop_mask_threshold,
+                ),
                 transforms.RandCropByPosNegLabeld(
-                    keys=["image", "label", 'inklabels'],
+                    keys=["image", "label", 'inklabels'] + soft,
                     label_key="inklabels",
+                    fg_indices_key="inklabels_fg_indices",
+                    bg_indices_key="inklabels_bg_indices",
                     spatial_size=(args.roi_x, args.roi_y, args.roi_z),
                     pos=1,
                     neg=1,
-                    num_samples=32,
+                    num_samples=CROP_SAMPLES[args.model_mode],
                     image_key="image",
                     image_threshold=0,
                     allow_smaller=False,
                 ),
                 # printShaped(keys=["image", "label", 'inklabels']),
                 transforms.RandFlipd(
-                    keys=["image", 'inklabels'], prob=args.RandFlipd_prob, spatial_axis=0),
+                    keys=["image", 'inklabels'] + soft, prob=args.RandFlipd_prob, spatial_axis=0),
                 transforms.RandFlipd(
-                    keys=["image", 'inklabels'], prob=args.RandFlipd_prob, spatial_axis=1),
+                    keys=["image", 'inklabels'] + soft, prob=args.RandFlipd_prob, spatial_axis=1),
                 transforms.RandFlipd(
-                    keys=["image", 'inklabels'], prob=args.RandFlipd_prob, spatial_axis=2),
+                    keys=["image", 'inklabels'] + soft, prob=args.RandFlipd_prob, spatial_axis=2),
                 transforms.RandRotate90d(
-                    keys=["image", 'inklabels'], prob=args.RandRotate90d_prob, max_k=3),
+                    keys=["image", 'inklabels'] + soft, prob=args.RandRotate90d_prob, max_k=3),
                 transforms.RandScaleIntensityd(
                     keys="image", factors=0.1, prob=args.RandScaleIntensityd_prob),
                 transforms.RandShiftIntensityd(
                     keys="image", offsets=0.1, prob=args.RandShiftIntensityd_prob),
                 change_channeld(
-                    keys=["image", "label", 'inklabels'], back=True),
+                    keys=["image", "label", 'inklabels'] + soft, back=True),
                 # printShaped(keys=["image", "label", 'inklabels']),
-                remove_channeld(keys=["image", "label", 'inklabels']),
-                transforms.ToTensord(keys=["image", 'inklabels']),
+                remove_channeld(keys=["image", "label", 'inklabels'] + soft),
+                transforms.ToTensord(keys=["image", 'inklabels'] + soft),
             ]
         )
         val_transform = transforms.Compose(
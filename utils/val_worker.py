@@ -0,0 +1,118 @@
+import copy
+import queue
+import time
+import traceback
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from utils.checkpoint_io import snapshot_to_cpu
+
+
+def _worker_main(args, device, acc_func, jobs, results):
+    # imported here, trainer imports this module
+    from trainer import val_epoch
+    from utils.data_utils import get_loader
+    from utils.myModel import get_model
+    from utils.utils import get_inferer
+
+    try:
+        args = copy.copy(args)
+        args.test_mode = True
+        args.distributed = False
+        args.rank = 0
+        args.amp = args.amp and device.startswith("cuda")
+        loader = get_loader(args)
+        model = get_model(args)
+        if hasattr(model, "set_checkpoint_policy"):
+            model.set_checkpoint_policy("none")
+        model.to(device)
+        model_inferer = get_inferer(args, model, sw_device=device)
+        results.put(("ready", None, None))
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            epoch, state_dict = job
+            start_time = time.time()
+            model.load_state_dict(state_dict)
+            acc = val_epoch(
+                model, loader, epoch=epoch, acc_func=acc_func, args=args, model_inferer=model_inferer, device=device
+            )
+            results.put((epoch, float(np.mean(acc)), time.time() - start_time))
+    except Exception:
+        results.put(("error", traceback.format_exc(), None))
+
+
+class ValidationWorker(object):
+    """
+    Runs :py:func:`trainer.val_epoch` with the usual ``model_inferer`` and ``acc_func`` in a separate process on
+    a spare device (or the CPU) so training does not pause for validation.
+
+    Weight snapshots go to the worker through a queue (CPU tensors travel through shared memory), results come
+    back as ``(epoch, acc, seconds)`` tuples collected with :py:meth:`poll`.
+
+    Args:
+        args: training arguments, the worker builds its own model, val loader and inferer from them.
+        device: device of the worker, e.g. ``"cuda:1"`` or ``"cpu"``.
+        acc_func: metric passed to ``val_epoch``.
+        max_pending: snapshots waiting for a result before new ones are skipped.
+    """
+
+    def __init__(self, args, device, acc_func, max_pending=2):
+        ctx = mp.get_context("spawn")
+        self.jobs = ctx.Queue()
+        self.results = ctx.Queue()
+        self.max_pending = max_pending
+        self.pending = set()
+        self.process = ctx.Process(
+            target=_worker_main, args=(args, device, acc_func, self.jobs, self.results), daemon=True
+        )
+        self.process.start()
+
+    def submit(self, epoch, state_dict):
+        """
+        Queue a snapshot of ``state_dict`` for validation, returns the CPU snapshot or None when the worker is
+        too far behind and the epoch is skipped.
+        """
+        if len(self.pending) >= self.max_pending:
+            return None
+        snapshot = snapshot_to_cpu(state_dict)
+        self.jobs.put((epoch, snapshot))
+        self.pending.add(epoch)
+        return snapshot
+
+    def poll(self, block=False):
+        """
+        Collect finished results, with ``block`` wait until no snapshot is pending.
+        """
+        out = []
+        while True:
+            try:
+                if block and self.pending:
+                    result = self.results.get(timeout=1.0)
+                else:
+                    result = self.results.get_nowait()
+            except queue.Empty:
+                if not (block and self.pending):
+                    return out
+                if not self.process.is_alive():
+                    raise RuntimeError("validation worker exited with pending epochs {}".format(sorted(self.pending)))
+                continue
+            if result[0] == "error":
+                raise RuntimeError("validation worker failed:\n" + result[1])
+            if result[0] != "ready":
+                self.pending.discard(result[0])
+                out.append(result)
+
+    def close(self):
+        """
+        Wait for the outstanding snapshots and stop the worker, returns their results.
+        """
+        out = []
+        while self.pending:
+            out += self.poll(block=True)
+        self.jobs.put(None)
+        self.process.join()
+        return out